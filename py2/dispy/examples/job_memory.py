@@ -0,0 +1,53 @@
+# program that reports memory used by client to keep track of jobs:
+# bytes per job that is queued (not yet sent to a node) and per job
+# that is running (serialized arguments are not kept once a node
+# accepts the job, unless cluster is created with 'reentrant=True')
+import sys
+
+def compute(n, data):
+    import time
+    time.sleep(n)
+    print('received %s bytes' % len(data))
+    return len(data)
+
+def job_size(job):
+    # approximate size of objects kept at client for 'job'
+    size = 0
+    seen = set()
+    objs = [job, job._dispy_job_]
+    while objs:
+        obj = objs.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple, set)):
+            objs.extend(obj)
+        elif isinstance(obj, dict):
+            objs.extend(obj.keys())
+            objs.extend(obj.values())
+        elif not isinstance(obj, (str, bytes)):
+            if hasattr(obj, '__dict__'):
+                objs.extend(obj.__dict__.values())
+            for attr in getattr(obj, '__slots__', ()):
+                # node is shared by all jobs
+                if attr != 'node':
+                    objs.append(getattr(obj, attr, None))
+    return size
+
+if __name__ == '__main__':
+    import dispy, time
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cluster = dispy.JobCluster(compute, discard_output=True)
+    data = 'x' * 1000
+    jobs = [cluster.submit(1, data) for i in range(n)]
+    queued = [job_size(job) for job in jobs if job.status == dispy.DispyJob.Created]
+    time.sleep(0.5)
+    running = [job_size(job) for job in jobs if job.status == dispy.DispyJob.Running]
+    if queued:
+        print('bytes per queued job: %d' % (sum(queued) / len(queued)))
+    if running:
+        print('bytes per running job: %d' % (sum(running) / len(running)))
+    cluster.wait()
+    print('output of jobs: %s' % set(job.stdout for job in jobs))
+    cluster.print_status()
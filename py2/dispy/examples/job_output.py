@@ -0,0 +1,35 @@
+# Example program where jobs print a lot. With capture_output='file',
+# nodes save output of jobs in files and keep only last 'max_output'
+# characters in memory, which are sent with results; full output of a
+# job is retrieved from node only when needed with 'fetch_output'.
+# See 'capture_output' in JobCluster for other modes ('tail' to keep
+# only last part, 'stream' to get output while jobs run etc.).
+
+def compute(n):
+    steps = n * 10000
+    for i in range(steps):
+        print('step %s of %s' % (i, steps))
+    if n % 5 == 0:
+        raise Exception('simulated failure')
+    return n
+
+if __name__ == '__main__':
+    import dispy
+    cluster = dispy.JobCluster(compute, capture_output='file', max_output=100)
+    jobs = []
+    for n in range(1, 11):
+        job = cluster.submit(n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: last output: %s' % (job.id, job.stdout.strip().split('\n')[-1]))
+        else:
+            # full output of failed job may help understand failure
+            output = cluster.fetch_output(job)
+            if output:
+                print('%s failed after %s lines of output' % (job.id, output[0].count('\n')))
+    cluster.print_status()
+    cluster.close()
@@ -0,0 +1,26 @@
+# program that reports overhead of executing jobs on nodes: time from
+# when a node accepts a job to when the computation finishes for a job
+# that does no work, and job throughput. Run dispynode with
+# '--max_worker_jobs 1' to compare with starting a process for each job
+# (nodes reuse worker processes by default)
+import sys
+
+def compute(n):
+    return n
+
+if __name__ == '__main__':
+    import dispy, time
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cluster = dispy.JobCluster(compute, discard_output=True)
+    # first job starts worker processes
+    cluster.submit(0)()
+    start = time.time()
+    jobs = [cluster.submit(i) for i in range(n)]
+    cluster.wait()
+    elapsed = time.time() - start
+    overhead = [job.end_time - job.start_time for job in jobs
+                if job.status == dispy.DispyJob.Finished]
+    if overhead:
+        print('overhead per job: %.2f ms' % (1000.0 * sum(overhead) / len(overhead)))
+    print('%d jobs in %.2f sec: %.1f jobs/sec' % (n, elapsed, n / elapsed))
+    cluster.close()
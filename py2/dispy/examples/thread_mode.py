@@ -0,0 +1,32 @@
+# Example program that executes jobs in threads on nodes with
+# exec_mode='thread'. Jobs that mostly wait for I/O (or call
+# functions that release GIL, such as many numpy functions) don't need
+# separate processes; with 'jobs_per_cpu=4', each node runs up to 4
+# jobs for each of its cpus, so 20 jobs finish in about the time of 5
+# jobs on a node with 1 cpu.
+
+def compute(n):
+    import time, threading
+    # simulate waiting for I/O
+    time.sleep(1)
+    return (threading.current_thread().name, n * n)
+
+if __name__ == '__main__':
+    import dispy, time
+    cluster = dispy.JobCluster(compute, exec_mode='thread', jobs_per_cpu=4)
+    start = time.time()
+    jobs = []
+    for n in range(20):
+        job = cluster.submit(n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: %s (%s)' % (job.id, job.result[1], job.result[0]))
+        else:
+            print(job.exception)
+    print('elapsed: %.1f sec' % (time.time() - start))
+    cluster.print_status()
+    cluster.close()
@@ -0,0 +1,43 @@
+# Example program that uses 'worker_setup' and 'worker_cleanup'
+# functions to create state in each worker process on nodes that is
+# used by all jobs executed by that worker. Unlike with 'setup', this
+# state is created after worker process is started, so it can be
+# objects that can't be used across fork, such as database
+# connections or thread pools. Here an sqlite database connection is
+# opened once in each worker instead of for each job.
+
+def worker_setup(n):
+    global db
+    import sqlite3
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE squares (n INTEGER PRIMARY KEY, square INTEGER)')
+    db.executemany('INSERT INTO squares VALUES (?, ?)', [(i, i * i) for i in range(n)])
+    return 0
+
+def worker_cleanup():
+    db.close()
+
+def compute(n):
+    import os
+    # 'db' global variable is initialized in 'worker_setup'
+    square = db.execute('SELECT square FROM squares WHERE n = ?', (n,)).fetchone()[0]
+    return (os.getpid(), square)
+
+if __name__ == '__main__':
+    import dispy, functools
+    cluster = dispy.JobCluster(compute, worker_setup=functools.partial(worker_setup, 1000),
+                               worker_cleanup=worker_cleanup)
+    jobs = []
+    for n in range(20):
+        job = cluster.submit(n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: %s (worker %s)' % (job.id, job.result[1], job.result[0]))
+        else:
+            print(job.exception)
+    cluster.print_status()
+    cluster.close()
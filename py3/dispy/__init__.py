@@ -16,7 +16,8 @@ __url__ = "http://dispy.sourceforge.net"
 __status__ = "Production"
 __version__ = "4.5"
 
-__all__ = ['logger', 'DispyJob', 'DispyNode', 'NodeAllocate', 'JobCluster', 'SharedJobCluster']
+__all__ = ['logger', 'DispyJob', 'DispyNode', 'NodeAllocate', 'ResultCache', 'JobCluster',
+           'SharedJobCluster']
 
 import os
 import sys
@@ -31,18 +32,33 @@ import ssl
 import hashlib
 import traceback
 import shelve
+import sqlite3
+import struct
+import mmap
+import tempfile
+import shutil
 import datetime
 import atexit
 import functools
 import queue
 import numbers
 import collections
+import weakref
 
 import asyncoro
 from asyncoro import Coro, AsynCoro, AsyncSocket, MetaSingleton, serialize, unserialize
 
 _dispy_version = __version__
 MsgTimeout = 5
+# number of threads used for disk I/O (so asyncoro's event loop is not
+# blocked by slow disks)
+IOThreads = 4
+# size of parts in which files (and memory mapped results) are
+# received and written
+XferChunkSize = 8 * 1024**2
+# maximum number of results sent (when resending saved results) before
+# their acknowledgements are received
+ResendWindow = 128
 
 logger = logging.getLogger('dispy')
 logger.setLevel(logging.INFO)
@@ -78,13 +94,19 @@ class DispyJob(object):
     .ip_addr is read-inly field; it is set to IP address of node that
     executed job.
 
+    If cluster is created with capture_output='stream', .stdout and
+    .stderr are updated as nodes send output of running job. With
+    capture_output='file', full output of job is saved on node and
+    can be retrieved with 'fetch_output' method of cluster.
+
     .finish is a read-only event that is set when a job's results are
     available.
 
     """
 
     __slots__ = ('id', 'args', 'kwargs', 'result', 'stdout', 'stderr', 'exception',
-                 'start_time', 'end_time', 'status', 'ip_addr', 'finish', '_dispy_job_')
+                 'start_time', 'end_time', 'status', 'ip_addr', 'finish', '_dispy_job_',
+                 '_dispy_output_')
 
     Created = 5
     Running = 6
@@ -117,6 +139,8 @@ class DispyJob(object):
 
         # _dispy_job_ is for dispy implementation only - it is opaque to users
         self._dispy_job_ = None
+        # uid of job on node if its output is saved there
+        self._dispy_output_ = None
 
     def __call__(self, clear=False):
         self.finish.wait()
@@ -152,6 +176,17 @@ class DispyNode(object):
         self.jobs_done = 0
         self.cpu_time = 0.0
         self.update_time = 0
+        # dictionary with 'numa_nodes' (list of cpus in each NUMA node),
+        # 'affinity' and 'cores_per_job' of dispynode (if known)
+        self.topology = None
+        # bytes used by files under dispynode's 'dest_path_prefix' (as
+        # reported in its pulse messages; None if not known)
+        self.disk_usage = None
+        # number of computations whose compiled code was found (or not
+        # found) in dispynode's code cache (as reported in its pulse
+        # messages; None if not known)
+        self.code_cache_hits = None
+        self.code_cache_misses = None
 
 
 class NodeAllocate(object):
@@ -212,6 +247,180 @@ class NodeAllocate(object):
 ClusterStatus = collections.namedtuple('ClusterStatus', ['nodes', 'jobs_pending'])
 
 
+class ResultCache(object):
+    """Results of jobs that finish successfully can be cached (by
+    passing an instance of this class as 'result_cache' to
+    JobCluster or SharedJobCluster), so that when a job is submitted
+    again with same arguments, it is not executed; instead, the result
+    (and output) of earlier execution is returned immediately. Jobs
+    are identified by code of computation, code of dependencies and
+    the (serialized) arguments, so a change in computation's source
+    code invalidates cached results.
+
+    @max_entries is maximum number of results kept in memory; when
+    more results are cached, least recently used results are evicted.
+
+    @path, if given, is directory where results are stored as well,
+    so they are available to later runs of the program; results of a
+    computation are stored in a subdirectory with name of the
+    computation (and digest of its code). These results are removed
+    if the computation's code is changed.
+
+    A cache can be shared by clusters (of same or different
+    computations); results of each computation are kept separately.
+
+    @max_disk_size is maximum total size (in bytes) of results stored
+    under @path; least recently used results are removed to keep the
+    size below this limit.
+
+    'hits' and 'misses' count number of jobs found and not found in
+    the cache.
+    """
+
+    def __init__(self, max_entries=1024, path=None, max_disk_size=100*1024*1024):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # key -> (file, size) of results stored on disk, in LRU order
+        self._disk_entries = collections.OrderedDict()
+        self._disk_size = 0
+        # code digest -> directory of results of computations set up
+        self._dirs = {}
+
+    def clear(self):
+        """Remove all cached results (in memory and on disk).
+        """
+        with self._lock:
+            self._entries.clear()
+            for f, size in self._disk_entries.values():
+                try:
+                    os.remove(f)
+                except:
+                    pass
+            self._disk_entries.clear()
+            self._disk_size = 0
+
+    def _setup(self, compute):
+        # called when cluster is created; returns digest of code of
+        # computation, which cluster passes to '_key' and '_put'.
+        # Results (on disk) of a different version of computation are
+        # discarded
+        digest = hashlib.sha1(compute.name.encode() + compute.code.encode())
+        for xf in compute.xfer_files:
+            digest.update(('%s:%s:%s' % (os.path.basename(xf.name), xf.stat_buf.st_size,
+                                         xf.stat_buf.st_mtime)).encode())
+        digest = digest.hexdigest()
+        with self._lock:
+            if not self.path or digest in self._dirs:
+                self._dirs.setdefault(digest, None)
+                return digest
+            name_dir = os.path.join(self.path, compute.name)
+            if not os.path.isdir(name_dir):
+                os.makedirs(name_dir)
+            in_use = set(self._dirs.values())
+            for name in os.listdir(name_dir):
+                f = os.path.join(name_dir, name)
+                if name == digest or f in in_use:
+                    continue
+                # results of other versions of computation (or saved
+                # by earlier versions of dispy)
+                try:
+                    if os.path.isdir(f):
+                        shutil.rmtree(f)
+                    else:
+                        os.remove(f)
+                except:
+                    logger.warning('Could not remove cached results "%s"', f)
+            result_dir = os.path.join(name_dir, digest)
+            if not os.path.isdir(result_dir):
+                os.makedirs(result_dir)
+            self._dirs[digest] = result_dir
+            entries = []
+            for key in os.listdir(result_dir):
+                f = os.path.join(result_dir, key)
+                try:
+                    stat_buf = os.stat(f)
+                except:
+                    continue
+                entries.append((stat_buf.st_mtime, key, f, stat_buf.st_size))
+            entries.sort()
+            for mtime, key, f, size in entries:
+                self._disk_entries[key] = (f, size)
+                self._disk_size += size
+            return digest
+
+    def _key(self, _job, code_digest):
+        digest = hashlib.sha1(code_digest.encode())
+        digest.update(_job.code.encode())
+        digest.update(_job.args)
+        digest.update(_job.kwargs)
+        for xf in _job.xfer_files:
+            digest.update(('%s:%s:%s' % (xf.name, xf.stat_buf.st_size,
+                                         xf.stat_buf.st_mtime)).encode())
+        return digest.hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None and key in self._disk_entries:
+                f = self._disk_entries[key][0]
+                try:
+                    with open(f, 'rb') as fd:
+                        entry = unserialize(fd.read())
+                    os.utime(f, None)
+                except:
+                    logger.debug('Could not read cached result "%s"', f)
+                    self._disk_size -= self._disk_entries.pop(key)[1]
+                else:
+                    self._disk_entries[key] = self._disk_entries.pop(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.hits += 1
+            return entry
+
+    def _put(self, key, job, code_digest):
+        # called (by worker thread) with a job that finished successfully
+        entry = (job.result, job.stdout, job.stderr)
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            result_dir = self._dirs.get(code_digest, None)
+            if not result_dir or key in self._disk_entries:
+                return
+            try:
+                data = serialize(entry)
+            except:
+                logger.debug('Could not serialize result of job %s', job.id)
+                return
+            if len(data) > self.max_disk_size:
+                return
+            while self._disk_entries and (self._disk_size + len(data)) > self.max_disk_size:
+                old_key, (f, size) = self._disk_entries.popitem(last=False)
+                self._disk_size -= size
+                try:
+                    os.remove(f)
+                except:
+                    pass
+            f = os.path.join(result_dir, key)
+            try:
+                with open(f, 'wb') as fd:
+                    fd.write(data)
+            except:
+                logger.warning('Could not store result of job %s in cache', job.id)
+            else:
+                self._disk_entries[key] = (f, len(data))
+                self._disk_size += len(data)
+
+
 def num_min(*args):
     items = [arg for arg in args if isinstance(arg, numbers.Number)]
     if not items:
@@ -226,6 +435,34 @@ def num_max(*args):
     return max(items)
 
 
+def _add_job_output(job, stdout, stderr):
+    # output of running job with capture_output='stream'
+    if stdout:
+        job.stdout = stdout if job.stdout is None else (job.stdout + stdout)
+    if stderr:
+        job.stderr = stderr if job.stderr is None else (job.stderr + stderr)
+
+
+# source of functions / classes that jobs depend on, so it is extracted
+# only once for many jobs
+_dep_sources = weakref.WeakKeyDictionary()
+
+
+def _dep_source(dep):
+    try:
+        return _dep_sources[dep]
+    except KeyError:
+        pass
+    lines = inspect.getsourcelines(dep)[0]
+    lines[0] = lines[0].lstrip()
+    source = ''.join(lines)
+    try:
+        _dep_sources[dep] = source
+    except TypeError:
+        pass
+    return source
+
+
 def _same_file(tgt, xf):
     """Internal use only.
     """
@@ -240,6 +477,100 @@ def _same_file(tgt, xf):
         return False
 
 
+def _write_file(path, data):
+    """Internal use only.
+
+    Writes 'data' to file 'path'; called in I/O threads.
+    """
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+
+def _map_result(path, info):
+    """Internal use only.
+
+    Returns result saved in file 'path' (see _MappedResult) memory
+    mapped: read-only numpy.memmap for kind 'numpy' and read-only memoryview for kind
+    'bytes'.
+    """
+    if info.kind == 'numpy':
+        import numpy
+        return numpy.memmap(path, dtype=info.meta[0], mode='r', shape=info.meta[1])
+    fd = open(path, 'rb')
+    try:
+        return memoryview(mmap.mmap(fd.fileno(), info.size, access=mmap.ACCESS_READ))
+    finally:
+        fd.close()
+
+
+def _recv_mapped_result(info, sock, dest_path, io_pool, coro=None):
+    """Internal use only.
+
+    Receives data of result described by 'info' (_MappedResult) from
+    'sock' and saves it in a new file in 'dest_path' (in I/O threads),
+    then returns the result memory mapped from that file. If
+    'dest_path' is None, data is discarded.
+
+    If data can't be read, IOError (or socket error) is raised and
+    'sock' can't be used anymore. If data can't be saved (e.g., disk is
+    full), rest of data is read (and discarded) before exception is
+    raised, so reply can be rejected over 'sock'.
+    """
+    # generator
+    size = yield sock.recvall(8)
+    if len(size) != 8:
+        raise IOError('invalid size of result')
+    size = struct.unpack('>Q', size)[0]
+    fd = path = error = None
+    if dest_path:
+        try:
+            fd, path = yield io_pool.async_task(tempfile.mkstemp, '', '_dispy_result_',
+                                                dest_path)
+            fd = os.fdopen(fd, 'wb')
+        except:
+            error = traceback.format_exc()
+            fd = None
+
+    def discard_file():
+        try:
+            fd.close()
+        except:
+            pass
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    try:
+        n = 0
+        while n < size:
+            data = yield sock.recvall(min(size - n, XferChunkSize))
+            if not data:
+                raise IOError('read only %s of %s bytes' % (n, size))
+            if fd:
+                try:
+                    yield io_pool.async_task(fd.write, data)
+                except:
+                    error = traceback.format_exc()
+                    discard_file()
+                    fd = None
+            n += len(data)
+        data = None
+    except:
+        if fd:
+            discard_file()
+        raise
+    result = None
+    if fd:
+        try:
+            yield io_pool.async_task(fd.close)
+            result = yield io_pool.async_task(_map_result, path, info)
+        except:
+            error = traceback.format_exc()
+            discard_file()
+    if error:
+        raise Exception('Could not save result: %s' % error)
+    raise StopIteration(result)
+
+
 def auth_code(secret, sign):
     return bytes(hashlib.sha1(bytes(secret + sign, 'ascii')).hexdigest(), 'ascii')
 
@@ -300,11 +631,22 @@ class _Compute(object):
         self.reentrant = False
         self.setup = None
         self.cleanup = None
+        self.worker_setup = None
+        self.worker_cleanup = None
         self.scheduler_ip_addr = None
         self.scheduler_port = None
         self.auth = None
         self.job_result_port = None
         self.pulse_interval = None
+        self.capture_output = 'memory'
+        self.max_output = 0
+        self.max_pending = 0
+        self.exec_mode = 'process'
+        self.jobs_per_cpu = 1
+        self.program_worker = False
+        self.reuse_workers = False
+        self.weight = 1
+        self.mmap_result_size = 0
 
     def __getstate__(self):
         state = dict(self.__dict__)
@@ -314,12 +656,51 @@ class _Compute(object):
 class _XferFile(object):
     """Internal use only.
     """
+
+    __slots__ = ('name', 'stat_buf', 'compute_id', 'sep')
+
     def __init__(self, name, stat_buf, compute_id=None):
         self.name = name
         self.stat_buf = stat_buf
         self.compute_id = compute_id
         self.sep = os.sep
 
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+class _Broadcast(object):
+    """Internal use only.
+
+    Data sent to nodes with 'broadcast' method of cluster.
+    """
+
+    def __init__(self, name, obj):
+        if not isinstance(name, str) or not name:
+            raise Exception('Invalid broadcast name; must be a string')
+        self.name = name
+        self.meta = None
+        numpy = sys.modules.get('numpy', None)
+        if numpy is not None and isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject:
+            # nodes don't need numpy; jobs create array with the data
+            self.kind = 'numpy'
+            self.meta = (obj.dtype.str, obj.shape)
+            self.data = numpy.ascontiguousarray(obj).tobytes()
+        elif isinstance(obj, (bytes, bytearray)):
+            self.kind = 'bytes'
+            self.data = bytes(obj)
+        else:
+            self.kind = 'pickle'
+            self.data = serialize(obj)
+
+    def header(self, compute_id, auth):
+        return {'compute_id': compute_id, 'auth': auth, 'name': self.name,
+                'kind': self.kind, 'meta': self.meta, 'size': len(self.data)}
+
 
 class _Node(object):
     """Internal use only.
@@ -339,7 +720,12 @@ class _Node(object):
         self.certfile = certfile
         self.last_pulse = None
         self.scheduler_ip_addr = None
+        self.topology = None
+        self.overcommit = 0
         self._jobs = set()
+        # hashes of job dependency code sent to (and kept by) node, for
+        # each computation
+        self.job_codes = {}
 
     def setup(self, compute, coro=None):
         # generator
@@ -363,11 +749,13 @@ class _Node(object):
                 raise StopIteration(resp)
         raise StopIteration(0)
 
-    def send(self, msg, reply=True, coro=None):
+    def send(self, msg, reply=True, timeout=None, coro=None):
         # generator
+        if timeout is None:
+            timeout = MsgTimeout
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock = AsyncSocket(sock, keyfile=self.keyfile, certfile=self.certfile)
-        sock.settimeout(MsgTimeout)
+        sock.settimeout(timeout)
         try:
             yield sock.connect((self.ip_addr, self.port))
             yield sock.sendall(self.auth)
@@ -418,6 +806,56 @@ class _Node(object):
             resp = 0
         raise StopIteration(resp)
 
+    def broadcast(self, compute, bc, coro=None):
+        # generator
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.keyfile, certfile=self.certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            yield sock.connect((self.ip_addr, self.port))
+            yield sock.sendall(self.auth)
+            yield sock.send_msg(b'BROADCAST:' + serialize(bc.header(compute.id, compute.auth)))
+            resp = yield sock.recv_msg()
+            if resp == b'ACK':
+                for i in range(0, len(bc.data), 1024000):
+                    yield sock.sendall(bc.data[i:i + 1024000])
+                resp = yield sock.recv_msg()
+        except:
+            logger.error('Could not send "%s" to %s', bc.name, self.ip_addr)
+            resp = traceback.format_exc()
+        finally:
+            sock.close()
+
+        if resp == b'ACK':
+            resp = 0
+        raise StopIteration(resp)
+
+    def retrieve_output(self, compute, uid, coro=None):
+        # generator
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.keyfile, certfile=self.certfile)
+        sock.settimeout(MsgTimeout)
+        output = None
+        try:
+            yield sock.connect((self.ip_addr, self.port))
+            yield sock.sendall(self.auth)
+            req = {'compute_id': compute.id, 'auth': compute.auth, 'uid': uid}
+            yield sock.send_msg(b'RETRIEVE_OUTPUT:' + serialize(req))
+            sizes = yield sock.recv_msg()
+            sizes = unserialize(sizes)
+            if sizes is not None:
+                output = []
+                for size in sizes:
+                    data = yield sock.recvall(size)
+                    assert len(data) == size
+                    output.append(data)
+        except:
+            logger.warning('Could not retrieve output of job %s from %s', uid, self.ip_addr)
+            output = None
+        finally:
+            sock.close()
+        raise StopIteration(output)
+
     def close(self, compute, coro=None):
         # generator
         logger.debug('Closing node %s for %s / %s', self.ip_addr, compute.name, compute.id)
@@ -427,6 +865,7 @@ class _Node(object):
         except:
             logger.debug('Deleting computation %s/%s from %s failed',
                          compute.id, compute.name, self.ip_addr)
+        self.job_codes.pop(compute.id, None)
         self.busy = 0
 
 
@@ -434,7 +873,8 @@ class _DispyJob_(object):
     """Internal use only.
     """
 
-    __slots__ = ('job', 'uid', 'compute_id', 'hash', 'node', 'xfer_files', 'args', 'kwargs', 'code')
+    __slots__ = ('job', 'uid', 'compute_id', 'hash', 'node', 'xfer_files', 'args', 'kwargs', 'code',
+                 'code_hash', 'after', 'after_args', 'children', 'cache_key')
 
     def __init__(self, compute_id, args, kwargs):
         self.job = DispyJob(args, kwargs)
@@ -445,6 +885,14 @@ class _DispyJob_(object):
         self.node = None
         self.xfer_files = []
         self.code = ''
+        # 'after' is list of parent jobs this job is waiting for (if
+        # any); until the job is released, 'after_args' indicates if
+        # results of parents should be passed to it, after that it is
+        # serialized list of those results (appended to 'args' on node)
+        self.after = None
+        self.after_args = None
+        self.children = None
+        self.cache_key = None
         job_deps = kwargs.pop('dispy_job_depends', [])
         self.args = serialize(args)
         self.kwargs = serialize(kwargs)
@@ -469,17 +917,21 @@ class _DispyJob_(object):
                     dep = dep.__class__
                 if id(dep) in depend_ids:
                     continue
-                lines = inspect.getsourcelines(dep)[0]
-                lines[0] = lines[0].lstrip()
-                self.code += '\n' + ''.join(lines)
+                self.code += '\n' + _dep_source(dep)
                 depend_ids.add(id(dep))
             else:
                 logger.warning('Invalid job depends element "%s"; ignoring it.', dep)
+        # nodes keep compiled code by its hash, so code is sent only
+        # once to a node (for a computation)
+        if self.code:
+            self.code_hash = hashlib.sha1(self.code.encode()).hexdigest()
+        else:
+            self.code_hash = None
 
     def __getstate__(self):
         state = {'uid': self.uid, 'hash': self.hash, 'compute_id': self.compute_id,
                  'args': self.args, 'kwargs': self.kwargs, 'xfer_files': self.xfer_files,
-                 'code': self.code}
+                 'code': self.code, 'code_hash': self.code_hash, 'after_args': self.after_args}
         return state
 
     def __setstate__(self, state):
@@ -501,11 +953,23 @@ class _DispyJob_(object):
             if resp:
                 logger.warning('Transfer of file "%s" to %s failed' % (xf.name, self.node.ip_addr))
                 raise Exception(-1)
-        resp = yield self.node.send(b'JOB:' + serialize(self), coro=coro)
+        job_codes = self.node.job_codes.get(self.compute_id, None)
+        if self.code_hash and job_codes and self.code_hash in job_codes:
+            code, self.code = self.code, ''
+            msg = b'JOB:' + serialize(self)
+            self.code = code
+            resp = yield self.node.send(msg, coro=coro)
+            if resp == b'NAK (job code)':
+                job_codes.discard(self.code_hash)
+                resp = yield self.node.send(b'JOB:' + serialize(self), coro=coro)
+        else:
+            resp = yield self.node.send(b'JOB:' + serialize(self), coro=coro)
         # TODO: deal with NAKs (reschedule?)
         if resp != 0:
             logger.warning('Failed to run %s on %s: %s', self.uid, self.node.ip_addr, resp)
             raise Exception(str(resp))
+        if self.code_hash:
+            self.node.job_codes.setdefault(self.compute_id, set()).add(self.code_hash)
         raise StopIteration(resp)
 
     def finish(self, status):
@@ -520,6 +984,10 @@ class _DispyJob_(object):
 class _JobReply(object):
     """Internal use only.
     """
+
+    __slots__ = ('uid', 'hash', 'ip_addr', 'status', 'result', 'stdout', 'stderr', 'exception',
+                 'start_time', 'end_time', 'cpus')
+
     def __init__(self, _job, ip_addr, status=None, keyfile=None, certfile=None):
         self.uid = _job.uid
         self.hash = _job.hash
@@ -531,6 +999,584 @@ class _JobReply(object):
         self.exception = None
         self.start_time = 0
         self.end_time = 0
+        self.cpus = 0
+
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+class _MappedResult(object):
+    """Internal use only.
+
+    Describes result of job (bytes or numpy array) that node sends as
+    raw data right after job's reply, instead of serializing it with
+    the reply, so client can save it in a file and memory map it (see
+    'mmap_result_size' of JobCluster).
+    """
+
+    def __init__(self, kind, meta, size):
+        self.kind = kind
+        self.meta = meta
+        self.size = size
+
+
+class _ResultStore(object):
+    """Internal use only.
+
+    Results of jobs that could not be sent to client are kept in this
+    store (sqlite database in computation's directory) until they are
+    delivered or retrieved. Results are indexed by job's uid and
+    iterated in order of uid. If result of a job is already in a file
+    (e.g., large results on nodes), only the path of that file is kept
+    with (light) reply. Size of each result (with its file) and time
+    when it is saved are kept so oldest results can be discarded when
+    results use too much disk space. The database is removed when it
+    is empty.
+    """
+
+    # removed entries are reclaimed after these many removals
+    CompactCount = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._count = 0
+        self._size = 0
+        self._removed = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                             '(uid INTEGER PRIMARY KEY, reply BLOB, path TEXT, '
+                             'size INTEGER DEFAULT 0, saved REAL)')
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(results)')]
+            if 'size' not in columns:
+                # database saved by earlier version
+                self._db.execute('ALTER TABLE results ADD COLUMN size INTEGER DEFAULT 0')
+                self._db.execute('ALTER TABLE results ADD COLUMN saved REAL')
+                self._db.execute('UPDATE results SET saved = 0')
+            self._count, self._size = self._db.execute(
+                'SELECT COUNT(*), TOTAL(size) FROM results').fetchone()
+            self._size = int(self._size)
+            self._removed = 0
+        return self._db
+
+    def __len__(self):
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return 0
+            self._open()
+            return self._count
+
+    def put(self, uid, reply, path=None):
+        """Save 'reply' of job with 'uid'; if 'path' is given, it is
+        file with (serialized) full reply.
+        """
+        data = sqlite3.Binary(serialize(reply))
+        size = len(data)
+        if path:
+            size += os.path.getsize(path)
+        with self._lock:
+            db = self._open()
+            row = db.execute('SELECT size FROM results WHERE uid = ?', (uid,)).fetchone()
+            if row is None:
+                db.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?)',
+                           (uid, data, path, size, time.time()))
+                self._count += 1
+            else:
+                db.execute('UPDATE results SET reply = ?, path = ?, size = ?, saved = ? '
+                           'WHERE uid = ?', (data, path, size, time.time(), uid))
+                self._size -= row[0]
+            self._size += size
+
+    def get(self, uid):
+        """Returns tuple (reply, path) for job with 'uid', or None if
+        it is not in the store.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return None
+            row = self._open().execute('SELECT reply, path FROM results WHERE uid = ?',
+                                       (uid,)).fetchone()
+        if row is None:
+            return None
+        return (unserialize(bytes(row[0])), row[1])
+
+    def uids(self, after=None, limit=-1):
+        """Returns list of (at most 'limit') uids in the store, in
+        ascending order, greater than 'after' if it is not None.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return []
+            if after is None:
+                after = -1
+            return [row[0] for row in self._open().execute(
+                'SELECT uid FROM results WHERE uid > ? ORDER BY uid LIMIT ?', (after, limit))]
+
+    def items(self, after=None, limit=-1):
+        """Returns list of (at most 'limit') tuples (uid, reply, path),
+        in ascending order of uid, with uid greater than 'after' if it
+        is not None.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return []
+            if after is None:
+                after = -1
+            rows = self._open().execute(
+                'SELECT uid, reply, path FROM results WHERE uid > ? ORDER BY uid LIMIT ?',
+                (after, limit)).fetchall()
+        return [(row[0], unserialize(bytes(row[1])), row[2]) for row in rows]
+
+    def remove(self, uid):
+        """Remove reply of job with 'uid' (and the file with reply, if
+        any). Returns True if it was in the store.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return False
+            db = self._open()
+            row = db.execute('SELECT path, size FROM results WHERE uid = ?',
+                             (uid,)).fetchone()
+            if row is None:
+                return False
+            db.execute('DELETE FROM results WHERE uid = ?', (uid,))
+            self._count -= 1
+            self._size -= row[1]
+            self._removed += 1
+            if row[0]:
+                try:
+                    os.remove(row[0])
+                except:
+                    logger.warning('Could not remove "%s"', row[0])
+            if self._count == 0:
+                self._close()
+            elif self._removed >= self.CompactCount:
+                self._compact()
+        return True
+
+    def nbytes(self):
+        """Returns number of bytes used by results in the store.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return 0
+            self._open()
+            return self._size
+
+    def oldest(self, limit=-1):
+        """Returns list of (at most 'limit') tuples (saved, uid, size)
+        of results in the store, oldest first; results replaced with
+        'discard' are not included.
+        """
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return []
+            return self._open().execute(
+                'SELECT saved, uid, size FROM results WHERE saved IS NOT NULL '
+                'ORDER BY saved LIMIT ?', (limit,)).fetchall()
+
+    def discard(self, uid, reply):
+        """Replace result of job with 'uid' with (small) 'reply' to
+        reclaim space used by it (and remove file with result, if
+        any). Returns number of bytes reclaimed.
+        """
+        data = sqlite3.Binary(serialize(reply))
+        with self._lock:
+            if self._db is None and not os.path.isfile(self.path):
+                return 0
+            db = self._open()
+            row = db.execute('SELECT path, size FROM results WHERE uid = ?',
+                             (uid,)).fetchone()
+            if row is None:
+                return 0
+            db.execute('UPDATE results SET reply = ?, path = NULL, size = ?, saved = NULL '
+                       'WHERE uid = ?', (data, len(data), uid))
+            self._size += len(data) - row[1]
+            self._removed += 1
+            if row[0]:
+                try:
+                    os.remove(row[0])
+                except:
+                    logger.warning('Could not remove "%s"', row[0])
+            if self._removed >= self.CompactCount:
+                self._compact()
+        return row[1] - len(data)
+
+    def _compact(self):
+        self._db.execute('VACUUM')
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._removed = 0
+
+    def compact(self):
+        """Reclaim space used by removed entries.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._compact()
+
+    def _close(self):
+        if self._db is None:
+            return
+        self._db.close()
+        self._db = None
+        if self._count == 0:
+            for path in (self.path, self.path + '-wal', self.path + '-shm'):
+                if os.path.isfile(path):
+                    try:
+                        os.remove(path)
+                    except:
+                        logger.warning('Could not remove "%s"', path)
+
+    def close(self):
+        """Close the store; database is removed if it is empty.
+        """
+        with self._lock:
+            self._close()
+
+
+def _recv_result_ack(store, uid, sock, owner, peer, io_pool):
+    """Internal use only.
+
+    Receives acknowledgement for result of job 'uid' sent over 'sock'.
+    If 'peer' acknowledges it, the result is removed from 'store' (and
+    'pending_results' of 'owner' updated); otherwise it is kept (and
+    sent again with later resend or retrieve). Returns True if result
+    is acknowledged.
+    """
+    # generator
+    ack = yield sock.recv_msg()
+    if ack != b'ACK':
+        logger.warning('Result of job %s is not acknowledged by %s', uid, peer)
+        raise StopIteration(False)
+    # result may have been sent (and removed) already
+    removed = yield io_pool.async_task(store.remove, uid)
+    if removed:
+        owner.pending_results -= 1
+    raise StopIteration(True)
+
+
+def _send_stored_results(store, sock, send_reply, owner, peer, io_pool, jobs=None,
+                         resend_rate=0, coro=None):
+    """Internal use only.
+
+    Sends results saved in 'store' (_ResultStore) over 'sock': all
+    results, or only those in 'jobs' (dictionary of uid to hash of
+    job). Each result is sent with generator function 'send_reply',
+    called with reply and path of file with reply (or None). Up to
+    ResendWindow results are sent before their acknowledgements are
+    received, and at most 'resend_rate' results per second (if it is
+    not 0). Results are removed from 'store' as 'peer' acknowledges
+    them (see '_recv_result_ack'). Returns number of results sent.
+    """
+    # generator
+    sent = collections.deque()
+    count = 0
+    if jobs is not None:
+        uids = sorted(jobs)
+
+    def saved_results(after):
+        # called in I/O thread; returns next batch of results and
+        # position to get batch after it
+        if jobs is None:
+            results = store.items(after=after, limit=1024)
+            return (results, results[-1][0] if results else None)
+        if after is None:
+            after = 0
+        results = []
+        for uid in uids[after:after + 1024]:
+            result = store.get(uid)
+            if result and result[0].hash == jobs[uid]:
+                results.append((uid, result[0], result[1]))
+        after += 1024
+        return (results, after if after < len(uids) else None)
+
+    start_time = time.time()
+    after = None
+    while True:
+        results, after = yield io_pool.async_task(saved_results, after)
+        for uid, reply, path in results:
+            yield send_reply(reply, path)
+            sent.append(uid)
+            count += 1
+            if len(sent) >= ResendWindow:
+                yield _recv_result_ack(store, sent.popleft(), sock, owner, peer, io_pool)
+            if resend_rate:
+                delay = (count / float(resend_rate)) - (time.time() - start_time)
+                if delay > 0:
+                    yield coro.sleep(delay)
+        if after is None:
+            break
+    while sent:
+        yield _recv_result_ack(store, sent.popleft(), sock, owner, peer, io_pool)
+    yield sock.send_msg(b'END')
+    raise StopIteration(count)
+
+
+class _LoopLatency(object):
+    """Internal use only.
+
+    Measures latency of asyncoro's event loop: a coroutine sleeps for
+    'interval' seconds and the time it is woken up late is
+    latency. Latency is high if the loop is blocked (e.g., by disk I/O
+    or computations in coroutines). If 'threshold' is given, latencies
+    above it are logged as warnings with 'log' (dispy's logger if not
+    given).
+    """
+
+    def __init__(self, interval=0.5, threshold=None, log=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.log = log if log else logger
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+        self.samples = 0
+        self._coro = Coro(self._monitor)
+
+    def _monitor(self, coro=None):
+        # generator
+        coro.set_daemon()
+        while True:
+            start = time.time()
+            yield coro.sleep(self.interval)
+            self.last = max(time.time() - start - self.interval, 0.0)
+            self.total += self.last
+            self.samples += 1
+            if self.last > self.max:
+                self.max = self.last
+            if self.threshold and self.last > self.threshold:
+                self.log.warning('Event loop was blocked for %.3f sec', self.last)
+
+    @property
+    def avg(self):
+        if self.samples:
+            return self.total / self.samples
+        else:
+            return 0.0
+
+    def __str__(self):
+        return '%.1f ms avg, %.1f ms max, %.1f ms last' % \
+            (1000 * self.avg, 1000 * self.max, 1000 * self.last)
+
+
+class _RecoveryJournal(object):
+    """Internal use only.
+
+    Client's fault recovery information (see 'recover_file') is kept
+    in this append-only journal. Updates are appended as records and
+    committed (written and synced to disk) in groups, so updates by
+    many coroutines (e.g., when many nodes are set up) cost one
+    write. Entries are also kept in memory; when most records in the
+    journal are obsolete, it is compacted (rewritten with only current
+    entries). Value of an entry is either an object (see 'set') or a
+    set of items (see 'add'). If journal file exists, its entries are
+    loaded and it is extended; a file that is not a journal is not
+    overwritten.
+    """
+
+    Magic = b'dispy-journal-1\n'
+    # journal is compacted when it has these many records and at
+    # least half of them are obsolete
+    CompactRecords = 4096
+
+    def __init__(self, path, io_pool):
+        self.path = path
+        self._io_pool = io_pool
+        self._entries = {}
+        # records appended but not committed yet
+        self._records = []
+        # records in journal file
+        self._count = 0
+        self._compact_count = self.CompactRecords
+        # number of records appended and committed
+        self._appended = 0
+        self._committed = 0
+        self._committing = None
+        loaded = None
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            loaded = _RecoveryJournal._load(path)
+            if loaded is None:
+                raise Exception('"%s" is not a dispy recover file' % path)
+        if loaded:
+            self._entries, self._count, size = loaded
+            self._compact_count = max(self.CompactRecords, 2 * len(self._entries))
+            self._fd = open(path, 'r+b')
+            # incomplete last record (if client crashed while writing
+            # it) is overwritten
+            self._fd.truncate(size)
+            self._fd.seek(size)
+        else:
+            self._fd = open(path, 'wb')
+            self._fd.write(self.Magic)
+            self._fd.flush()
+
+    def get(self, key, default=None):
+        return self._entries.get(key, default)
+
+    def set(self, key, value):
+        self._entries[key] = value
+        self._append(('set', key, value))
+
+    def add(self, key, item):
+        items = self._entries.setdefault(key, set())
+        if item not in items:
+            items.add(item)
+            self._append(('add', key, item))
+
+    def discard(self, key, item):
+        items = self._entries.get(key, None)
+        if items and item in items:
+            items.discard(item)
+            self._append(('discard', key, item))
+
+    def delete(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._append(('del', key, None))
+
+    def _append(self, record):
+        data = serialize(record)
+        self._records.append(struct.pack('>L', len(data)) + data)
+        self._appended += 1
+
+    def _write(self, records, entries=None):
+        # called in I/O thread
+        if entries is None:
+            self._fd.write(b''.join(records))
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+        else:
+            # compact: current entries replace journal
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fd:
+                fd.write(self.Magic)
+                fd.write(b''.join(entries))
+                fd.flush()
+                os.fsync(fd.fileno())
+            self._fd.close()
+            os.rename(tmp, self.path)
+            self._fd = open(self.path, 'ab')
+
+    def commit(self, coro=None):
+        """Write records appended so far to disk. Must be used with
+        'yield'. Records appended while a commit is in progress are
+        written together in next commit.
+        """
+        # generator
+        appended = self._appended
+        while self._committed < appended:
+            if self._committing:
+                yield self._committing.wait()
+                continue
+            self._committing = committing = asyncoro.Event()
+            records, self._records = self._records, []
+            last = self._appended
+            if (self._count + len(records)) >= self._compact_count:
+                entries = []
+                for key, value in self._entries.items():
+                    if isinstance(value, set):
+                        value = set(value)
+                    data = serialize(('set', key, value))
+                    entries.append(struct.pack('>L', len(data)) + data)
+            else:
+                entries = None
+            try:
+                yield self._io_pool.async_task(self._write, records, entries)
+            except:
+                logger.warning('Could not save fault recovery information in "%s": %s',
+                               self.path, traceback.format_exc())
+            if entries is None:
+                self._count += len(records)
+            else:
+                self._count = len(entries)
+                self._compact_count = max(self.CompactRecords, 2 * self._count)
+            self._committed = last
+            self._committing = None
+            committing.set()
+
+    def flush(self):
+        """Write records appended so far to disk in calling thread;
+        used when coroutines are not using journal (e.g., when
+        client is initialized or closed).
+        """
+        if self._records:
+            self._write(self._records)
+            self._count += len(self._records)
+            self._records = []
+        self._committed = self._appended
+
+    def close(self, remove=False):
+        """Write any pending records and close journal (and remove it
+        if 'remove' is True).
+        """
+        if self._fd is None:
+            return
+        self.flush()
+        self._fd.close()
+        self._fd = None
+        if remove:
+            for path in (self.path, self.path + '.tmp'):
+                if os.path.isfile(path):
+                    try:
+                        os.remove(path)
+                    except:
+                        pass
+
+    @staticmethod
+    def read(path):
+        """Returns entries in journal 'path' as dictionary, or None if
+        'path' is not a journal.
+        """
+        loaded = _RecoveryJournal._load(path)
+        if loaded is None:
+            return None
+        return loaded[0]
+
+    @staticmethod
+    def _load(path):
+        # returns tuple (entries, number of records, size of journal
+        # up to last complete record), or None if 'path' is not a
+        # journal
+        entries = {}
+        count = 0
+        with open(path, 'rb') as fd:
+            if fd.read(len(_RecoveryJournal.Magic)) != _RecoveryJournal.Magic:
+                return None
+            size = fd.tell()
+            while True:
+                # last record may be incomplete if client crashed
+                # while writing it
+                data = fd.read(4)
+                if len(data) < 4:
+                    break
+                n = struct.unpack('>L', data)[0]
+                data = fd.read(n)
+                if len(data) < n:
+                    break
+                try:
+                    op, key, value = unserialize(data)
+                except:
+                    break
+                if op == 'set':
+                    entries[key] = value
+                elif op == 'add':
+                    entries.setdefault(key, set()).add(value)
+                elif op == 'discard':
+                    entries.get(key, set()).discard(value)
+                elif op == 'del':
+                    entries.pop(key, None)
+                count += 1
+                size = fd.tell()
+        return (entries, count, size)
 
 
 class _Cluster(object, metaclass=MetaSingleton):
@@ -541,6 +1587,8 @@ class _Cluster(object, metaclass=MetaSingleton):
                  shared=False, secret='', keyfile=None, certfile=None, recover_file=None):
         if not hasattr(self, 'asyncoro'):
             self.asyncoro = AsynCoro()
+            self.io_pool = asyncoro.AsyncThreadPool(IOThreads)
+            self.loop_latency = _LoopLatency()
             self.ip_addrs = set()
             if ip_addr:
                 if not isinstance(ip_addr, list):
@@ -603,15 +1651,15 @@ class _Cluster(object, metaclass=MetaSingleton):
                                     (now.year, now.month, now.day,
                                      now.hour, now.minute, now.second)
             try:
-                self.shelf = shelve.open(self.recover_file, flag='c', writeback=True)
-                self.shelf['_cluster'] = {'ip_addrs': self.ip_addrs, 'port': self.port,
-                                          'sign': self.sign, 'secret': self.secret,
-                                          'auth': self.auth,
-                                          'keyfile': self.keyfile, 'certfile': self.certfile}
-                self.shelf.sync()
+                self.journal = _RecoveryJournal(self.recover_file, self.io_pool)
+                self.journal.set('_cluster', {'ip_addrs': self.ip_addrs, 'port': self.port,
+                                              'sign': self.sign, 'secret': self.secret,
+                                              'auth': self.auth, 'dest_path': self.dest_path,
+                                              'keyfile': self.keyfile, 'certfile': self.certfile})
+                self.journal.flush()
             except:
-                raise Exception('Could not create fault recover file "%s"' %
-                                self.recover_file)
+                raise Exception('Could not create fault recover file "%s": %s' %
+                                (self.recover_file, sys.exc_info()[1]))
             logger.info('Storing fault recovery information in "%s"', self.recover_file)
             atexit.register(self.shutdown)
             self.timer_coro = Coro(self.timer_task)
@@ -657,6 +1705,12 @@ class _Cluster(object, metaclass=MetaSingleton):
                     node = self._nodes[info['ip_addr']]
                     assert 0 <= info['cpus'] <= node.cpus
                     node.last_pulse = time.time()
+                    for cid in node.clusters:
+                        dispy_node = self._clusters[cid]._dispy_nodes.get(node.ip_addr, None)
+                        if dispy_node is not None:
+                            dispy_node.disk_usage = info.get('disk_usage', None)
+                            dispy_node.code_cache_hits = info.get('code_cache_hits', None)
+                            dispy_node.code_cache_misses = info.get('code_cache_misses', None)
                     pulse_msg = {'ip_addr': info['scheduler_ip_addr'], 'port': self.port}
                 except:
                     logger.warning('Ignoring pulse message from %s', addr[0])
@@ -754,6 +1808,24 @@ class _Cluster(object, metaclass=MetaSingleton):
                 logger.warning('invalid job reply from %s:%s ignored' % (addr[0], addr[1]))
             else:
                 yield self.job_reply_process(info, conn, addr)
+        elif msg.startswith(b'JOB_REPLIES:'):
+            # saved results resent in bulk
+            yield self.job_replies_process(conn, addr)
+        elif msg.startswith(b'JOB_OUTPUT:'):
+            try:
+                info = unserialize(msg[len(b'JOB_OUTPUT:'):])
+                _job = self._sched_jobs[info['uid']]
+                assert _job.hash == info['hash']
+            except:
+                logger.debug('Ignoring output of job from %s', addr[0])
+                resp = b'NAK'
+            else:
+                _add_job_output(_job.job, info.get('stdout', None), info.get('stderr', None))
+                resp = b'ACK'
+            try:
+                yield conn.send_msg(resp)
+            except:
+                pass
         elif msg.startswith(b'JOB_STATUS:'):
             # message from dispyscheduler
             try:
@@ -974,17 +2046,25 @@ class _Cluster(object, metaclass=MetaSingleton):
         if xf.name.startswith(os.sep):
             xf.name = xf.name[len(os.sep):]
         tgt = os.path.join(self.dest_path, xf.name)
-        if not os.path.isdir(os.path.dirname(tgt)):
-            os.makedirs(os.path.dirname(tgt))
-        fd = open(tgt, 'wb')
+
+        def open_tgt():
+            if not os.path.isdir(os.path.dirname(tgt)):
+                os.makedirs(os.path.dirname(tgt))
+            return open(tgt, 'wb')
+
+        # file is written in I/O threads so other coroutines are not
+        # blocked by disk I/O
+        fd = yield self.io_pool.async_task(open_tgt)
         n = 0
-        while n < xf.stat_buf.st_size:
-            data = yield sock.recvall(min(xf.stat_buf.st_size-n, 1024000))
-            if not data:
-                break
-            fd.write(data)
-            n += len(data)
-        fd.close()
+        try:
+            while n < xf.stat_buf.st_size:
+                data = yield sock.recvall(min(xf.stat_buf.st_size - n, XferChunkSize))
+                if not data:
+                    break
+                yield self.io_pool.async_task(fd.write, data)
+                n += len(data)
+        finally:
+            yield self.io_pool.async_task(fd.close)
         if n != xf.stat_buf.st_size:
             yield sock.send_msg(b'NAK (read only %s bytes)' % n)
         else:
@@ -1059,48 +2139,48 @@ class _Cluster(object, metaclass=MetaSingleton):
 
     def poll_job_results(self, cluster, coro=None):
         # generator
+        # nodes are polled concurrently
+        poll_coros = []
         for ip_addr in cluster._dispy_nodes:
             node = self._nodes.get(ip_addr, None)
             if not node or not node.port:
                 continue
-            sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
-                               keyfile=self.keyfile, certfile=self.certfile)
-            sock.settimeout(MsgTimeout)
-            try:
-                req = {'compute_id': cluster._compute.id, 'auth': cluster._compute.auth}
-                reply = yield node.send(b'PENDING_JOBS:' + serialize(req))
-                reply = unserialize(reply)
-            except:
-                logger.debug(traceback.format_exc())
-                continue
-            finally:
-                sock.close()
+            poll_coros.append(Coro(self.poll_node_results, cluster, node))
+        for poll_coro in poll_coros:
+            yield poll_coro.finish()
 
-            for uid in reply['done']:
-                _job = self._sched_jobs.get(uid, None)
-                if _job is None:
-                    continue
-                conn = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
-                                   keyfile=self.keyfile, certfile=self.certfile)
-                conn.settimeout(MsgTimeout)
-                try:
-                    yield conn.connect((node.ip_addr, node.port))
-                    req = {'compute_id': cluster._compute.id, 'auth': cluster._compute.auth,
-                           'uid': uid, 'hash': _job.hash}
-                    yield conn.sendall(node.auth)
-                    yield conn.send_msg(b'RETRIEVE_JOB:' + serialize(req))
-                    reply = yield conn.recv_msg()
-                    reply = unserialize(reply)
-                except:
-                    logger.debug(traceback.format_exc())
-                    continue
-                else:
-                    if isinstance(reply, _JobReply):
-                        yield self.job_reply_process(reply, conn, (node.ip_addr, node.port))
-                    else:
-                        logger.debug('invalid reply for %s' % uid)
-                finally:
-                    conn.close()
+    def poll_node_results(self, cluster, node, coro=None):
+        # generator
+        try:
+            req = {'compute_id': cluster._compute.id, 'auth': cluster._compute.auth}
+            reply = yield node.send(b'PENDING_JOBS:' + serialize(req))
+            reply = unserialize(reply)
+        except:
+            logger.debug(traceback.format_exc())
+            raise StopIteration
+
+        jobs = {}
+        for uid in reply['done']:
+            _job = self._sched_jobs.get(uid, None)
+            if _job is not None:
+                jobs[uid] = _job.hash
+        if not jobs:
+            raise StopIteration
+        # results of all jobs are retrieved with one request
+        conn = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                           keyfile=self.keyfile, certfile=self.certfile)
+        conn.settimeout(MsgTimeout)
+        try:
+            yield conn.connect((node.ip_addr, node.port))
+            req = {'compute_id': cluster._compute.id, 'auth': cluster._compute.auth,
+                   'jobs': jobs}
+            yield conn.sendall(node.auth)
+            yield conn.send_msg(b'RETRIEVE_JOBS:' + serialize(req))
+            yield self.job_replies_process(conn, (node.ip_addr, node.port))
+        except:
+            logger.debug(traceback.format_exc())
+        finally:
+            conn.close()
 
     def add_cluster(self, cluster, coro=None):
         # generator
@@ -1116,15 +2196,15 @@ class _Cluster(object, metaclass=MetaSingleton):
             self._nodes[cluster.scheduler_ip_addr] = node
             dispy_node = DispyNode(cluster.scheduler_ip_addr, None, 0)
             cluster._dispy_nodes[dispy_node.ip_addr] = dispy_node
-            info = self.shelf['_cluster']
+            info = dict(self.journal.get('_cluster'))
             info['port'] = self.port
-            self.shelf['_cluster'] = info
-            info = {'name': compute.name, 'auth': compute.auth,
-                    'nodes': [cluster.scheduler_ip_addr]}
-            self.shelf['compute_%s' % compute.id] = info
-            info = {'port': cluster.scheduler_port, 'auth': cluster._scheduler_auth}
-            self.shelf['node_%s' % (cluster.scheduler_ip_addr)] = info
-            self.shelf.sync()
+            self.journal.set('_cluster', info)
+            self.journal.set('compute_%s' % compute.id, {'name': compute.name,
+                                                         'auth': compute.auth})
+            self.journal.add('nodes_%s' % compute.id, cluster.scheduler_ip_addr)
+            self.journal.set('node_%s' % (cluster.scheduler_ip_addr),
+                             {'port': cluster.scheduler_port, 'auth': cluster._scheduler_auth})
+            yield self.journal.commit(coro=coro)
             if cluster.poll_interval:
                 self.poll_interval = num_min(self.poll_interval, cluster.poll_interval)
             if self.poll_interval:
@@ -1136,12 +2216,14 @@ class _Cluster(object, metaclass=MetaSingleton):
         if compute.id is None:
             compute.id = self.compute_id
             self.compute_id += 1
+            # save computation before other coroutines (e.g., 'add_node')
+            # can find it
+            self.journal.set('compute_%s' % compute.id, {'name': compute.name,
+                                                         'auth': compute.auth})
+            yield self.journal.commit(coro=coro)
             self._clusters[compute.id] = cluster
             for xf in compute.xfer_files:
                 xf.compute_id = compute.id
-            info = {'name': compute.name, 'auth': compute.auth, 'nodes': []}
-            self.shelf['compute_%s' % compute.id] = info
-            self.shelf.sync()
 
             if compute.pulse_interval:
                 self.pulse_interval = num_min(self.pulse_interval, compute.pulse_interval)
@@ -1204,9 +2286,10 @@ class _Cluster(object, metaclass=MetaSingleton):
                 if cluster.status_callback:
                     self.worker_Q.put((cluster.status_callback,
                                        (DispyNode.Closed, dispy_node, None)))
-        self.shelf.pop('compute_%s' % (cluster._compute.id), None)
-        # TODO: prune nodes in shelf
-        self.shelf.sync()
+        self.journal.delete('compute_%s' % (cluster._compute.id))
+        self.journal.delete('nodes_%s' % (cluster._compute.id))
+        # TODO: prune nodes in journal
+        yield self.journal.commit(coro=coro)
 
     def setup_node(self, node, computations, coro=None):
         # generator
@@ -1219,21 +2302,23 @@ class _Cluster(object, metaclass=MetaSingleton):
                 continue
             dispy_node = DispyNode(node.ip_addr, node.name, node.cpus)
             dispy_node.avail_cpus = node.avail_cpus
+            dispy_node.topology = node.topology
             dispy_node.update_time = time.time()
             cluster._dispy_nodes[node.ip_addr] = dispy_node
-            self.shelf['node_%s' % (node.ip_addr)] = {'port': node.port, 'auth': node.auth}
-            shelf_compute = self.shelf['compute_%s' % compute.id]
-            shelf_compute['nodes'].append(node.ip_addr)
-            self.shelf['compute_%s' % compute.id] = shelf_compute
-            self.shelf.sync()
+            info = {'port': node.port, 'auth': node.auth}
+            if self.journal.get('node_%s' % (node.ip_addr)) != info:
+                self.journal.set('node_%s' % (node.ip_addr), info)
+            self.journal.add('nodes_%s' % compute.id, node.ip_addr)
+            yield self.journal.commit(coro=coro)
             r = yield node.setup(compute, coro=coro)
+            if r == 0:
+                r = yield self.send_broadcasts(cluster, node, coro=coro)
             if r != 0:
                 cluster._dispy_nodes.pop(node.ip_addr, None)
                 logger.warning('Failed to setup %s for compute "%s": %s',
                                node.ip_addr, compute.name, r)
-                # TODO: delete node from shelf's cluster._dispy_nodes
-                del self.shelf['node_%s' % (node.ip_addr)]
-                self.shelf.sync()
+                self.journal.discard('nodes_%s' % compute.id, node.ip_addr)
+                yield self.journal.commit(coro=coro)
                 yield node.close(compute, coro=coro)
             else:
                 node.clusters.add(compute.id)
@@ -1289,6 +2374,8 @@ class _Cluster(object, metaclass=MetaSingleton):
         node_computations = []
         node.name = info['name']
         node.scheduler_ip_addr = info['scheduler_ip_addr']
+        node.topology = info.get('topology', None)
+        node.overcommit = info.get('overcommit', 0)
         for cid, cluster in self._clusters.items():
             if cid in node.clusters:
                 continue
@@ -1321,18 +2408,99 @@ class _Cluster(object, metaclass=MetaSingleton):
     def finish_job(self, cluster, _job, status):
         # assert status in (DispyJob.Finished, DispyJob.Terminated, DispyJob.Abandoned)
         job = _job.job
+        children = _job.children
         _job.finish(status)
+        if status == DispyJob.Finished and _job.cache_key:
+            self.worker_Q.put((cluster._result_cache._put,
+                               (_job.cache_key, job, cluster._result_cache_digest)))
         if cluster.callback:
             self.worker_Q.put((cluster.callback, (job,)))
         if status != DispyJob.ProvisionalResult:
+            cluster._notify_pending()
             assert cluster._pending_jobs > 0
             cluster._pending_jobs -= 1
             if cluster._pending_jobs == 0:
                 cluster.end_time = time.time()
                 cluster._complete.set()
+            if children:
+                _job.children = None
+                for child in children:
+                    self.release_job(child)
+
+    def release_job(self, _job):
+        # function
+        # called when a parent of (blocked) _job is done; once all
+        # parents are done, _job is queued for scheduling (or
+        # cancelled if any parent didn't finish successfully)
+        parents = _job.after
+        if parents is None or any(parent.status < DispyJob.Cancelled for parent in parents):
+            return
+        cluster = self._clusters.get(_job.compute_id, None)
+        if cluster is None or cluster._blocked_jobs.pop(_job.uid, None) is None:
+            return
+        _job.after = None
+        if any(parent.status != DispyJob.Finished for parent in parents):
+            logger.debug('Cancelling job %s as its parent(s) failed', _job.uid)
+            if cluster.status_callback:
+                self.worker_Q.put((cluster.status_callback, (DispyJob.Cancelled, None, _job.job)))
+            self.finish_job(cluster, _job, DispyJob.Cancelled)
+            return
+        if _job.after_args:
+            if cluster._compute.type == _Compute.prog_type:
+                _job.after_args = serialize([str(parent.result) for parent in parents])
+            else:
+                _job.after_args = serialize([parent.result for parent in parents])
+        else:
+            _job.after_args = None
+        cluster._jobs.append(_job)
+        self.unsched_jobs += 1
+        self._sched_event.set()
+
+    def job_replies_process(self, conn, addr):
+        # generator
+        # replies of many jobs sent in one stream (saved results
+        # resent by nodes or scheduler, or retrieved with
+        # RETRIEVE_JOBS); each reply is acknowledged as it is
+        # processed, until 'END'
+        while True:
+            try:
+                msg = yield conn.recv_msg()
+            except:
+                break
+            if not msg.startswith(b'JOB_REPLY:'):
+                break
+            try:
+                info = unserialize(msg[len(b'JOB_REPLY:'):])
+            except:
+                logger.warning('invalid job reply from %s:%s ignored' % (addr[0], addr[1]))
+                yield conn.send_msg(b'NAK')
+            else:
+                yield self.job_reply_process(info, conn, addr)
 
     def job_reply_process(self, reply, sock, addr):
         _job = self._sched_jobs.get(reply.uid, None)
+        if isinstance(reply.result, _MappedResult):
+            # data of result follows reply; it is saved in file (unless
+            # reply is invalid) and result is memory mapped from there
+            if _job is None or reply.hash != _job.hash:
+                dest_path = None
+            else:
+                dest_path = self.dest_path
+            try:
+                reply.result = yield _recv_mapped_result(reply.result, sock, dest_path,
+                                                         self.io_pool)
+            except IOError:
+                # rest of stream can't be read
+                logger.warning('Could not receive result of job %s from %s: %s',
+                               reply.uid, addr[0], traceback.format_exc())
+                sock.close()
+                raise StopIteration
+            except:
+                # result couldn't be saved; sender keeps it
+                logger.warning('Could not receive result of job %s from %s: %s',
+                               reply.uid, addr[0], traceback.format_exc())
+                yield sock.send_msg(b'NAK')
+                raise StopIteration
         if _job is None or reply.hash != _job.hash:
             logger.warning('Ignoring invalid reply for job %s from %s', reply.uid, addr[0])
             yield sock.send_msg(b'NAK')
@@ -1368,8 +2536,14 @@ class _Cluster(object, metaclass=MetaSingleton):
 
         node.last_pulse = time.time()
         job.result = reply.result
-        job.stdout = reply.stdout
-        job.stderr = reply.stderr
+        if cluster._compute.capture_output == 'stream':
+            # rest of output that was not sent while job was running
+            _add_job_output(job, reply.stdout, reply.stderr)
+        else:
+            job.stdout = reply.stdout
+            job.stderr = reply.stderr
+            if cluster._compute.capture_output == 'file':
+                job._dispy_output_ = reply.uid
         job.exception = reply.exception
         job.start_time = reply.start_time
         job.end_time = reply.end_time
@@ -1461,6 +2635,10 @@ class _Cluster(object, metaclass=MetaSingleton):
                          _job.job.id, _job.uid, node.ip_addr, node.busy, node.cpus)
             _job.job.status = DispyJob.Running
             _job.job.start_time = time.time()
+            if not cluster._compute.reentrant:
+                # job is not sent again, so its serialized data is not needed
+                _job.args = _job.kwargs = _job.after_args = None
+                _job.code = ''
             dispy_node.busy += 1
             dispy_node.update_time = time.time()
             if cluster.status_callback:
@@ -1469,15 +2647,21 @@ class _Cluster(object, metaclass=MetaSingleton):
 
     def load_balance_schedule(self):
         host = None
-        load = 1.0
+        load = None
         for node in self._nodes.values():
-            if node.busy >= node.cpus:
-                continue
             if all((not self._clusters[cid]._jobs) for cid in node.clusters):
                 continue
+            # nodes used only by clusters that execute jobs in threads
+            # may run more jobs than cpus
+            cpus = node.cpus * min(self._clusters[cid]._compute.jobs_per_cpu
+                                   for cid in node.clusters)
+            # nodes with 'overcommit' queue that many jobs more, to start
+            # them as soon as cpus are available
+            if not cpus or node.busy >= (cpus + node.overcommit):
+                continue
             # logger.debug('load: %s, %s, %s' % (node.ip_addr, node.busy, node.cpus))
-            if (float(node.busy) / node.cpus) < load:
-                load = float(node.busy) / node.cpus
+            if load is None or (float(node.busy) / cpus) < load:
+                load = float(node.busy) / cpus
                 host = node
         return host
 
@@ -1503,6 +2687,7 @@ class _Cluster(object, metaclass=MetaSingleton):
                 yield self._sched_event.wait()
                 continue
             cluster = self._clusters[_job.compute_id]
+            cluster._notify_pending()
             _job.node = node
             # assert node.busy < node.cpus
             self._sched_jobs[_job.uid] = _job
@@ -1518,6 +2703,15 @@ class _Cluster(object, metaclass=MetaSingleton):
             if not hasattr(cluster, '_compute'):
                 # cluster is closed
                 continue
+            blocked_jobs, cluster._blocked_jobs = list(cluster._blocked_jobs.values()), {}
+            for _job in blocked_jobs:
+                _job.after = None
+                if _job.job is None:
+                    continue
+                self.finish_job(cluster, _job, DispyJob.Cancelled)
+                if cluster.status_callback:
+                    self.worker_Q.put((cluster.status_callback,
+                                       (DispyJob.Cancelled, None, _job.job)))
             for _job in cluster._jobs:
                 if _job.job.status == DispyJob.Running:
                     status = DispyJob.Terminated
@@ -1532,6 +2726,7 @@ class _Cluster(object, metaclass=MetaSingleton):
                                            (status, dispy_node, _job.job)))
             cluster._jobs = []
             cluster._pending_jobs = []
+            cluster._notify_pending()
             yield self.del_cluster(cluster, coro=coro)
         self._clusters = {}
         self._nodes = {}
@@ -1541,13 +2736,37 @@ class _Cluster(object, metaclass=MetaSingleton):
         # generator
         _job.uid = id(_job)
         cluster = self._clusters[_job.compute_id]
-        cluster._jobs.append(_job)
-        self.unsched_jobs += 1
+        if _job.after:
+            for parent in _job.after:
+                if parent.status >= DispyJob.Cancelled:
+                    if parent.status != DispyJob.Finished:
+                        logger.warning('Parent job %s of new job is not finished successfully',
+                                       parent.id)
+                        raise StopIteration(-1)
+                elif parent._dispy_job_ is None:
+                    logger.warning('Parent job %s of new job is not submitted', parent.id)
+                    raise StopIteration(-1)
+            for parent in _job.after:
+                _parent = parent._dispy_job_
+                if _parent is None:
+                    continue
+                if _parent.children is None:
+                    _parent.children = [_job]
+                else:
+                    _parent.children.append(_job)
+            cluster._blocked_jobs[_job.uid] = _job
+        else:
+            cluster._jobs.append(_job)
+            self.unsched_jobs += 1
         cluster._pending_jobs += 1
         cluster._complete.clear()
         if cluster.status_callback:
             self.worker_Q.put((cluster.status_callback, (DispyJob.Created, None, _job.job)))
+        if _job.after:
+            # all parents may have finished already
+            self.release_job(_job)
         yield self._sched_event.set()
+        raise StopIteration(0)
 
     def cancel_job(self, job, coro=None):
         # generator
@@ -1563,8 +2782,17 @@ class _Cluster(object, metaclass=MetaSingleton):
             raise StopIteration(-1)
         assert cluster._pending_jobs >= 1
         if _job.job.status == DispyJob.Created:
-            cluster._jobs.remove(_job)
-            self.unsched_jobs -= 1
+            if cluster._blocked_jobs.pop(_job.uid, None) is None:
+                cluster._jobs.remove(_job)
+                self.unsched_jobs -= 1
+            else:
+                for parent in _job.after:
+                    if parent._dispy_job_ is not None and parent._dispy_job_.children:
+                        try:
+                            parent._dispy_job_.children.remove(_job)
+                        except ValueError:
+                            pass
+                _job.after = None
             if cluster.status_callback:
                 self.worker_Q.put((cluster.status_callback, (DispyJob.Cancelled, None, _job.job)))
             self.finish_job(cluster, _job, DispyJob.Cancelled)
@@ -1602,6 +2830,34 @@ class _Cluster(object, metaclass=MetaSingleton):
         yield self._sched_event.set()
         raise StopIteration(0)
 
+    def send_broadcasts(self, cluster, node, coro=None):
+        # generator
+        # data may be broadcast while sending earlier data
+        sent = set()
+        while True:
+            bcs = [bc for bc in cluster._broadcasts.values() if bc not in sent]
+            if not bcs:
+                break
+            for bc in bcs:
+                r = yield node.broadcast(cluster._compute, bc, coro=coro)
+                if r != 0:
+                    raise StopIteration(r)
+                sent.add(bc)
+        raise StopIteration(0)
+
+    def broadcast(self, cluster, bc, coro=None):
+        # generator
+        cluster._broadcasts[bc.name] = bc
+        # nodes being setup get data in 'send_broadcasts'
+        coros = [Coro(node.broadcast, cluster._compute, bc) for node in self._nodes.values()
+                 if cluster._compute.id in node.clusters]
+        n = 0
+        for coro_ in coros:
+            r = yield coro_.finish()
+            if r == 0:
+                n += 1
+        raise StopIteration(n)
+
     def set_node_cpus(self, node, cpus, coro=None):
         # generator
         try:
@@ -1679,16 +2935,10 @@ class _Cluster(object, metaclass=MetaSingleton):
             self.asyncoro.finish()
             self.asyncoro = None
             logger.debug('shutdown complete')
-        if self.shelf:
+        if self.journal:
             # TODO: need to check all clusters are deleted?
-            self.shelf.close()
-            self.shelf = None
-            for ext in ('', '.db', '.bak', '.dat', '.dir'):
-                if os.path.isfile(self.recover_file + ext):
-                    try:
-                        os.remove(self.recover_file + ext)
-                    except:
-                        pass
+            self.journal.close(remove=True)
+            self.journal = None
 
 
 class JobCluster(object):
@@ -1699,7 +2949,11 @@ class JobCluster(object):
                  ip_addr=None, port=None, node_port=None, ext_ip_addr=None,
                  dest_path=None, loglevel=logging.INFO, setup=None, cleanup=True,
                  ping_interval=None, pulse_interval=None, poll_interval=None,
-                 reentrant=False, secret='', keyfile=None, certfile=None, recover_file=None):
+                 reentrant=False, secret='', keyfile=None, certfile=None, recover_file=None,
+                 result_cache=None, discard_output=False, max_pending=None,
+                 worker_setup=None, worker_cleanup=None, exec_mode='process', jobs_per_cpu=1,
+                 capture_output='memory', max_output=65536, program_worker=False,
+                 weight=1, mmap_result_size=0, reuse_workers=False):
         """Create an instance of cluster for a specific computation.
 
         @computation is either a string (which is name of program, possibly
@@ -1813,10 +3067,136 @@ class JobCluster(object):
         this is None, dispy stores information about cluster in a file
         of the form '_dispy_YYYYMMDDHHMMSS' in current directory. If
         it is a path, dispy will use given path to store
-        information. If user program terminates for some reason (such
+        information; if that file is recover file of an earlier
+        cluster, it is extended (any other existing file is not
+        overwritten and cluster is not created). If user program terminates for some reason (such
         as raising an exception), it is possible to retrieve results
         of scheduled jobs later (after they are finished) by calling
         'recover' function (implemented in this file) with this file.
+
+        @result_cache must be either None (default), True or an
+        instance of ResultCache. If it is not None, results of jobs
+        that finish successfully are cached and jobs submitted later
+        with same arguments are finished immediately with those
+        results (without executing them). If it is True, an instance
+        of ResultCache with default parameters is used. Jobs submitted
+        with 'dispy_after' are not cached.
+
+        @discard_output must be either True or False (default). If it
+        is True, it is same as capture_output='discard'.
+
+        @max_pending must be either None (default) or a positive
+        number. If it is a number, at most that many jobs are kept
+        queued (i.e., submitted but not yet sent to nodes); when the
+        limit is reached, 'submit' waits until jobs are scheduled
+        (or raises an exception if 'dispy_block=False' is passed to
+        'submit'), so jobs can be submitted at the rate the cluster
+        executes them. With SharedJobCluster, the limit is enforced by
+        dispyscheduler, which may also impose its own limit.
+
+        @worker_setup is a Python (partial) function. Nodes execute
+        jobs in worker processes (see 'reuse_workers' below); this
+        function is called once in each worker process before it
+        executes jobs, so state that is expensive to create (e.g.,
+        loading a model, opening database connections) can be kept
+        in global variables and used by all jobs executed by that
+        worker. Unlike 'setup', which is called once on a node
+        before workers are created, state created here need not
+        survive fork. It must return 0 to indicate successful
+        initialization; otherwise, jobs sent to that worker are
+        terminated.
+
+        @worker_cleanup is a Python (partial) function that is
+        called in each worker process when it is done executing jobs
+        (i.e., after its job, when computation is closed or when
+        worker is replaced after 'max_worker_jobs' jobs with
+        dispynode), e.g., to release resources created by
+        'worker_setup'. It is not called if a worker is terminated
+        (e.g., when a job is cancelled).
+
+        @exec_mode must be either 'process' (default) or 'thread'. If
+        it is 'thread', nodes execute jobs in threads of one worker
+        process (for each computation) instead of a process for each
+        job. This is suitable for computations that are I/O bound or
+        spend most of their time in extension modules that release the
+        GIL (such as NumPy). The computation and 'worker_setup' are
+        loaded once in that process on each node and all jobs on that
+        node share them, so computation must be thread safe. Results
+        are passed from that process to dispynode as with
+        exec_mode='process' (large results through files). If the
+        process dies (e.g., a job calls 'os._exit'), jobs running in it
+        are terminated and another process is started for later jobs.
+        Jobs that are running can't be terminated (e.g., 'cancel' waits
+        for them to finish).
+
+        @jobs_per_cpu is number of jobs to run on each cpu of nodes. It
+        can be more than 1 (default) only with exec_mode='thread', e.g.,
+        for I/O bound computations. Nodes are oversubscribed only when
+        all clusters using them allow it.
+
+        @capture_output is how nodes capture standard output and error
+        of jobs. With 'memory' (default), all output is kept in memory
+        and sent with results, so jobs that print a lot use as much
+        memory on nodes. With 'discard', output is not saved ('stdout'
+        and 'stderr' of jobs are None). With 'tail', only the last
+        @max_output characters of each are kept. With 'file', all
+        output is saved in files on node (until computation is closed)
+        and last @max_output characters are sent with results; full
+        output can be retrieved with 'fetch_output'. With 'stream',
+        output is sent to client in chunks of @max_output characters
+        while job is running and appended to 'stdout' and 'stderr' of
+        job. Output is sent by nodes in the background, so jobs don't
+        wait for client; if client can't be reached, only the last
+        @max_output characters are kept, and if it can't receive
+        output as fast as job writes it, older part of output that is
+        not sent yet is discarded.
+
+        @max_output is number of characters (bytes for programs) of
+        output kept in memory for each of standard output and error
+        of a job, except with capture_output='memory'. Default is 65536.
+
+        @program_worker must be either True or False (default). It is
+        used only if computation is a Python program (name ends with
+        '.py'). Nodes normally start a new Python interpreter for each
+        job of such programs. If @program_worker is True, programs are
+        instead run with 'runpy' in worker processes that are reused
+        for jobs (as with @reuse_workers=True), so interpreter startup
+        and imports of modules used by program are done once in each
+        worker. Each job runs program in a new
+        '__main__' module with 'sys.argv' set to job's arguments;
+        its 'result' is exit status of program (e.g., argument to
+        'sys.exit'), or 1 if program raises exception. Programs should
+        write output with 'print' or 'sys.stdout.write' (output of
+        child processes and 'sys.stdout.buffer' are not captured) and
+        shouldn't leave behind state in modules that affects later jobs.
+
+        @weight is a positive number used by nodes that queue jobs
+        (see 'overcommit' option of dispynode): when cpus become
+        available, queued jobs of computations are started in
+        proportion to their weights, e.g., a computation with weight 2
+        gets twice as many jobs started as one with weight 1 (while
+        both have jobs queued). Default is 1.
+
+        @mmap_result_size, if positive, is size in bytes of results
+        that are not kept in memory: if result of a job is bytes /
+        bytearray or numpy array (of numbers etc., not objects) of at
+        least this size, worker process writes its data as is to a
+        file and node sends it from there; client saves it in a file
+        in 'dest_path' and job's 'result' is read-only numpy.memmap
+        (for arrays) or memoryview of that file, so data is read from
+        disk as it is used. These files are not removed by
+        dispy. Default is 0 (results are never memory mapped).
+
+        @reuse_workers must be either True or False (default). If it is
+        False, nodes execute each job (of computation with
+        exec_mode='process') in a new worker process, so jobs don't
+        affect each other. If it is True, worker processes are reused
+        for many jobs (at most 'max_worker_jobs' jobs each, if that
+        option of dispynode is given), which avoids the cost of
+        starting processes (and of 'worker_setup') for each job, but
+        global variables, current directory, modules imported and
+        memory used by a job are then seen by later jobs in that
+        worker.
         """
 
         logger.setLevel(loglevel)
@@ -1904,6 +3284,7 @@ class JobCluster(object):
                                        key=lambda node_alloc: node_alloc.ip_rex)
             self._node_allocs.reverse()
         self._dispy_nodes = {}
+        self._broadcasts = {}
 
         if inspect.isfunction(computation):
             func = computation
@@ -1954,6 +3335,21 @@ class JobCluster(object):
         else:
             raise Exception('"cleanup" must be Python (partial) function')
 
+        for name, func in (('worker_setup', worker_setup), ('worker_cleanup', worker_cleanup)):
+            if not func:
+                continue
+            if compute.type != _Compute.func_type:
+                raise Exception('"%s" is not supported for programs' % name)
+            if inspect.isfunction(func):
+                depends.append(func)
+                func = _Function(func.__name__, (), {})
+            elif isinstance(func, functools.partial):
+                depends.append(func.func)
+                func = _Function(func.func.__name__, func.args or (), func.keywords or {})
+            else:
+                raise Exception('"%s" must be Python (partial) function' % name)
+            setattr(compute, name, func)
+
         self._cluster = _Cluster(ip_addr=ip_addr, port=port, node_port=node_port,
                                  ext_ip_addr=ext_ip_addr, shared=shared,
                                  secret=secret, keyfile=keyfile, certfile=certfile,
@@ -2026,15 +3422,82 @@ class JobCluster(object):
         compute.job_result_port = self._cluster.port
         compute.reentrant = reentrant
         compute.pulse_interval = pulse_interval
+        if discard_output:
+            capture_output = 'discard'
+        if capture_output not in ('memory', 'discard', 'tail', 'file', 'stream'):
+            raise Exception('Invalid capture_output; must be one of "memory", "discard", '
+                            '"tail", "file" or "stream"')
+        compute.capture_output = capture_output
+        try:
+            max_output = int(max_output)
+            assert max_output > 0
+        except:
+            raise Exception('Invalid max_output; must be a positive number')
+        compute.max_output = max_output
+        if max_pending is not None:
+            try:
+                max_pending = int(max_pending)
+                assert max_pending > 0
+            except:
+                raise Exception('Invalid max_pending; must be a positive number')
+            compute.max_pending = max_pending
+        if exec_mode not in ('process', 'thread'):
+            raise Exception('Invalid exec_mode; must be either "process" or "thread"')
+        if exec_mode == 'thread' and compute.type != _Compute.func_type:
+            raise Exception('exec_mode "thread" is not supported for programs')
+        compute.exec_mode = exec_mode
+        try:
+            jobs_per_cpu = int(jobs_per_cpu)
+            assert jobs_per_cpu > 0
+            assert jobs_per_cpu == 1 or exec_mode == 'thread'
+        except:
+            raise Exception('Invalid jobs_per_cpu; must be a positive number '
+                            '(more than 1 only with exec_mode "thread")')
+        compute.jobs_per_cpu = jobs_per_cpu
+        if program_worker:
+            if compute.type != _Compute.prog_type or not compute.name.endswith('.py'):
+                raise Exception('program_worker is supported only for Python programs')
+            compute.program_worker = True
+            # program workers are always reused
+            reuse_workers = True
+        if reuse_workers is not True and reuse_workers is not False:
+            raise Exception('Invalid reuse_workers; must be either True or False')
+        compute.reuse_workers = reuse_workers
+        try:
+            weight = float(weight)
+            assert weight > 0
+        except:
+            raise Exception('Invalid weight; must be a positive number')
+        compute.weight = weight
+        try:
+            mmap_result_size = int(mmap_result_size)
+            assert mmap_result_size >= 0
+        except:
+            raise Exception('Invalid mmap_result_size; must be a non-negative number')
+        compute.mmap_result_size = mmap_result_size
 
         self._compute = compute
         self._pending_jobs = 0
         self._jobs = []
+        # jobs waiting for their parent jobs ('dispy_after') to finish
+        self._blocked_jobs = {}
         self._complete = threading.Event()
         self._complete.set()
+        self._pending_cond = threading.Condition()
         self.cpu_time = 0
         self.start_time = time.time()
         self.end_time = None
+        if result_cache is True:
+            result_cache = ResultCache()
+        elif result_cache is not None and not isinstance(result_cache, ResultCache):
+            raise Exception('"result_cache" must be True or an instance of ResultCache')
+        if result_cache:
+            # digest of computation's code identifies its results in
+            # cache, which may be shared with other clusters
+            self._result_cache_digest = result_cache._setup(compute)
+        else:
+            self._result_cache_digest = None
+        self._result_cache = result_cache
         if not shared:
             Coro(self._cluster.add_cluster, self).value()
 
@@ -2043,7 +3506,24 @@ class JobCluster(object):
 
         Arguments should be serializable and should correspond to
         arguments for computation used when cluster is created.
+
+        If keyword argument 'dispy_after' is given as a job (or list
+        of jobs) submitted earlier, the new job is not scheduled until
+        all of those jobs have finished; if any of them doesn't finish
+        successfully, the new job is cancelled. If 'dispy_after_results'
+        is True, results of those jobs are passed to the new job as
+        additional (positional) arguments, in the same order.
+
+        If 'max_pending' is set for the cluster and that many jobs
+        are queued, this method waits until jobs are scheduled, unless
+        keyword argument 'dispy_block' is False, in which case an
+        exception is raised.
         """
+        after = kwargs.pop('dispy_after', None)
+        after_results = kwargs.pop('dispy_after_results', False)
+        block = kwargs.pop('dispy_block', True)
+        if isinstance(after, DispyJob):
+            after = [after]
         if self._compute.type == _Compute.prog_type:
             if kwargs:
                 logger.warning('Programs can not have keyword arguments')
@@ -2055,9 +3535,57 @@ class JobCluster(object):
             logger.warning('Creating job for "%s", "%s" failed with "%s"',
                            str(args), str(kwargs), traceback.format_exc())
             return None
-        Coro(self._cluster.submit_job, _job).value()
+        if after:
+            _job.after = list(after)
+            _job.after_args = bool(after_results)
+        elif self._result_cache:
+            job = self._cached_job(_job)
+            if job:
+                return job
+        if self._compute.max_pending:
+            try:
+                self._wait_pending(block)
+            except:
+                _job.job._dispy_job_ = None
+                raise
+        if Coro(self._cluster.submit_job, _job).value() != 0:
+            _job.job._dispy_job_ = None
+            return None
         return _job.job
 
+    def _wait_pending(self, block):
+        # wait until number of queued jobs is below 'max_pending'
+        with self._pending_cond:
+            while (len(self._jobs) + len(self._blocked_jobs)) >= self._compute.max_pending:
+                if not block:
+                    raise Exception('Number of pending jobs reached max_pending (%s)' %
+                                    self._compute.max_pending)
+                self._pending_cond.wait()
+
+    def _notify_pending(self):
+        # called by scheduler when a job is removed from queue
+        if self._compute.max_pending:
+            with self._pending_cond:
+                self._pending_cond.notify_all()
+
+    def _cached_job(self, _job):
+        # finishes _job with cached result if available and returns
+        # its DispyJob
+        _job.cache_key = self._result_cache._key(_job, self._result_cache_digest)
+        entry = self._result_cache._get(_job.cache_key)
+        if entry is None:
+            return None
+        job = _job.job
+        job.result, job.stdout, job.stderr = entry
+        job.start_time = job.end_time = time.time()
+        _job.cache_key = None
+        _job.finish(DispyJob.Finished)
+        if self.status_callback:
+            self._cluster.worker_Q.put((self.status_callback, (DispyJob.Finished, None, job)))
+        if self.callback:
+            self._cluster.worker_Q.put((self.callback, (job,)))
+        return job
+
     def cancel(self, job):
         """Cancel given job. If the job is not yet running on any
         node, it is simply removed from scheduler's queue. If the job
@@ -2088,6 +3616,54 @@ class JobCluster(object):
         """
         return Coro(self._cluster.set_node_cpus, node, cpus).value()
 
+    def broadcast(self, name, obj):
+        """Sends 'obj' to nodes used by this cluster (and nodes added
+        later) once, where it is kept in shared memory until the
+        computation is closed. Jobs get it with 'dispy_broadcast(name)'
+        without copying: bytes / bytearray as read-only memoryview,
+        numpy array as read-only numpy array using the shared memory
+        and other objects (which must be serializable) unserialized
+        once in each worker. Broadcasting with the same name again
+        replaces the data for jobs scheduled after this call returns.
+
+        Returns number of nodes the data was sent to.
+        """
+        if self._compute.type != _Compute.func_type:
+            raise Exception('broadcast is not supported for programs')
+        return Coro(self._cluster.broadcast, self, _Broadcast(name, obj)).value()
+
+    def fetch_output(self, job):
+        """With capture_output='file', nodes save all output of jobs
+        in files and only the last 'max_output' characters are in
+        'stdout' and 'stderr' of jobs. This method retrieves full
+        output of given (finished) job from the node that executed it;
+        output is available until the computation is closed.
+
+        Returns tuple (stdout, stderr), or None if output is not
+        available.
+        """
+        if job._dispy_output_ is None:
+            return None
+
+        def _fetch_output(self, job, coro=None):
+            node = self._cluster._nodes.get(job.ip_addr, None)
+            if node is None:
+                raise StopIteration(None)
+            output = yield node.retrieve_output(self._compute, job._dispy_output_, coro=coro)
+            raise StopIteration(output)
+
+        output = Coro(_fetch_output, self, job).value()
+        return self._decode_output(output)
+
+    def _decode_output(self, output):
+        # programs' output is bytes, as with other modes
+        if output is not None:
+            if self._compute.type == _Compute.func_type:
+                output = tuple(data.decode('utf-8', 'replace') for data in output)
+            else:
+                output = tuple(bytes(data) for data in output)
+        return output
+
     @property
     def name(self):
         """Returns name of computation. If the computation is Python
@@ -2142,6 +3718,7 @@ class JobCluster(object):
         if wall_time:
             msg += ', wall time: %.3f sec, speedup: %.3f' % (wall_time, cpu_time / wall_time)
         print(msg)
+        print('Event loop latency: %s' % self._cluster.loop_latency)
         print()
 
     # for backward compatibility
@@ -2198,7 +3775,10 @@ class SharedJobCluster(JobCluster):
                  ip_addr=None, port=None, scheduler_node=None, scheduler_port=None,
                  ext_ip_addr=None, loglevel=logging.INFO, setup=None, cleanup=True, dest_path=None,
                  poll_interval=None, reentrant=False, secret='',
-                 keyfile=None, certfile=None, recover_file=None):
+                 keyfile=None, certfile=None, recover_file=None, result_cache=None,
+                 discard_output=False, max_pending=None, worker_setup=None, worker_cleanup=None,
+                 exec_mode='process', jobs_per_cpu=1, capture_output='memory', max_output=65536,
+                 program_worker=False, weight=1, reuse_workers=False):
 
         if scheduler_node:
             self.scheduler_ip_addr = _node_ipaddr(scheduler_node)
@@ -2223,7 +3803,13 @@ class SharedJobCluster(JobCluster):
                             loglevel=loglevel, setup=setup, cleanup=cleanup, dest_path=dest_path,
                             poll_interval=poll_interval, reentrant=reentrant,
                             secret=secret, keyfile=keyfile, certfile=certfile,
-                            recover_file=recover_file)
+                            recover_file=recover_file, result_cache=result_cache,
+                            discard_output=discard_output, max_pending=max_pending,
+                            worker_setup=worker_setup, worker_cleanup=worker_cleanup,
+                            exec_mode=exec_mode, jobs_per_cpu=jobs_per_cpu,
+                            capture_output=capture_output, max_output=max_output,
+                            program_worker=program_worker, weight=weight,
+                            reuse_workers=reuse_workers)
 
         def _terminate_scheduler(self, coro=None):
             self._cluster.terminate = True
@@ -2340,7 +3926,21 @@ class SharedJobCluster(JobCluster):
 
         Arguments should be serializable and should correspond to
         arguments for computation used when cluster is created.
+
+        'dispy_after' and 'dispy_after_results' are same as for
+        JobCluster, except that jobs in 'dispy_after' must have been
+        submitted with SharedJobCluster; the new job is held by
+        dispyscheduler until those jobs are done.
+
+        'dispy_block' is same as for JobCluster; if dispyscheduler
+        has 'max_pending' jobs of this cluster queued, this method
+        retries periodically until the job is accepted.
         """
+        after = kwargs.pop('dispy_after', None)
+        after_results = kwargs.pop('dispy_after_results', False)
+        block = kwargs.pop('dispy_block', True)
+        if isinstance(after, DispyJob):
+            after = [after]
         if self._compute.type == _Compute.prog_type:
             if kwargs:
                 logger.warning('Programs can not have keyword arguments')
@@ -2352,7 +3952,14 @@ class SharedJobCluster(JobCluster):
             logger.warning('Creating job for "%s", "%s" failed with "%s"',
                            str(args), str(kwargs), traceback.format_exc())
             return None
-
+        if after:
+            after = list(after)
+        elif self._result_cache:
+            job = self._cached_job(_job)
+            if job:
+                return job
+
+        full = False
         try:
             for xf in _job.xfer_files:
                 sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), blocking=True,
@@ -2374,15 +3981,58 @@ class SharedJobCluster(JobCluster):
                     assert resp == b'ACK'
                 sock.close()
 
-            sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), blocking=True,
-                               keyfile=self._cluster.keyfile, certfile=self._cluster.certfile)
-            sock.settimeout(MsgTimeout)
-            sock.connect((self.scheduler_ip_addr, self.scheduler_port))
-            sock.sendall(self._scheduler_auth)
-            req = {'job': _job, 'auth': self._compute.auth}
-            sock.send_msg(b'JOB:' + serialize(req))
-            msg = sock.recv_msg()
-            _job.uid = unserialize(msg)
+            resolves = 0
+            delay = 0.1
+            while True:
+                req = {'job': _job, 'auth': self._compute.auth}
+                if after:
+                    # parents still pending are identified by their uid
+                    # (dispyscheduler holds new job until they are
+                    # done); results of parents already done are sent
+                    req['after'] = []
+                    req['after_results'] = [] if after_results else None
+                    for parent in after:
+                        _parent = parent._dispy_job_
+                        if _parent:
+                            req['after'].append((_parent.uid, _parent.hash))
+                            result = None
+                        elif parent.status == DispyJob.Finished:
+                            req['after'].append(None)
+                            result = parent.result
+                        else:
+                            logger.warning('Parent job %s of new job is not finished successfully',
+                                           parent.id)
+                            _job.job._dispy_job_ = None
+                            return None
+                        if after_results:
+                            req['after_results'].append(result)
+                sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                                   blocking=True, keyfile=self._cluster.keyfile,
+                                   certfile=self._cluster.certfile)
+                sock.settimeout(MsgTimeout)
+                sock.connect((self.scheduler_ip_addr, self.scheduler_port))
+                sock.sendall(self._scheduler_auth)
+                sock.send_msg(b'JOB:' + serialize(req))
+                msg = sock.recv_msg()
+                if msg == b'NAK (max_pending)':
+                    sock.close()
+                    if not block:
+                        full = True
+                        raise Exception('Number of pending jobs reached max_pending')
+                    time.sleep(delay)
+                    delay = min(2 * delay, 2.0)
+                    continue
+                _job.uid = unserialize(msg)
+                if not isinstance(_job.uid, list):
+                    break
+                resolves += 1
+                if resolves >= 3:
+                    raise Exception('Parent jobs could not be resolved')
+                # these parents are done at the scheduler, but their
+                # results are not yet processed here; wait and retry
+                sock.close()
+                for j in _job.uid:
+                    after[j].finish.wait(MsgTimeout)
             self._cluster._sched_jobs[_job.uid] = _job
             self._pending_jobs += 1
             self._complete.clear()
@@ -2391,10 +4041,12 @@ class SharedJobCluster(JobCluster):
                                             (DispyJob.Created, None, _job.job)))
             return _job.job
         except:
-            logger.warning('Creating job for "%s", "%s" failed with "%s"',
-                           str(args), str(kwargs), traceback.format_exc())
             _job.job._dispy_job_ = None
             del _job.job
+            if full:
+                raise
+            logger.warning('Creating job for "%s", "%s" failed with "%s"',
+                           str(args), str(kwargs), traceback.format_exc())
             return None
         finally:
             sock.close()
@@ -2505,6 +4157,59 @@ class SharedJobCluster(JobCluster):
             sock.close()
         return reply
 
+    def broadcast(self, name, obj):
+        """Similar to 'broadcast' of JobCluster.
+        """
+        if self._compute.type != _Compute.func_type:
+            raise Exception('broadcast is not supported for programs')
+        bc = _Broadcast(name, obj)
+        sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), blocking=True,
+                           keyfile=self._cluster.keyfile, certfile=self._cluster.certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            sock.connect((self.scheduler_ip_addr, self.scheduler_port))
+            sock.sendall(self._scheduler_auth)
+            req = bc.header(self._compute.id, self._compute.auth)
+            sock.send_msg(b'BROADCAST:' + serialize(req))
+            sock.sendall(bc.data)
+            reply = sock.recv_msg()
+            reply = unserialize(reply)
+        except:
+            logger.warning('Could not send "%s" to scheduler', name)
+            return -1
+        finally:
+            sock.close()
+        return reply
+
+    def fetch_output(self, job):
+        """Similar to 'fetch_output' of JobCluster.
+        """
+        if job._dispy_output_ is None:
+            return None
+        sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), blocking=True,
+                           keyfile=self._cluster.keyfile, certfile=self._cluster.certfile)
+        sock.settimeout(MsgTimeout)
+        output = None
+        try:
+            sock.connect((self.scheduler_ip_addr, self.scheduler_port))
+            sock.sendall(self._scheduler_auth)
+            req = {'compute_id': self._compute.id, 'auth': self._compute.auth,
+                   'uid': job._dispy_output_, 'node': job.ip_addr}
+            sock.send_msg(b'RETRIEVE_OUTPUT:' + serialize(req))
+            sizes = unserialize(sock.recv_msg())
+            if sizes is not None:
+                output = []
+                for size in sizes:
+                    data = sock.recvall(size)
+                    assert len(data) == size
+                    output.append(data)
+        except:
+            logger.warning('Could not retrieve output of job %s', job.id)
+            output = None
+        finally:
+            sock.close()
+        return self._decode_output(output)
+
     def close(self):
         """Similar to 'close' of JobCluster.
         """
@@ -2515,7 +4220,8 @@ class SharedJobCluster(JobCluster):
             Coro(cluster.del_cluster, self).value()
 
 
-def recover_jobs(recover_file, timeout=None, terminate_pending=False):
+def recover_jobs(recover_file, timeout=None, terminate_pending=False, callback=None,
+                 max_requests=64, node_timeout=None):
     """
     If dispy client crashes or loses connection to nodes, the nodes
     will continue to execute scheduled jobs. This 'recover_jobs'
@@ -2536,6 +4242,21 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
       computations again right away instead of having to wait until
       all jobs finish).
 
+    @callback, if given, is called (in the thread that called this
+      function) with each recovered DispyJob instance as soon as its
+      result is received, so results can be processed while other
+      jobs are still being recovered.
+
+    @max_requests is maximum number of nodes that are contacted at the
+      same time to resend results. Nodes are contacted concurrently,
+      so recovering from many nodes (some of which may not be
+      reachable) doesn't take as long as contacting them one by one.
+
+    @node_timeout is time limit in seconds for each request to a
+      node. If a node doesn't respond within this time, it is assumed
+      to be not reachable and is skipped. Default value is
+      'MsgTimeout'.
+
     Returns list of DispyJob instances that will have .result,
     .stdout, .stderr etc.; however, the nodes don't keep track of .id,
     .args, .kwargs so they will be None.
@@ -2553,23 +4274,40 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
     asyncoro_scheduler = asyncoro.AsynCoro.instance()
 
     try:
-        shelf = shelve.open(recover_file, flag='r')
+        entries = _RecoveryJournal.read(recover_file)
+    except (IOError, OSError):
+        # shelve (used by earlier version of dispy) may save in other
+        # files (e.g., 'recover_file.dat' with 'dbm.dumb')
+        entries = None
     except:
         print('Could not open recover file "%s"' % recover_file)
         return []
+    if entries is None:
+        # recover file saved by earlier version of dispy
+        try:
+            shelf = shelve.open(recover_file, flag='r')
+            entries = dict(shelf.items())
+            shelf.close()
+        except:
+            print('Could not open recover file "%s"' % recover_file)
+            return []
 
-    for key, val in shelf.items():
+    compute_nodes = {}
+    for key, val in entries.items():
         if key.startswith('node_'):
             shelf_nodes[key[len('node_'):]] = val
+        elif key.startswith('nodes_'):
+            compute_nodes[int(key[len('nodes_'):])] = val
         elif key.startswith('compute_'):
             computes[int(key[len('compute_'):])] = val
         elif key == '_cluster':
             cluster = val
         else:
             logger.warning('invalid key "%s" ignored' % key)
-    shelf.close()
+    for compute_id, compute in computes.items():
+        compute['nodes'] = list(compute_nodes.get(compute_id, compute.get('nodes', [])))
     if not cluster or not computes or not shelf_nodes:
-        for ext in ('', '.db', '.bak', '.dat', '.dir'):
+        for ext in ('', '.tmp', '.db', '.bak', '.dat', '.dir'):
             if os.path.isfile(recover_file + ext):
                 try:
                     os.remove(recover_file + ext)
@@ -2577,6 +4315,9 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
                     pass
         return []
 
+    # memory mapped results are saved where client saved them
+    dest_path = cluster.get('dest_path', None) or os.path.dirname(os.path.abspath(recover_file))
+    io_pool = asyncoro.AsyncThreadPool(IOThreads)
     nodes = {}
     for ip_addr, info in shelf_nodes.items():
         node = _Node(ip_addr, info['port'], 0, '', cluster['secret'],
@@ -2588,31 +4329,60 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
         # generator
         conn.settimeout(MsgTimeout)
         msg = yield conn.recv_msg()
-        if msg.startswith(b'JOB_REPLY:'):
+        if msg.startswith(b'JOB_REPLIES:'):
+            # saved results resent in bulk, until 'END'
+            bulk = True
+            msg = yield conn.recv_msg()
+        elif msg.startswith(b'JOB_REPLY:'):
+            bulk = False
+        else:
+            logger.debug('Invalid TCP message from %s ignored' % addr[0])
+            conn.close()
+            raise StopIteration
+        while msg.startswith(b'JOB_REPLY:'):
             try:
                 reply = unserialize(msg[len(b'JOB_REPLY:'):])
             except:
                 logger.warning('invalid job reply from %s:%s ignored' % (addr[0], addr[1]))
-                conn.close()
-                raise StopIteration
-            yield conn.send_msg(b'ACK')
-            logger.debug('received reply for job %s' % reply.uid)
-            job = DispyJob((), {})
-            job.result = reply.result
-            job.stdout = reply.stdout
-            job.stderr = reply.stderr
-            job.exception = reply.exception
-            job.start_time = reply.start_time
-            job.end_time = reply.end_time
-            job.status = reply.status
-            job.ip_addr = reply.ip_addr
-            job.finish.set()
-            pending['jobs'].append(job)
-            pending['count'] -= 1
-            if pending['count'] == 0 and pending['resend_req_done'] is True:
-                pending['complete'].set()
-        else:
-            logger.debug('Invalid TCP message from %s ignored' % addr[0])
+                break
+            try:
+                if isinstance(reply.result, _MappedResult):
+                    reply.result = yield _recv_mapped_result(reply.result, conn, dest_path,
+                                                             io_pool)
+            except IOError:
+                logger.warning('Could not receive result of job %s from %s: %s',
+                               reply.uid, addr[0], traceback.format_exc())
+                break
+            except:
+                # result couldn't be saved; node keeps it (and it can be
+                # recovered again)
+                logger.warning('Could not receive result of job %s from %s: %s',
+                               reply.uid, addr[0], traceback.format_exc())
+                yield conn.send_msg(b'NAK')
+            else:
+                yield conn.send_msg(b'ACK')
+                logger.debug('received reply for job %s' % reply.uid)
+                job = DispyJob((), {})
+                job.result = reply.result
+                job.stdout = reply.stdout
+                job.stderr = reply.stderr
+                job.exception = reply.exception
+                job.start_time = reply.start_time
+                job.end_time = reply.end_time
+                job.status = reply.status
+                job.ip_addr = reply.ip_addr
+                job.finish.set()
+                pending['jobs'].append(job)
+                pending['results'].put(job)
+                pending['count'] -= 1
+                if pending['count'] == 0 and pending['resend_req_done'] is True:
+                    pending['complete'].set()
+            if not bulk:
+                break
+            try:
+                msg = yield conn.recv_msg()
+            except:
+                break
         conn.close()
 
     def tcp_server(ip_addr, pending, coro=None):
@@ -2646,34 +4416,66 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
                 Coro(tcp_task, conn, addr, pending)
         raise StopIteration
 
-    def resend_requests(pending, coro=None):
-        for compute_id, compute in computes.items():
-            if pending['timeout'] and \
-               ((time.time() - pending['start_time']) > pending['timeout']):
-                break
-            req = serialize({'compute_id': compute_id, 'auth': compute['auth']})
-            for ip_addr in compute['nodes']:
-                node = nodes.get(ip_addr, None)
-                if not node:
-                    continue
-                reply = yield node.send(b'RESEND_JOB_RESULTS:' + req)
+    def resend_node_requests(node_reqs, pending, coro=None):
+        # generator
+        while node_reqs:
+            node, compute_ids = node_reqs.pop()
+            for compute_id in compute_ids:
+                if pending['timeout'] and \
+                   ((time.time() - pending['start_time']) > pending['timeout']):
+                    raise StopIteration
+                compute = computes[compute_id]
+                req = serialize({'compute_id': compute_id, 'auth': compute['auth']})
+                reply = yield node.send(b'RESEND_JOB_RESULTS:' + req, timeout=node_timeout)
                 try:
                     reply = unserialize(reply)
                     assert isinstance(reply, int)
                 except:
-                    logger.warning('Invalid resend reply from %s' % ip_addr)
-                    continue
+                    # node is not reachable; don't wait for it for other computations
+                    logger.warning('Invalid resend reply from %s' % node.ip_addr)
+                    pending['failed'].add(node.ip_addr)
+                    break
                 logger.debug('pending jobs from %s for %s: %s' %
                              (node.ip_addr, compute['name'], reply))
                 if reply == 0:
-                    yield node.send(b'CLOSE:' + req, reply=False)
+                    yield node.send(b'CLOSE:' + req, reply=False, timeout=node_timeout)
                 else:
                     pending['count'] += reply
+
+    def resend_requests(pending, coro=None):
+        # generator
+        node_reqs = {}
+        for compute_id, compute in computes.items():
+            for ip_addr in compute['nodes']:
+                node = nodes.get(ip_addr, None)
+                if node:
+                    node_reqs.setdefault(node, []).append(compute_id)
+        node_reqs = list(node_reqs.items())
+        tasks = [Coro(resend_node_requests, node_reqs, pending)
+                 for i in range(min(max(max_requests, 1), len(node_reqs)))]
+        for task in tasks:
+            yield task.finish()
         pending['resend_req_done'] = True
         if pending['count'] == 0:
             pending['complete'].set()
 
+    def deliver_results(pending):
+        while not (pending['complete'].is_set() and pending['results'].empty()):
+            try:
+                job = pending['results'].get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if callback:
+                try:
+                    callback(job)
+                except:
+                    logger.warning('Callback for recovered job failed: %s',
+                                   traceback.format_exc())
+
+    if node_timeout is None:
+        node_timeout = MsgTimeout
     pending = {'count': 0, 'resend_req_done': False, 'jobs': [], 'complete': threading.Event(),
+               'results': queue.Queue(), 'failed': set(),
                'timeout': timeout, 'start_time': time.time()}
     for ip_addr in cluster['ip_addrs']:
         if not ip_addr:
@@ -2682,16 +4484,16 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
 
     Coro(resend_requests, pending)
 
-    pending['complete'].wait()
+    deliver_results(pending)
 
     for compute_id, compute in computes.items():
         req = serialize({'compute_id': compute_id, 'auth': compute['auth'],
                          'terminate_pending': terminate_pending})
         for ip_addr in compute['nodes']:
             node = nodes.get(ip_addr, None)
-            if not node:
+            if not node or ip_addr in pending['failed']:
                 continue
-            Coro(node.send, b'CLOSE:' + req, reply=False)
+            Coro(node.send, b'CLOSE:' + req, reply=False, timeout=node_timeout)
 
     if terminate_pending:
         # wait a bit to get cancelled job results
@@ -2701,9 +4503,11 @@ def recover_jobs(recover_file, timeout=None, terminate_pending=False):
             time.sleep(0.2)
 
     asyncoro_scheduler.finish()
+    pending['complete'].set()
+    deliver_results(pending)
 
     if pending['count'] == 0 and pending['resend_req_done'] is True:
-        for ext in ('', '.db', '.bak', '.dat', '.dir'):
+        for ext in ('', '.tmp', '.db', '.bak', '.dat', '.dir'):
             if os.path.isfile(recover_file + ext):
                 try:
                     os.remove(recover_file + ext)
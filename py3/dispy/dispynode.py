@@ -27,16 +27,26 @@ import ssl
 import traceback
 import logging
 import marshal
+import hashlib
 import tempfile
 import shutil
 import glob
 import functools
 import inspect
+import struct
 import pickle
 import io
-
-from dispy import _JobReply, DispyJob, _Function, _Compute, _XferFile, _node_ipaddr, \
-    _dispy_version, auth_code, num_min, _same_file
+import queue
+import collections
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # broadcast data is kept in files (memory mapped by jobs)
+    shared_memory = None
+
+from dispy import _JobReply, _MappedResult, DispyJob, _Function, _Compute, _XferFile, \
+    _node_ipaddr, _dispy_version, auth_code, num_min, _same_file, _ResultStore, _write_file, \
+    _LoopLatency, IOThreads, _send_stored_results, _recv_result_ack
 
 import asyncoro
 from asyncoro import Coro, AsynCoro, AsyncSocket, serialize, unserialize
@@ -46,6 +56,15 @@ __all__ = []
 
 MaxFileSize = 10*(1024**2)
 MsgTimeout = 5
+# results at least this big are saved in files by job processes and
+# sent from there, instead of passing them through reply_Q
+LargeResultSize = 1024**2
+# files with job reply followed by data of result (see _MappedResult)
+# start with this (instead of serialized reply)
+MappedResultMagic = b'\x00dispy-mapped-result\n'
+# number of compiled computations kept (least recently used are
+# discarded)
+CodeCacheSize = 64
 
 logger = logging.getLogger('dispynode')
 logger.setLevel(logging.INFO)
@@ -156,6 +175,49 @@ def dispy_send_file(path, timeout=MsgTimeout):
         sock.close()
 
 
+def dispy_broadcast(name):
+    """Returns data sent to nodes with 'broadcast' method of cluster
+    under given 'name'.
+
+    The data is kept on the node in shared memory (or, with Python
+    versions before 3.8, in a file that is memory mapped) and is not copied for jobs:
+    bytes / bytearray are returned as read-only memoryview and numpy
+    arrays as read-only numpy arrays. Other objects are unserialized
+    once in each worker process (shared by jobs of computation with
+    exec_mode='thread'), so jobs shouldn't modify them.
+
+    Raises KeyError if there is no data with given name.
+    """
+    storage, location, size, kind, meta = __dispy_job_info.broadcasts[name]
+    cache = globals().setdefault('_dispy_broadcast_cache', {})
+    if location in cache:
+        return cache[location][1]
+    if size == 0:
+        block, buf = None, memoryview(b'')
+    else:
+        if storage == 'shm':
+            from multiprocessing import shared_memory
+            block = shared_memory.SharedMemory(name=location)
+            buf = block.buf[:size].toreadonly()
+        else:
+            import mmap
+            fd = open(location, 'rb')
+            block = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+            fd.close()
+            buf = memoryview(block)
+    if kind == 'numpy':
+        import numpy
+        data = numpy.frombuffer(buf, dtype=meta[0]).reshape(meta[1])
+    elif kind == 'pickle':
+        from asyncoro import unserialize
+        data = unserialize(bytes(buf))
+    else:
+        data = buf
+    # block must be kept open while data is used
+    cache[location] = (block, data)
+    return data
+
+
 class _DispyJobInfo(object):
     """Internal use only.
     """
@@ -166,43 +228,888 @@ class _DispyJobInfo(object):
         self.compute_dest_path = compute.dest_path
         self.xfer_files = xfer_files
         self.compute_auth = compute.auth
+        self.capture_output = getattr(compute, 'capture_output', 'memory')
+        self.max_output = getattr(compute, 'max_output', 0)
+        self.mmap_result_size = getattr(compute, 'mmap_result_size', 0)
+        # file with serialized job reply (for large results)
+        self.reply_file = None
+        # descriptors of data broadcast for computation
+        self.broadcasts = compute.broadcasts
+        # index of cpu slot job runs on (if dispynode pins jobs)
+        self.cpu_slot = None
+        # True while job is in run queue of node, waiting for a cpu
+        self.queued = False
         self.proc = None
+        self.worker = None
 
+    def __getstate__(self):
+        # job info is sent to worker process; process / worker are
+        # not needed (and can't be pickled) there
+        state = dict(self.__dict__)
+        state['proc'] = state['worker'] = None
+        return state
 
-def _dispy_job_func(__dispy_job_info, __dispy_job_certfile, __dispy_job_keyfile,
-                    __dispy_job_name, __dispy_job_args, __dispy_job_kwargs,
-                    __dispy_job_code, __dispy_job_globals, __dispy_path, __dispy_reply_Q):
+
+class _DispyWorker(object):
+    """Internal use only.
+    """
+    def __init__(self, compute_id, proc, conn):
+        self.compute_id = compute_id
+        self.proc = proc
+        self.conn = conn
+        self.job_info = None
+        self.jobs = 0
+        self.code_hash = None
+        self.crashed = False
+        self.cpu_slot = None
+
+
+class _DispyThreadWorker(object):
     """Internal use only.
+
+    Worker process (see '_dispy_thread_worker_func') that executes
+    jobs of computation with exec_mode 'thread' in its threads.
+    """
+    def __init__(self, compute_id):
+        self.compute_id = compute_id
+        self.worker = None
+        # infos of jobs running in worker
+        self.job_infos = set()
+        self.jobs = 0
+        self.crashed = False
+
+
+class _DispyThreadOutput(object):
+    """Internal use only.
+
+    Replaces sys.stdout / sys.stderr in worker process of computation
+    with exec_mode 'thread' so output of jobs executed in its threads
+    is captured for each job.
     """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, output):
+        self.local.buf = output
+
+    def release(self):
+        buf, self.local.buf = self.local.buf, None
+        value = buf.getvalue()
+        buf.close()
+        return value
+
+    def __getattr__(self, name):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            return getattr(self.stream, name)
+        return getattr(buf, name)
+
+
+class _DispyOutput(object):
+    """Internal use only.
+
+    Captures stdout / stderr of a job as per 'capture_output' of
+    computation, so at most 'max_output' characters are kept in
+    memory. With 'file', all output is also saved in a file; with
+    'stream', output is sent to client in chunks of 'max_output'
+    characters (or at least once a second while job writes) by
+    '_DispyOutputSender', so job doesn't wait for network.
+    """
+    def __init__(self, name, job_info, keyfile, certfile, empty=''):
+        self.name = name
+        self.mode = job_info.capture_output
+        self.max_output = job_info.max_output
+        self.job_info = job_info
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.empty = empty
+        self.buf = collections.deque()
+        self.size = 0
+        self.send_time = time.time()
+        if self.mode == 'stream':
+            # chunks of output queued to be sent and (last part of)
+            # output that couldn't be sent, updated by sender thread
+            self.lock = threading.Condition()
+            self.pending = 0
+            self.unsent = empty
+            self.max_buffer = self.max_output * _DispyOutputSender.MaxQueued
+        else:
+            self.lock = None
+        if self.mode == 'file':
+            self.fd = open(os.path.join(job_info.compute_dest_path, '_dispy_job_%s_%s' %
+                                        (name, job_info.job_reply.uid)), 'wb')
+        else:
+            self.fd = None
+
+    def write(self, data):
+        n = len(data)
+        if not data or self.mode == 'discard':
+            return n
+        if isinstance(data, str) and isinstance(self.empty, bytes):
+            # Python programs executed in worker (with 'program_worker')
+            data = data.encode('utf-8', 'replace')
+        if self.fd:
+            if isinstance(data, str):
+                self.fd.write(data.encode('utf-8', 'replace'))
+            else:
+                self.fd.write(data)
+        if self.lock:
+            self.lock.acquire()
+        self.buf.append(data)
+        self.size += len(data)
+        if self.mode == 'stream':
+            # while earlier chunks are being sent, output is collected
+            # (up to 'max_buffer') and sent as one chunk later
+            max_output = self.max_buffer
+            if self.pending < 2 and (self.size >= self.max_output or
+                                     (time.time() - self.send_time) >= 1):
+                if _DispyOutputSender.instance().send(self, self.empty.join(self.buf)):
+                    self.pending += 1
+                    self.buf.clear()
+                    self.size = 0
+                self.send_time = time.time()
+        else:
+            max_output = self.max_output
+        while self.size > max_output:
+            extra = self.size - max_output
+            if len(self.buf[0]) <= extra:
+                self.size -= len(self.buf.popleft())
+            else:
+                self.buf[0] = self.buf[0][extra:]
+                self.size -= extra
+        if self.lock:
+            self.lock.release()
+        return n
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.fd:
+            self.fd.flush()
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        if self.mode == 'discard':
+            return None
+        if self.lock:
+            self.lock.acquire()
+            # chunks queued are sent before rest of output (with reply)
+            while self.pending:
+                self.lock.wait()
+            self.lock.release()
+            if self.unsent:
+                return (self.unsent + self.empty.join(self.buf))[-self.max_output:]
+        return self.empty.join(self.buf)
+
+    def sent(self, data, status):
+        """Called by '_DispyOutputSender' after sending 'data' (chunk
+        of output); 'status' is 0 if it is sent.
+        """
+        self.lock.acquire()
+        self.pending -= 1
+        if status != 0:
+            # client is not reachable; keep only last part
+            self.mode = 'tail'
+            self.unsent = (self.unsent + data)[-self.max_output:]
+        self.lock.notify_all()
+        self.lock.release()
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+
+class _DispyOutputSender(object):
+    """Internal use only.
+
+    Sends output of jobs with capture_output='stream' to clients in a
+    thread (one in each process), so jobs don't wait for network. At
+    most 'MaxQueued' chunks are queued (if queue is full, output is
+    kept by job until a chunk can be queued); chunks of a job are
+    sent in the order they are written.
+    """
+
+    MaxQueued = 64
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.MaxQueued)
+        thread = threading.Thread(target=self.__send_task)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def instance():
+        sender = _DispyOutputSender._instance
+        # thread of sender in parent is not running in forked worker
+        if sender is None or sender.pid != os.getpid():
+            _DispyOutputSender._lock.acquire()
+            sender = _DispyOutputSender._instance
+            if sender is None or sender.pid != os.getpid():
+                sender = _DispyOutputSender._instance = _DispyOutputSender()
+            _DispyOutputSender._lock.release()
+        return sender
+
+    def send(self, output, data):
+        """Queues 'data' of 'output' (_DispyOutput) to be sent and
+        returns True, or False if queue is full.
+        """
+        try:
+            self.queue.put_nowait((output, data))
+        except queue.Full:
+            return False
+        return True
+
+    def __send_task(self):
+        while True:
+            output, data = self.queue.get()
+            if output.mode == 'stream':
+                status = _dispy_send_output(output.job_info, output.name, data,
+                                            output.keyfile, output.certfile)
+            else:
+                # earlier chunk couldn't be sent
+                status = -1
+            output.sent(data, status)
+
+
+def _dispy_send_output(job_info, name, data, keyfile, certfile, timeout=MsgTimeout):
+    """Internal use only.
+
+    Sends output of job (with capture_output='stream') to client.
+    """
+    info = {'uid': job_info.job_reply.uid, 'hash': job_info.job_reply.hash, name: data}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = AsyncSocket(sock, blocking=True, keyfile=keyfile, certfile=certfile)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(job_info.reply_addr)
+        sock.send_msg(b'JOB_OUTPUT:' + serialize(info))
+        ack = sock.recv_msg()
+        assert ack == b'ACK'
+    except:
+        logger.debug('Could not send output of job %s', job_info.job_reply.uid)
+        return -1
+    else:
+        return 0
+    finally:
+        sock.close()
+
+
+class _DispyBroadcast(object):
+    """Internal use only.
+
+    Data sent with 'broadcast' method of cluster.
+    """
+    def __init__(self, name, size, kind, meta, dest_path):
+        self.name = name
+        self.size = size
+        self.kind = kind
+        self.meta = meta
+        if shared_memory:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self.fd = None
+            self.location = ('shm', self.shm.name)
+        else:
+            self.shm = None
+            fd, self.path = tempfile.mkstemp(prefix='_dispy_broadcast_', dir=dest_path)
+            self.fd = os.fdopen(fd, 'wb')
+            self.location = ('file', self.path)
+
+    def write(self, offset, data):
+        if self.shm:
+            self.shm.buf[offset:offset + len(data)] = data
+        else:
+            self.fd.write(data)
+
+    def desc(self):
+        if self.fd:
+            self.fd.close()
+        return self.location + (self.size, self.kind, self.meta)
+
+    def close(self):
+        if self.shm:
+            self.shm.close()
+            self.shm.unlink()
+        else:
+            if not self.fd.closed:
+                self.fd.close()
+            try:
+                os.remove(self.path)
+            except:
+                logger.warning('Could not remove "%s"', self.path)
+
+
+def _dispy_result_size(result):
+    """Internal use only.
+
+    Returns (approximate) size of 'result' without serializing it.
+    """
+    try:
+        size = max(sys.getsizeof(result), getattr(result, 'nbytes', 0))
+        if isinstance(result, (list, tuple)):
+            items = result
+        elif isinstance(result, dict):
+            items = result.values()
+        else:
+            return size
+        for item in items:
+            size += max(sys.getsizeof(item), getattr(item, 'nbytes', 0))
+            if size >= LargeResultSize:
+                break
+        return size
+    except:
+        return 0
+
+
+def _dispy_mapped_result(result, min_size):
+    """Internal use only.
+
+    Returns _MappedResult describing 'result' if it is bytes /
+    bytearray or numpy array (without objects) of at least 'min_size'
+    bytes, so it is sent as raw data; otherwise returns None.
+    """
+    if not min_size:
+        return None
+    if isinstance(result, (bytes, bytearray)):
+        if len(result) >= min_size:
+            return _MappedResult('bytes', None, len(result))
+        return None
+    numpy = sys.modules.get('numpy', None)
+    if numpy is not None and isinstance(result, numpy.ndarray) and \
+       not result.dtype.hasobject and result.nbytes >= min_size:
+        return _MappedResult('numpy', (result.dtype.str, result.shape), result.nbytes)
+    return None
+
+
+def _dispy_save_mapped_result(fd, job_reply, info):
+    """Internal use only.
+
+    Writes 'job_reply' (with result replaced by 'info') and data of
+    result to file 'fd', as expected by '_send_reply_file'.
+    """
+    import pickle
+    import struct
+    result = job_reply.result
+    job_reply.result = info
+    try:
+        reply = pickle.dumps(job_reply, pickle.HIGHEST_PROTOCOL)
+    finally:
+        job_reply.result = result
+    fd.write(MappedResultMagic + struct.pack('>Q', len(reply)) + reply)
+    if info.kind == 'numpy':
+        import numpy
+        numpy.ascontiguousarray(result).tofile(fd)
+    else:
+        fd.write(result)
+
+
+def _dispy_reply_file(job_reply, job_info, path, pickle):
+    """Internal use only.
+
+    Called in worker processes: if result of 'job_reply' is large (or
+    is to be memory mapped by client), it is written to a file in
+    'path', so node sends it from there, instead of result being
+    copied through reply_Q; returns that file (and result and output
+    in 'job_reply' are cleared) or None.
+    """
+    mapped = _dispy_mapped_result(job_reply.result, job_info.mmap_result_size)
+    if not mapped and _dispy_result_size(job_reply.result) < LargeResultSize:
+        return None
+    reply_file = os.path.join(path, '_dispy_job_result_%s' % job_reply.uid)
+    try:
+        with open(reply_file, 'wb') as fd:
+            if mapped:
+                _dispy_save_mapped_result(fd, job_reply, mapped)
+            else:
+                pickle.dump(job_reply, fd, pickle.HIGHEST_PROTOCOL)
+    except:
+        # send it through reply_Q (which reports any errors)
+        if os.path.isfile(reply_file):
+            os.remove(reply_file)
+        return None
+    job_reply.result = job_reply.stdout = job_reply.stderr = None
+    return reply_file
+
+
+def _dispy_numa_nodes():
+    """Internal use only.
+
+    Returns list of cpus in each NUMA node of this machine.
+    """
+    numa_nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    paths.sort(key=lambda path: int(os.path.basename(os.path.dirname(path))[len('node'):]))
+    for path in paths:
+        try:
+            fd = open(path)
+            cpulist = fd.read().strip()
+            fd.close()
+        except:
+            continue
+        cpus = []
+        for cpu_range in cpulist.split(','):
+            if not cpu_range:
+                continue
+            cpu_range = cpu_range.split('-')
+            cpus.extend(range(int(cpu_range[0]), int(cpu_range[-1]) + 1))
+        if cpus:
+            numa_nodes.append(cpus)
+    if not numa_nodes:
+        numa_nodes = [list(range(multiprocessing.cpu_count()))]
+    return numa_nodes
+
+
+def _dispy_set_affinity(pid, cpus):
+    """Internal use only.
+
+    Pins all threads of process 'pid' to given cpus.
+    """
+    task_dir = '/proc/%s/task' % pid
+    if os.path.isdir(task_dir):
+        tids = [int(tid) for tid in os.listdir(task_dir)]
+    else:
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # thread may have exited
+            pass
+
+
+class _DispyCPUSlots(object):
+    """Internal use only.
+
+    Divides cpus used by dispynode into slots of 'cores_per_job' cpus,
+    each within a NUMA node if possible. A job (and the worker process
+    executing it) is pinned to cpus of a free slot chosen according to
+    'policy': with 'spread', slot is taken from NUMA node with fewest
+    busy slots, so jobs use memory (bandwidth) of all NUMA nodes, and
+    with 'pack', from NUMA node with most busy slots, so jobs share
+    caches and memory of as few NUMA nodes as possible.
+    """
+    def __init__(self, policy, cpus, cores_per_job):
+        self.policy = policy
+        self.cores_per_job = cores_per_job
+        self.numa_nodes = _dispy_numa_nodes()
+        # cpus this process is allowed to use (e.g., with 'taskset')
+        usable = os.sched_getaffinity(0)
+        numa_nodes = [[cpu for cpu in node_cpus if cpu in usable]
+                      for node_cpus in self.numa_nodes]
+        if sum(len(node_cpus) for node_cpus in numa_nodes) < cpus:
+            raise Exception('only %s cpus are available for affinity' %
+                            sum(len(node_cpus) for node_cpus in numa_nodes))
+        # each slot is (NUMA node index, cpus); with 'spread', slots
+        # are taken from all NUMA nodes in turn and with 'pack', from
+        # NUMA nodes in order
+        self.slots = []
+        node_slots = [0] * len(numa_nodes)
+        while len(self.slots) < (cpus // cores_per_job):
+            nodes = [i for i, node_cpus in enumerate(numa_nodes) if len(node_cpus) >= cores_per_job]
+            if nodes:
+                if policy == 'spread':
+                    i = min(nodes, key=lambda i: node_slots[i])
+                else:
+                    i = nodes[0]
+                slot_cpus = numa_nodes[i][:cores_per_job]
+                del numa_nodes[i][:cores_per_job]
+            else:
+                # no NUMA node has enough cpus left; combine them
+                i = None
+                slot_cpus = []
+                for j, node_cpus in enumerate(numa_nodes):
+                    if node_cpus and i is None:
+                        i = j
+                    take = min(cores_per_job - len(slot_cpus), len(node_cpus))
+                    slot_cpus.extend(node_cpus[:take])
+                    del node_cpus[:take]
+            node_slots[i] += 1
+            self.slots.append((i, tuple(slot_cpus)))
+        self.free = set(range(len(self.slots)))
+
+    def allocate(self, prefer=None):
+        """Returns index of free slot ('prefer', if it is free) or None.
+        """
+        if prefer is not None and prefer in self.free:
+            self.free.discard(prefer)
+            return prefer
+        if not self.free:
+            return None
+        busy_slots = dict((self.slots[slot][0], 0) for slot in self.free)
+        for slot in range(len(self.slots)):
+            if slot not in self.free and self.slots[slot][0] in busy_slots:
+                busy_slots[self.slots[slot][0]] += 1
+        if self.policy == 'spread':
+            numa_node = min(busy_slots, key=lambda i: (busy_slots[i], i))
+        else:
+            numa_node = min(busy_slots, key=lambda i: (-busy_slots[i], i))
+        slot = min(slot for slot in self.free if self.slots[slot][0] == numa_node)
+        self.free.discard(slot)
+        return slot
+
+    def release(self, slot):
+        self.free.add(slot)
+
+    def cpus(self, slot):
+        return self.slots[slot][1]
+
+
+def _dispy_close_sockets():
+    """Internal use only.
+
+    Worker processes forked from dispynode inherit its sockets (e.g.,
+    connection of job request being served); these are replaced so
+    sockets are released when dispynode closes them (otherwise its I/O
+    notifier may fail for sockets opened later).
+    """
+    if os.path.isdir('/proc/self/fd'):
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    else:
+        fds = range(3, 1024)
+    for fd in fds:
+        if fd < 3:
+            continue
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.close(fd)
+        except OSError:
+            pass
+
 
-    if os.name == 'nt':
+def _dispy_worker_func(__dispy_job_name, __dispy_job_code, __dispy_job_globals,
+                       __dispy_worker_setup, __dispy_worker_cleanup,
+                       __dispy_job_certfile, __dispy_job_keyfile, __dispy_path,
+                       __dispy_job_conn, __dispy_reply_Q):
+    """Internal use only.
+    """
+
+    if os.name == 'nt' or __name__ == '__mp_main__':
+        # not forked from dispynode (Windows or forkserver)
+        __dispy_job_globals.update(globals())
+    else:
+        _dispy_close_sockets()
+    os.chdir(__dispy_path)
+    # 'io' and 'pickle' may be replaced with computation's globals below
+    __dispy_StringIO = io.StringIO
+    __dispy_Output = _DispyOutput
+    __dispy_pickle = pickle
+    # computation is loaded once and then used for all jobs sent to
+    # this worker
+    try:
+        exec(marshal.loads(__dispy_job_code), __dispy_job_globals)
+    except:
+        __dispy_code_error = traceback.format_exc()
+    else:
+        __dispy_code_error = None
+    globals().update(__dispy_job_globals)
+    if __name__ == '__mp_main__':  # Windows / forkserver multiprocessing process
+        sys.modules['__mp_main__'].__dict__.update(__dispy_job_globals)
+    __dispy_job_globals['__dispy_job_certfile'] = __dispy_job_certfile
+    __dispy_job_globals['__dispy_job_keyfile'] = __dispy_job_keyfile
+    if __dispy_worker_setup and not __dispy_code_error:
+        try:
+            assert __dispy_job_globals[__dispy_worker_setup.name](
+                *__dispy_worker_setup.args, **__dispy_worker_setup.kwargs) == 0
+        except:
+            __dispy_code_error = traceback.format_exc()
+            __dispy_worker_cleanup = None
+            logger.warning('worker_setup "%s" failed', __dispy_worker_setup.name)
+
+    while True:
+        try:
+            __dispy_job = __dispy_job_conn.recv()
+        except:
+            break
+        if __dispy_job is None:
+            break
+        __dispy_job_info, __dispy_job_args, __dispy_job_kwargs, \
+            __dispy_job_after_args, __dispy_job_code = __dispy_job
+        if __dispy_job_info.capture_output == 'memory':
+            sys.stdout = __dispy_StringIO()
+            sys.stderr = __dispy_StringIO()
+        else:
+            sys.stdout = __dispy_Output('stdout', __dispy_job_info,
+                                        __dispy_job_keyfile, __dispy_job_certfile)
+            sys.stderr = __dispy_Output('stderr', __dispy_job_info,
+                                        __dispy_job_keyfile, __dispy_job_certfile)
+        __dispy_job_reply = __dispy_job_info.job_reply
+        try:
+            if __dispy_code_error:
+                raise Exception(__dispy_code_error)
+            if __dispy_job_code:
+                exec(marshal.loads(__dispy_job_code), __dispy_job_globals)
+            __dispy_job_args = unserialize(__dispy_job_args)
+            if __dispy_job_after_args:
+                __dispy_job_args = tuple(__dispy_job_args) + \
+                    tuple(unserialize(__dispy_job_after_args))
+            __dispy_job_kwargs = unserialize(__dispy_job_kwargs)
+            __dispy_job_globals['__dispy_job_info'] = __dispy_job_info
+            __dispy_job_reply.result = __dispy_job_globals[__dispy_job_name](
+                *__dispy_job_args, **__dispy_job_kwargs)
+            __dispy_job_reply.status = DispyJob.Finished
+        except:
+            __dispy_job_reply.exception = traceback.format_exc()
+            __dispy_job_reply.status = DispyJob.Terminated
+        __dispy_job_reply.stdout = sys.stdout.getvalue()
+        __dispy_job_reply.stderr = sys.stderr.getvalue()
+        __dispy_job_reply.end_time = time.time()
+        if __dispy_job_info.capture_output != 'memory':
+            sys.stdout.close()
+            sys.stderr.close()
+        __dispy_reply_file = _dispy_reply_file(__dispy_job_reply, __dispy_job_info,
+                                               __dispy_path, __dispy_pickle)
+        # don't let TERMINATE_JOB kill this process while reply is
+        # being written, as that would leave reply_Q in invalid state
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            if __dispy_reply_file:
+                __dispy_reply_Q.put((__dispy_job_reply, __dispy_reply_file))
+            else:
+                __dispy_reply_Q.put(__dispy_job_reply)
+        except:
+            # result can't be pickled
+            __dispy_job_reply.result = None
+            __dispy_job_reply.exception = traceback.format_exc()
+            __dispy_job_reply.status = DispyJob.Terminated
+            __dispy_reply_Q.put(__dispy_job_reply)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        __dispy_job_args = __dispy_job_kwargs = __dispy_job_reply = __dispy_job = None
+        __dispy_job_globals['__dispy_job_info'] = __dispy_job_info = None
+
+    if __dispy_worker_cleanup and not __dispy_code_error:
+        try:
+            __dispy_job_globals[__dispy_worker_cleanup.name](
+                *__dispy_worker_cleanup.args, **__dispy_worker_cleanup.kwargs)
+        except:
+            logger.debug('worker_cleanup "%s" failed', __dispy_worker_cleanup.name)
+            logger.debug(traceback.format_exc())
+
+
+def _dispy_thread_worker_func(__dispy_job_name, __dispy_job_code, __dispy_job_globals,
+                              __dispy_worker_setup, __dispy_worker_cleanup,
+                              __dispy_job_certfile, __dispy_job_keyfile, __dispy_path,
+                              __dispy_job_conn, __dispy_reply_Q):
+    """Internal use only.
+
+    Worker process for computation with exec_mode 'thread': jobs sent
+    to it are executed in a pool of threads of this process, sharing
+    computation (loaded once); output of each job is captured
+    separately.
+    """
+
+    if os.name == 'nt' or __name__ == '__mp_main__':
+        # not forked from dispynode (Windows or forkserver)
         __dispy_job_globals.update(globals())
+    else:
+        _dispy_close_sockets()
     os.chdir(__dispy_path)
-    sys.stdout = io.StringIO()
-    sys.stderr = io.StringIO()
-    __dispy_job_reply = __dispy_job_info.job_reply
+    # these may be replaced with computation's globals below
+    __dispy_StringIO = io.StringIO
+    __dispy_pickle = pickle
+    __dispy_queue = queue
+    __dispy_threading = threading
+    __dispy_Output = _DispyOutput
+    __dispy_ThreadOutput = _DispyThreadOutput
     try:
-        exec(marshal.loads(__dispy_job_code[0]), __dispy_job_globals)
-        if __dispy_job_code[1]:
-            exec(__dispy_job_code[1], __dispy_job_globals)
-        globals().update(__dispy_job_globals)
-        if __name__ == '__mp_main__':  # Windows multiprocessing process
-            sys.modules['__mp_main__'].__dict__.update(__dispy_job_globals)
-        __dispy_job_args = unserialize(__dispy_job_args)
-        __dispy_job_kwargs = unserialize(__dispy_job_kwargs)
-        __dispy_job_globals.update(locals())
-        exec('__dispy_job_reply.result = %s(*__dispy_job_args, **__dispy_job_kwargs)' %
-             __dispy_job_name, __dispy_job_globals)
-        __dispy_job_reply.status = DispyJob.Finished
+        exec(marshal.loads(__dispy_job_code), __dispy_job_globals)
     except:
-        __dispy_job_reply.exception = traceback.format_exc()
-        __dispy_job_reply.status = DispyJob.Terminated
-    __dispy_job_reply.stdout = sys.stdout.getvalue()
-    __dispy_job_reply.stderr = sys.stderr.getvalue()
-    __dispy_job_reply.end_time = time.time()
-    __dispy_job_info.proc = None
-    signal.signal(signal.SIGTERM, signal.SIG_IGN)
-    __dispy_reply_Q.put(__dispy_job_reply)
+        __dispy_code_error = traceback.format_exc()
+    else:
+        __dispy_code_error = None
+    globals().update(__dispy_job_globals)
+    if __name__ == '__mp_main__':  # Windows / forkserver multiprocessing process
+        sys.modules['__mp_main__'].__dict__.update(__dispy_job_globals)
+    __dispy_job_globals['__dispy_job_certfile'] = __dispy_job_certfile
+    __dispy_job_globals['__dispy_job_keyfile'] = __dispy_job_keyfile
+    # job info (for 'dispy_provisional_result' etc.) of each thread
+    __dispy_thread_info = __dispy_threading.local()
+    __dispy_job_globals['__dispy_job_info'] = __dispy_thread_info
+    if __dispy_worker_setup and not __dispy_code_error:
+        try:
+            assert __dispy_job_globals[__dispy_worker_setup.name](
+                *__dispy_worker_setup.args, **__dispy_worker_setup.kwargs) == 0
+        except:
+            __dispy_code_error = traceback.format_exc()
+            __dispy_worker_cleanup = None
+            logger.warning('worker_setup "%s" failed', __dispy_worker_setup.name)
+    sys.stdout = __dispy_ThreadOutput(sys.stdout)
+    sys.stderr = __dispy_ThreadOutput(sys.stderr)
+    # hashes of job dependency code loaded; code that fails to load is
+    # loaded again with next job that needs it
+    __dispy_code_hashes = set()
+    __dispy_code_lock = __dispy_threading.Lock()
+    __dispy_jobs_Q = __dispy_queue.Queue()
+
+    def __dispy_run_job(job_info, args, kwargs, after_args, job_code, code_hash):
+        reply = job_info.job_reply
+        if job_info.capture_output == 'memory':
+            sys.stdout.capture(__dispy_StringIO())
+            sys.stderr.capture(__dispy_StringIO())
+        else:
+            sys.stdout.capture(__dispy_Output('stdout', job_info, __dispy_job_keyfile,
+                                              __dispy_job_certfile))
+            sys.stderr.capture(__dispy_Output('stderr', job_info, __dispy_job_keyfile,
+                                              __dispy_job_certfile))
+        try:
+            if __dispy_code_error:
+                raise Exception(__dispy_code_error)
+            if job_code and code_hash not in __dispy_code_hashes:
+                with __dispy_code_lock:
+                    if code_hash not in __dispy_code_hashes:
+                        exec(marshal.loads(job_code), __dispy_job_globals)
+                        if code_hash:
+                            __dispy_code_hashes.add(code_hash)
+            args = unserialize(args)
+            if after_args:
+                args = tuple(args) + tuple(unserialize(after_args))
+            kwargs = unserialize(kwargs)
+            __dispy_thread_info.job_reply = reply
+            __dispy_thread_info.reply_addr = job_info.reply_addr
+            __dispy_thread_info.broadcasts = job_info.broadcasts
+            reply.result = __dispy_job_globals[__dispy_job_name](*args, **kwargs)
+            reply.status = DispyJob.Finished
+        except:
+            reply.exception = traceback.format_exc()
+            reply.status = DispyJob.Terminated
+        __dispy_thread_info.job_reply = None
+        reply.stdout = sys.stdout.release()
+        reply.stderr = sys.stderr.release()
+        reply.end_time = time.time()
+        # as with other workers, dispynode sends reply (after it
+        # releases job's cpu, so client can send next job right away);
+        # large results are passed in files, others through reply_Q
+        reply_file = _dispy_reply_file(reply, job_info, __dispy_path, __dispy_pickle)
+        try:
+            if reply_file:
+                __dispy_reply_Q.put((reply, reply_file))
+            else:
+                __dispy_reply_Q.put(reply)
+        except:
+            # result can't be pickled
+            reply.result = None
+            reply.exception = traceback.format_exc()
+            reply.status = DispyJob.Terminated
+            __dispy_reply_Q.put(reply)
+
+    def __dispy_job_thread():
+        while True:
+            job = __dispy_jobs_Q.get()
+            if job is None:
+                break
+            __dispy_run_job(*job)
+            with __dispy_threads_lock:
+                __dispy_threads[1] += 1
+
+    # threads and number of idle threads among them
+    __dispy_threads = [[], 0]
+    __dispy_threads_lock = __dispy_threading.Lock()
+    while True:
+        try:
+            __dispy_job = __dispy_job_conn.recv()
+        except:
+            break
+        if __dispy_job is None:
+            break
+        with __dispy_threads_lock:
+            if __dispy_threads[1]:
+                __dispy_threads[1] -= 1
+                __dispy_thread = None
+            else:
+                __dispy_thread = __dispy_threading.Thread(target=__dispy_job_thread)
+                __dispy_thread.daemon = True
+                __dispy_threads[0].append(__dispy_thread)
+        if __dispy_thread:
+            __dispy_thread.start()
+        __dispy_jobs_Q.put(__dispy_job)
+        __dispy_job = __dispy_thread = None
+
+    # running jobs finish before worker_cleanup
+    for __dispy_thread in __dispy_threads[0]:
+        __dispy_jobs_Q.put(None)
+    for __dispy_thread in __dispy_threads[0]:
+        __dispy_thread.join()
+    if __dispy_worker_cleanup and not __dispy_code_error:
+        try:
+            __dispy_job_globals[__dispy_worker_cleanup.name](
+                *__dispy_worker_cleanup.args, **__dispy_worker_cleanup.kwargs)
+        except:
+            logger.debug('worker_cleanup "%s" failed', __dispy_worker_cleanup.name)
+            logger.debug(traceback.format_exc())
+
+
+def _dispy_program_worker_func(program, certfile, keyfile, path, conn, reply_Q):
+    """Internal use only.
+
+    Runs Python program (computation with 'program_worker') for jobs
+    in this worker process with 'runpy', so Python interpreter and
+    modules imported by program are loaded once for many jobs.
+    """
+    import runpy
+    if os.name != 'nt' and __name__ != '__mp_main__':
+        _dispy_close_sockets()
+    sys.path.insert(0, path)
+    os.environ['PATH'] = path + os.pathsep + os.environ['PATH']
+    argv = sys.argv
+    while True:
+        try:
+            job = conn.recv()
+        except:
+            break
+        if job is None:
+            break
+        job_info, args, kwargs, after_args, job_code = job
+        reply = job_info.job_reply
+        if job_info.capture_output == 'memory':
+            sys.stdout = io.StringIO()
+            sys.stderr = io.StringIO()
+        else:
+            sys.stdout = _DispyOutput('stdout', job_info, keyfile, certfile, empty=b'')
+            sys.stderr = _DispyOutput('stderr', job_info, keyfile, certfile, empty=b'')
+        try:
+            os.chdir(path)
+            sys.argv = [program] + list(unserialize(args))
+            if after_args:
+                sys.argv.extend(unserialize(after_args))
+            runpy.run_path(program, run_name='__main__')
+            reply.result = 0
+        except SystemExit as exc:
+            # exit status is same as that of Python interpreter
+            if exc.code is None:
+                reply.result = 0
+            elif isinstance(exc.code, int):
+                reply.result = exc.code
+            else:
+                sys.stderr.write('%s\n' % exc.code)
+                reply.result = 1
+        except:
+            sys.stderr.write(traceback.format_exc())
+            reply.result = 1
+        sys.argv = argv
+        reply.status = DispyJob.Finished
+        reply.stdout = sys.stdout.getvalue()
+        reply.stderr = sys.stderr.getvalue()
+        if job_info.capture_output == 'memory':
+            # output of programs is bytes, as when they are run in own process
+            reply.stdout = reply.stdout.encode('utf-8', 'replace')
+            reply.stderr = reply.stderr.encode('utf-8', 'replace')
+        sys.stdout.close()
+        sys.stderr.close()
+        reply.end_time = time.time()
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            reply_Q.put(reply)
+        except:
+            logger.warning('Could not send reply for job %s', reply.uid)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        job = job_info = reply = None
 
 
 class _DispyNode(object):
@@ -211,9 +1118,27 @@ class _DispyNode(object):
     def __init__(self, cpus, ip_addr=None, ext_ip_addr=None, node_port=None,
                  name='', scheduler_node=None, scheduler_port=None,
                  dest_path_prefix='', clean=False, secret='', keyfile=None, certfile=None,
-                 zombie_interval=60, service_start=None, service_end=None):
+                 zombie_interval=60, service_start=None, service_end=None, max_worker_jobs=0,
+                 preload=[], forkserver=False, affinity=None, cores_per_job=1, overcommit=0,
+                 resend_rate=0, disk_budget=0, max_saved_results=0):
         assert 0 < cpus <= multiprocessing.cpu_count()
-        self.num_cpus = cpus
+        if cores_per_job < 1 or cores_per_job > cpus:
+            raise Exception('cores_per_job must be between 1 and %s' % cpus)
+        # each job reserves 'cores_per_job' cpus
+        self.num_cpus = cpus // cores_per_job
+        if affinity:
+            if affinity not in ('spread', 'pack'):
+                raise Exception('invalid affinity "%s"' % affinity)
+            if not sys.platform.startswith('linux'):
+                raise Exception('affinity is supported only on Linux')
+            self.cpu_slots = _DispyCPUSlots(affinity, cpus, cores_per_job)
+            numa_nodes = self.cpu_slots.numa_nodes
+        else:
+            self.cpu_slots = None
+            numa_nodes = _dispy_numa_nodes()
+        # sent to clients (available as 'topology' of DispyNode)
+        self.topology = {'numa_nodes': numa_nodes, 'affinity': affinity,
+                         'cores_per_job': cores_per_job}
         if name:
             self.name = name
         else:
@@ -253,6 +1178,10 @@ class _DispyNode(object):
             self.certfile = os.path.abspath(self.certfile)
 
         self.asyncoro = AsynCoro()
+        # disk I/O (transferred files, saved results etc.) is done in
+        # these threads so coroutines are not blocked
+        self.io_pool = asyncoro.AsyncThreadPool(IOThreads)
+        self.loop_latency = _LoopLatency(threshold=1.0, log=logger)
 
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self.certfile:
@@ -272,11 +1201,56 @@ class _DispyNode(object):
         if not os.path.isdir(self.dest_path_prefix):
             os.makedirs(self.dest_path_prefix)
             os.chmod(self.dest_path_prefix, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        # if files under dest_path_prefix use more than 'disk_budget'
+        # bytes, cached files are removed (least recently used first);
+        # if saved results use more than 'max_saved_results' bytes,
+        # oldest results are discarded
+        self.disk_budget = disk_budget
+        self.max_saved_results = max_saved_results
+        self.disk_usage = 0
+        # None if disk usage is not being checked, True if it should be
+        # checked again after current check
+        self.disk_check = None
 
         self.avail_cpus = self.num_cpus
+        # jobs accepted when all cpus are busy wait in run queue (of
+        # each computation, indexed by compute id) for a cpu
+        self.overcommit = overcommit
+        self.run_queue = {}
+        self.queued_jobs = 0
+        # jobs are started from run queues with stride scheduling: each
+        # computation's pass advances by 1 / weight for each job started
+        self.run_pass = {}
+        self.run_vtime = 0
         self.computations = {}
         self.file_uses = {}
+        # files of computations with 'cleanup=False' that are not used
+        # anymore (kept so they can be reused), in LRU order, with sizes
+        self.cached_files = collections.OrderedDict()
         self.job_infos = {}
+        # results that could not be sent to clients, indexed by
+        # computation's dest_path
+        self.result_stores = {}
+        # dest_path of computations whose results are being resent
+        self.resending = set()
+        # number of results being saved (in I/O threads), indexed by dest_path
+        self.saving_results = {}
+        # computations not running anymore, but with results to be
+        # sent, loaded from their files; indexed by compute id
+        self.saved_computations = {}
+        self.state_lock = threading.Lock()
+        # compiled (and marshalled) code of computations, indexed by
+        # hash of their source
+        self.code_cache = collections.OrderedDict()
+        self.code_cache_hits = self.code_cache_misses = 0
+        self.resend_rate = resend_rate
+        # worker processes for each computation, indexed by compute id
+        self.workers = {}
+        # computations executed in threads, indexed by compute id
+        self.thread_workers = {}
+        # data broadcast for computations, indexed by compute id
+        self.broadcasts = {}
+        self.max_worker_jobs = max_worker_jobs
         self.terminate = False
         self.sign = ''.join(hex(x)[2:] for x in os.urandom(10))
         self.secret = secret
@@ -299,8 +1273,29 @@ class _DispyNode(object):
         # load modules from current working directory
         sys.path.insert(0, '.')
 
-        # start a process so all modules needed by dispynode are loaded
-        proc = multiprocessing.Process(target=functools.partial(int), args=(42,))
+        if forkserver:
+            # worker processes are forked from a (small) server process
+            # with dispynode and 'preload' modules loaded, instead of
+            # from this process
+            if os.name == 'nt' or 'forkserver' not in multiprocessing.get_all_start_methods():
+                raise Exception('forkserver is not supported on this platform')
+            self.mp_context = multiprocessing.get_context('forkserver')
+            # worker processes (re)load dispynode, which is quick once
+            # modules it uses are loaded in forkserver
+            self.mp_context.set_forkserver_preload(['__main__', 'dispy', 'asyncoro'] +
+                                                   list(preload))
+        else:
+            self.mp_context = multiprocessing
+            # worker processes forked from this process share these modules
+            for module in preload:
+                __import__(module)
+        # computations' global variables are inherited by worker
+        # processes only if they are forked from this process
+        self.fork_workers = os.name != 'nt' and not forkserver
+
+        # start a process so all modules needed by dispynode are
+        # loaded (and forkserver is started, if used)
+        proc = self.mp_context.Process(target=functools.partial(int), args=(42,))
         proc.start()
         proc.join()
 
@@ -309,14 +1304,22 @@ class _DispyNode(object):
         self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.udp_sock.bind(('', node_port))
         logger.info('serving %s cpus at %s:%s', self.num_cpus, self.ext_ip_addr, node_port)
+        if self.cpu_slots:
+            logger.info('jobs are pinned to cpus (%s): %s', affinity,
+                        ', '.join(','.join(str(cpu) for cpu in cpus)
+                                  for numa_node, cpus in self.cpu_slots.slots))
         logger.debug('tcp server at %s:%s', self.address[0], self.address[1])
         self.udp_sock = AsyncSocket(self.udp_sock)
 
-        self.reply_Q = multiprocessing.Queue()
+        # replies are written synchronously so a worker can't be
+        # terminated with a partially written reply
+        self.reply_Q = self.mp_context.SimpleQueue()
         self.reply_Q_thread = threading.Thread(target=self.__reply_Q)
         self.reply_Q_thread.start()
 
         self.timer_coro = Coro(self.timer_task)
+        Coro(self.worker_monitor_task)
+        Coro(self.check_disk_task)
         if isinstance(service_start, time.struct_time) and isinstance(service_end, time.struct_time):
             self.service_start = (service_start.tm_hour, service_start.tm_min)
             self.service_end = (service_end.tm_hour, service_end.tm_min)
@@ -328,8 +1331,9 @@ class _DispyNode(object):
 
         self.__init_code = ''.join(inspect.getsource(dispy_provisional_result))
         self.__init_code += ''.join(inspect.getsource(dispy_send_file))
+        self.__init_code += ''.join(inspect.getsource(dispy_broadcast))
         self.__init_modules = dict(sys.modules)
-        if os.name == 'nt':
+        if not self.fork_workers:
             self.__init_globals = dict(globals())
 
     def broadcast_ping_msg(self, coro=None):
@@ -365,6 +1369,7 @@ class _DispyNode(object):
         if info.get('sign', None):
             pong_msg = {'ip_addr': self.ext_ip_addr, 'port': self.port, 'sign': self.sign,
                         'version': _dispy_version, 'name': self.name, 'cpus': self.num_cpus,
+                        'overcommit': self.overcommit, 'topology': self.topology,
                         'auth': auth_code(self.secret, info['sign'])}
             for scheduler_ip_addr in scheduler_ip_addrs:
                 addr = (scheduler_ip_addr, scheduler_port)
@@ -476,7 +1481,8 @@ class _DispyNode(object):
                                  compute.scheduler_ip_addr, compute.scheduler_port,
                                  self.scheduler['ip_addr'], self.scheduler['port'])
                     compute = None
-            if self.avail_cpus == 0:
+            if compute is not None and not self._cpu_available(compute) and \
+               self.queued_jobs >= self.overcommit:
                 logger.warning('All cpus busy')
                 try:
                     yield conn.send_msg(b'NAK (all cpus busy)')
@@ -504,33 +1510,41 @@ class _DispyNode(object):
             logger.debug('New job id %s from %s/%s', _job.uid, addr[0], compute.scheduler_ip_addr)
 
             if compute.type == _Compute.func_type:
+                code_hash = getattr(_job, 'code_hash', None)
+                job_code = compute.job_codes.get(code_hash, None)
+                code_error = None
+                if job_code is None and _job.code:
+                    try:
+                        job_code = marshal.dumps(compile(_job.code, '<string>', 'exec'))
+                    except:
+                        code_error = traceback.format_exc()
+                    else:
+                        if code_hash:
+                            compute.job_codes[code_hash] = job_code
+                elif job_code is None and code_hash:
+                    # client assumes code is already here; ask for it
+                    try:
+                        yield conn.send_msg(b'NAK (job code)')
+                    except:
+                        pass
+                    raise StopIteration
+
                 reply = _JobReply(_job, self.ext_ip_addr)
-                reply.start_time = time.time()
                 job_info = _DispyJobInfo(reply, reply_addr, compute, _job.xfer_files)
-
-                args = (job_info, self.certfile, self.keyfile, compute.name,
-                        _job.args, _job.kwargs, (compute.code, _job.code),
-                        compute.globals, compute.dest_path, self.reply_Q)
                 try:
                     yield conn.send_msg(b'ACK')
                 except:
                     logger.warning('Failed to send response for new job to %s', str(addr))
                     raise StopIteration
-                job_info.job_reply.status = DispyJob.Running
-                job_info.proc = multiprocessing.Process(target=_dispy_job_func, args=args)
-                self.avail_cpus -= 1
                 compute.pending_jobs += 1
                 self.thread_lock.acquire()
                 self.job_infos[_job.uid] = job_info
                 self.thread_lock.release()
-                try:
-                    job_info.proc.start()
-                except:
-                    job_info.job_reply.status = DispyJob.Terminated
-                    job_info.job_reply.exception = traceback.format_exc()
-                    job_info.job_reply.end_time = time.time()
-                    job_info.proc = None
-                    self.reply_Q.put(job_info.job_reply)
+                # cpu may have been taken while sending ACK
+                if self._cpu_available(compute):
+                    self._start_job(compute, _job, job_info, code_hash, job_code, code_error)
+                else:
+                    self._queue_job(compute, (_job, job_info, code_hash, job_code, code_error))
                 raise StopIteration
             elif compute.type == _Compute.prog_type:
                 try:
@@ -539,16 +1553,15 @@ class _DispyNode(object):
                     logger.warning('Failed to send response for new job to %s', str(addr))
                     raise StopIteration
                 reply = _JobReply(_job, self.ext_ip_addr)
-                reply.start_time = time.time()
                 job_info = _DispyJobInfo(reply, reply_addr, compute, _job.xfer_files)
-                job_info.job_reply.status = DispyJob.Running
                 self.thread_lock.acquire()
                 self.job_infos[_job.uid] = job_info
                 self.thread_lock.release()
-                self.avail_cpus -= 1
                 compute.pending_jobs += 1
-                prog_thread = threading.Thread(target=self.__job_program, args=(_job, job_info))
-                prog_thread.start()
+                if self._cpu_available(compute):
+                    self._start_job(compute, _job, job_info)
+                else:
+                    self._queue_job(compute, (_job, job_info, None, None, None))
                 raise StopIteration
             else:
                 try:
@@ -621,23 +1634,39 @@ class _DispyNode(object):
             setattr(compute, 'pending_results', 0)
             setattr(compute, 'zombie', False)
             setattr(compute, 'globals', {})
+            # compiled code of job dependencies, indexed by hash
+            setattr(compute, 'job_codes', {})
+            setattr(compute, 'broadcasts', {})
 
             if compute.code:
-                try:
-                    code = compute.code
-                    code += self.__init_code
-                    code = compile(code, '<string>', 'exec')
-                except:
-                    print(traceback.format_exc())
-                    logger.warning('Computation "%s" could not be compiled', compute.name)
-                    if os.path.isdir(compute.dest_path):
-                        os.rmdir(compute.dest_path)
+                # compiled code is cached, so computations created again
+                # (e.g., by same client) are not compiled again
+                code_hash = hashlib.sha1(compute.code.encode('utf-8')).hexdigest()
+                code = self.code_cache.pop(code_hash, None)
+                if code is None:
+                    self.code_cache_misses += 1
                     try:
-                        yield conn.send_msg(b'NAK (Compilation failed)')
+                        code = compute.code
+                        code += self.__init_code
+                        code = compile(code, '<string>', 'exec')
                     except:
-                        logger.warning('Failed to send reply to %s', str(addr))
-                    raise StopIteration
-                compute.code = marshal.dumps(code)
+                        print(traceback.format_exc())
+                        logger.warning('Computation "%s" could not be compiled', compute.name)
+                        if os.path.isdir(compute.dest_path):
+                            os.rmdir(compute.dest_path)
+                        try:
+                            yield conn.send_msg(b'NAK (Compilation failed)')
+                        except:
+                            logger.warning('Failed to send reply to %s', str(addr))
+                        raise StopIteration
+                    code = marshal.dumps(code)
+                else:
+                    self.code_cache_hits += 1
+                    logger.debug('Using cached code for computation "%s"', compute.name)
+                self.code_cache[code_hash] = code
+                if len(self.code_cache) > CodeCacheSize:
+                    self.code_cache.popitem(last=False)
+                compute.code = code
 
             if compute.type == _Compute.prog_type:
                 compute.name = os.path.join(compute.dest_path, os.path.basename(compute.name))
@@ -657,12 +1686,11 @@ class _DispyNode(object):
                     self.pulse_interval = 10 * 60
                 if self.zombie_interval:
                     self.pulse_interval = num_min(self.pulse_interval, self.zombie_interval / 5.0)
-                fd = open(os.path.join(self.dest_path_prefix,
-                                       '%s_%s' % (compute.id, compute.auth)), 'wb')
-                pickle.dump(compute, fd)
-                fd.close()
-
                 try:
+                    yield self.io_pool.async_task(
+                        _write_file, os.path.join(self.dest_path_prefix,
+                                                  '%s_%s' % (compute.id, compute.auth)),
+                        pickle.dumps(compute))
                     yield conn.send_msg(resp)
                 except:
                     del self.computations[compute.id]
@@ -677,7 +1705,7 @@ class _DispyNode(object):
                     # to compute.globals; but in Windows
                     # compute.globals can't be passed via
                     # multiprocessing.Process
-                    if os.name == 'nt':
+                    if not self.fork_workers:
                         compute.globals = {}
                     else:
                         for var in ('AsyncSocket', 'DispyJob', 'serialize', '_XferFile',
@@ -711,6 +1739,7 @@ class _DispyNode(object):
                     self.file_uses[tgt] += 1
                 else:
                     self.file_uses[tgt] = 1
+                self.cached_files.pop(tgt, None)
                 resp = b'ACK'
             else:
                 resp = b'NAK'
@@ -718,19 +1747,26 @@ class _DispyNode(object):
             yield conn.send_msg(resp)
             if resp != b'ACK':
                 logger.debug('Copying file %s to %s (%s)', xf.name, tgt, xf.stat_buf.st_size)
+                self.cached_files.pop(tgt, None)
+                if self.disk_budget and not self._evict_cached_files(xf.stat_buf.st_size):
+                    logger.warning('Disk usage (%s bytes) exceeds budget (%s bytes)',
+                                   self.disk_usage + xf.stat_buf.st_size, self.disk_budget)
                 try:
-                    fd = open(tgt, 'wb')
+                    fd = yield self.io_pool.async_task(open, tgt, 'wb')
                     n = 0
-                    while n < xf.stat_buf.st_size:
-                        data = yield conn.recvall(min(xf.stat_buf.st_size-n, 1024000))
-                        if not data:
-                            break
-                        fd.write(data)
-                        n += len(data)
-                        if MaxFileSize and n > MaxFileSize:
-                            logger.warning('File "%s" is too big (%s); it is truncated', tgt, n)
-                            break
-                    fd.close()
+                    try:
+                        while n < xf.stat_buf.st_size:
+                            data = yield conn.recvall(min(xf.stat_buf.st_size-n, 1024000))
+                            if not data:
+                                break
+                            yield self.io_pool.async_task(fd.write, data)
+                            n += len(data)
+                            if MaxFileSize and n > MaxFileSize:
+                                logger.warning('File "%s" is too big (%s); it is truncated',
+                                               tgt, n)
+                                break
+                    finally:
+                        yield self.io_pool.async_task(fd.close)
                     if n < xf.stat_buf.st_size:
                         resp = b'NAK (read only %s bytes)' % n
                     else:
@@ -738,6 +1774,7 @@ class _DispyNode(object):
                         logger.debug('Copied file %s, %s', tgt, resp)
                         os.utime(tgt, (xf.stat_buf.st_atime, xf.stat_buf.st_mtime))
                         os.chmod(tgt, stat.S_IMODE(xf.stat_buf.st_mode))
+                        self.disk_usage += n
                         if tgt in self.file_uses:
                             self.file_uses[tgt] += 1
                         else:
@@ -752,6 +1789,86 @@ class _DispyNode(object):
                     logger.debug('Could not send reply for "%s"', xf.name)
             raise StopIteration  # xfer_file_task
 
+        def broadcast_task(msg):
+            try:
+                req = unserialize(msg)
+                compute = self.computations[req['compute_id']]
+                assert compute.auth == req['auth'] and not compute.zombie
+                bc = _DispyBroadcast(req['name'], req['size'], req['kind'], req['meta'],
+                                     compute.dest_path)
+            except:
+                logger.warning('Ignoring broadcast request from %s', addr[0])
+                logger.debug(traceback.format_exc())
+                try:
+                    yield conn.send_msg(b'NAK')
+                except:
+                    pass
+                raise StopIteration
+            try:
+                yield conn.send_msg(b'ACK')
+                n = 0
+                while n < bc.size:
+                    data = yield conn.recvall(min(bc.size - n, 1024000))
+                    if not data:
+                        break
+                    bc.write(n, data)
+                    n += len(data)
+                assert n == bc.size
+                desc = bc.desc()
+            except:
+                logger.warning('Receiving broadcast "%s" failed', bc.name)
+                bc.close()
+                raise StopIteration
+            bcs = self.broadcasts.setdefault(compute.id, {})
+            if bc.name in bcs:
+                # running jobs may still use old data (until their
+                # workers are done)
+                bcs[bc.name].close()
+            bcs[bc.name] = bc
+            compute.broadcasts[bc.name] = desc
+            logger.debug('Received broadcast "%s" (%s bytes) for "%s"',
+                         bc.name, bc.size, compute.name)
+            try:
+                yield conn.send_msg(b'ACK')
+            except:
+                logger.debug('Could not send reply for broadcast "%s"', bc.name)
+
+        def retrieve_output_task(msg):
+            # generator
+            try:
+                req = unserialize(msg)
+                compute = self.computations[req['compute_id']]
+                assert compute.auth == req['auth']
+                paths = [os.path.join(compute.dest_path, '_dispy_job_%s_%s' % (name, req['uid']))
+                         for name in ('stdout', 'stderr')]
+                sizes = [os.path.getsize(path) for path in paths]
+            except:
+                logger.debug('Ignoring output request from %s', addr[0])
+                try:
+                    yield conn.send_msg(serialize(None))
+                except:
+                    pass
+                raise StopIteration
+            try:
+                yield conn.send_msg(serialize(sizes))
+                for path, size in zip(paths, sizes):
+                    # file is read in I/O threads
+                    fd = yield self.io_pool.async_task(open, path, 'rb')
+                    try:
+                        n = 0
+                        while n < size:
+                            data = yield self.io_pool.async_task(fd.read,
+                                                                 min(size - n, 1024000))
+                            if not data:
+                                break
+                            yield conn.sendall(data)
+                            n += len(data)
+                    finally:
+                        fd.close()
+                    assert n == size
+            except:
+                logger.warning('Could not send output of job %s', req['uid'])
+
         def setup_computation(msg):
             try:
                 compute_id = unserialize(msg)
@@ -759,17 +1876,23 @@ class _DispyNode(object):
                 assert isinstance(compute.setup, _Function)
                 os.chdir(compute.dest_path)
                 localvars = {'_dispy_setup_args': compute.setup.args,
-                             '_dispy_setup_kwargs': compute.setup.kwargs}
-                if os.name == 'nt':
-                    globalvars = globals()
-                else:
+                             '_dispy_setup_kwargs': compute.setup.kwargs}
+                if self.fork_workers:
                     globalvars = compute.globals
+                else:
+                    globalvars = globals()
                 exec(marshal.loads(compute.code), globalvars, localvars)
                 exec('assert %s(*_dispy_setup_args, **_dispy_setup_kwargs) == 0' %
                      compute.setup.name, globalvars, localvars)
-                if os.name == 'nt':
-                    compute.globals.update({var: globals()[var] for var in globals()
-                                            if var not in self.__init_globals})
+                if not self.fork_workers:
+                    # variables are sent to worker processes, which
+                    # define functions and classes with computation's
+                    # code
+                    compute.globals.update({var: value for var, value in globals().items()
+                                            if var not in self.__init_globals and
+                                            not (inspect.isfunction(value) or
+                                                 inspect.isclass(value) or
+                                                 inspect.ismodule(value))})
             except:
                 logger.debug('Setup failed')
                 resp = traceback.format_exc().encode()
@@ -783,11 +1906,29 @@ class _DispyNode(object):
             yield conn.send_msg(resp)
 
         def terminate_job_task(compute, job_info):
+            if job_info.queued:
+                # job hasn't started yet; remove it from run queue
+                run_queue = self.run_queue.get(compute.id, None)
+                if run_queue:
+                    for item in run_queue:
+                        if item[1] == job_info:
+                            run_queue.remove(item)
+                            self.queued_jobs -= 1
+                            break
+                    else:
+                        raise StopIteration
+                    if not run_queue:
+                        del self.run_queue[compute.id]
+                        del self.run_pass[compute.id]
+                    job_info.job_reply.start_time = job_info.job_reply.end_time = time.time()
+                    job_info.job_reply.status = DispyJob.Terminated
+                    self.reply_Q.put(job_info.job_reply)
+                raise StopIteration
             if not job_info.proc:
                 raise StopIteration
             logger.debug('Terminating job %s of "%s"', job_info.job_reply.uid, compute.name)
             job_info.proc.terminate()
-            if isinstance(job_info.proc, multiprocessing.Process):
+            if isinstance(job_info.proc, multiprocessing.process.BaseProcess):
                 for x in range(20):
                     if job_info.proc.is_alive():
                         yield coro.sleep(0.1)
@@ -813,10 +1954,11 @@ class _DispyNode(object):
                 else:
                     logger.warning('Could not kill process %s', compute.name)
                     raise StopIteration
-            job_info.job_reply.end_time = time.time()
             job_info.proc = None
             self.thread_lock.acquire()
-            if self.job_infos.get(job_info.job_reply.uid, None) == job_info:
+            if self.job_infos.get(job_info.job_reply.uid, None) == job_info and \
+               job_info.job_reply.status == DispyJob.Running:
+                job_info.job_reply.end_time = time.time()
                 job_info.job_reply.status = DispyJob.Terminated
                 self.reply_Q.put(job_info.job_reply)
             self.thread_lock.release()
@@ -841,46 +1983,64 @@ class _DispyNode(object):
                 yield send_reply(None)
                 raise StopIteration
 
-            pkl_path = os.path.join(self.dest_path_prefix, '%s_%s' % (compute_id, auth))
             compute = self.computations.get(compute_id, None)
             if not compute:
-                fd = open(pkl_path, 'rb')
-                compute = pickle.load(fd)
-                fd.close()
+                compute = self._load_computation(compute_id, auth)
             if not compute or compute.auth != auth:
                 yield send_reply(None)
                 raise StopIteration
 
-            info_file = os.path.join(compute.dest_path, '_dispy_job_reply_%s' % uid)
-            if not os.path.isfile(info_file):
-                yield send_reply(None)
-                raise StopIteration
+            store = self._result_store(compute.dest_path)
             try:
-                fd = open(info_file, 'rb')
-                job_reply = pickle.load(fd)
-                fd.close()
+                job_reply, reply_file = yield self.io_pool.async_task(store.get, uid)
                 assert job_reply.hash == job_hash
             except:
                 yield send_reply(None)
                 raise StopIteration
 
             try:
-                yield conn.send_msg(serialize(job_reply))
-                ack = yield conn.recv_msg()
-                assert ack == b'ACK'
-                compute.pending_results -= 1
-                fd = open(pkl_path, 'wb')
-                pickle.dump(compute, fd)
-                fd.close()
+                if reply_file:
+                    # file has serialized reply
+                    yield self._send_reply_file(conn, reply_file, b'', coro=coro)
+                else:
+                    yield conn.send_msg(serialize(job_reply))
+                acked = yield _recv_result_ack(store, uid, conn, compute, addr[0],
+                                               self.io_pool)
             except:
                 pass
             else:
-                try:
-                    os.remove(info_file)
-                except:
-                    pass
-                if compute.pending_results == 0:
-                    self.cleanup_computation(compute)
+                if acked:
+                    yield self._save_pending_state(compute, coro=coro)
+
+        def retrieve_jobs_task(msg):
+            # generator
+            # results of many jobs are sent in one stream, as with
+            # resend_job_results
+            try:
+                req = unserialize(msg)
+                compute_id = req['compute_id']
+                auth = req['auth']
+                jobs = req['jobs']
+            except:
+                yield conn.send_msg(b'NAK')
+                raise StopIteration
+
+            compute = self.computations.get(compute_id, None)
+            if compute is None:
+                compute = self._load_computation(compute_id, auth)
+            if compute is None or compute.auth != auth:
+                yield conn.send_msg(b'NAK')
+                raise StopIteration
+
+            try:
+                count = yield self._send_saved_results(compute, conn, jobs=jobs, coro=coro)
+            except:
+                logger.debug('Could not send results of "%s" to %s: %s', compute.name,
+                             addr[0], traceback.format_exc())
+            else:
+                logger.debug('Sent %s results of "%s" to %s', count, compute.name, addr[0])
+            # computation is saved once for all results sent
+            yield self._save_pending_state(compute, coro=coro)
 
         # tcp_serve_task starts
         try:
@@ -916,6 +2076,10 @@ class _DispyNode(object):
             msg = msg[len(b'SETUP:'):]
             yield setup_computation(msg)
             conn.close()
+        elif msg.startswith(b'BROADCAST:'):
+            msg = msg[len(b'BROADCAST:'):]
+            yield broadcast_task(msg)
+            conn.close()
         elif msg.startswith(b'CLOSE:'):
             msg = msg[len(b'CLOSE:'):]
             try:
@@ -968,13 +2132,7 @@ class _DispyNode(object):
             else:
                 compute = self.computations.get(compute_id, None)
                 if compute is None or compute.auth != auth:
-                    try:
-                        fd = open(os.path.join(self.dest_path_prefix,
-                                               '%s_%s' % (compute_id, auth)), 'rb')
-                        compute = pickle.load(fd)
-                        fd.close()
-                    except:
-                        pass
+                    compute = self._load_computation(compute_id, auth)
                 if compute is None:
                     reply = 0
                 else:
@@ -990,6 +2148,7 @@ class _DispyNode(object):
                     reply = {'ip_addr': self.ext_ip_addr, 'port': self.port,
                              'sign': self.sign, 'version': _dispy_version,
                              'name': self.name, 'cpus': self.num_cpus,
+                             'overcommit': self.overcommit, 'topology': self.topology,
                              'auth': auth_code(self.secret, info['sign'])}
                     reply['scheduler_ip_addr'] = addr[0]
                     yield conn.send_msg(serialize(reply))
@@ -1009,25 +2168,12 @@ class _DispyNode(object):
             else:
                 compute = self.computations.get(compute_id, None)
                 if compute is None or compute.auth != auth:
-                    fd = open(os.path.join(self.dest_path_prefix,
-                                           '%s_%s' % (compute_id, auth)), 'rb')
-                    compute = pickle.load(fd)
-                    fd.close()
+                    compute = self._load_computation(compute_id, auth)
                 if compute is not None:
                     done = []
                     if compute.pending_results:
-                        for result_file in glob.glob(os.path.join(compute.dest_path,
-                                                                  '_dispy_job_reply_*')):
-                            result_file = os.path.basename(result_file)
-                            try:
-                                uid = int(result_file[len('_dispy_job_reply_'):])
-                            except:
-                                pass
-                            else:
-                                done.append(uid)
-                                # limit so as not to take up too much time
-                                if len(done) > 50:
-                                    break
+                        # limit so as not to take up too much time
+                        done = self._result_store(compute.dest_path).uids(limit=1024)
                     reply['done'] = done
                     reply['pending'] = compute.pending_jobs
             yield conn.send_msg(serialize(reply))
@@ -1036,6 +2182,14 @@ class _DispyNode(object):
             msg = msg[len(b'RETRIEVE_JOB:'):]
             yield retrieve_job_task(msg)
             conn.close()
+        elif msg.startswith(b'RETRIEVE_JOBS:'):
+            msg = msg[len(b'RETRIEVE_JOBS:'):]
+            yield retrieve_jobs_task(msg)
+            conn.close()
+        elif msg.startswith(b'RETRIEVE_OUTPUT:'):
+            msg = msg[len(b'RETRIEVE_OUTPUT:'):]
+            yield retrieve_output_task(msg)
+            conn.close()
         else:
             logger.warning('Invalid request "%s" from %s',
                            msg[:min(10, len(msg))], addr[0])
@@ -1046,28 +2200,300 @@ class _DispyNode(object):
                 logger.warning('Failed to send reply to %s', str(addr))
             conn.close()
 
-    def resend_job_results(self, compute, coro=None):
-        # TODO: limit number queued so as not to take up too much space/time
-        if not os.path.isdir(compute.dest_path):
-            raise StopIteration
-        result_files = [f for f in os.listdir(compute.dest_path)
-                        if f.startswith('_dispy_job_reply_')]
-        result_files = result_files[:min(len(result_files), 64)]
-        for result_file in result_files:
-            result_file = os.path.join(compute.dest_path, result_file)
+    def _result_store(self, dest_path):
+        """Internal use only.
+
+        Returns store of pending results of computation with given
+        'dest_path'.
+        """
+        store = self.result_stores.get(dest_path, None)
+        if store is None:
+            store = _ResultStore(os.path.join(dest_path, '_dispy_results.db'))
+            self.result_stores[dest_path] = store
+        return store
+
+    def _send_reply_file(self, sock, path, prefix, coro=None):
+        """Internal use only.
+
+        Sends file 'path' with serialized job reply over 'sock' in
+        parts (framed as with 'send_msg', after 'prefix') to avoid
+        copying it. If file has data of result to be memory mapped by
+        client, reply is sent as message, followed by size of data (8
+        bytes) and data. File is read in I/O threads.
+        """
+        # generator
+        fd = yield self.io_pool.async_task(open, path, 'rb')
+        try:
+            size = os.fstat(fd.fileno()).st_size
+            data = yield self.io_pool.async_task(fd.read, len(MappedResultMagic) + 8)
+            if data.startswith(MappedResultMagic):
+                reply_len = struct.unpack('>Q', data[len(MappedResultMagic):])[0]
+                reply = yield self.io_pool.async_task(fd.read, reply_len)
+                yield sock.send_msg(prefix + reply)
+                size -= len(data) + reply_len
+                yield sock.sendall(struct.pack('>Q', size))
+            else:
+                yield sock.sendall(struct.pack('>L', len(prefix) + size) + prefix + data)
+            while True:
+                data = yield self.io_pool.async_task(fd.read, 1024000)
+                if not data:
+                    break
+                yield sock.sendall(data)
+        finally:
+            fd.close()
+
+    def _send_saved_results(self, compute, sock, jobs=None, coro=None):
+        """Internal use only.
+
+        Sends saved results of computation over 'sock' (see
+        '_send_stored_results'); results saved in files are sent from
+        those files. Returns number of results sent.
+        """
+        # generator
+        def send_reply(job_reply, reply_file):
+            # generator
+            if reply_file:
+                yield self._send_reply_file(sock, reply_file, b'JOB_REPLY:', coro=coro)
+            else:
+                yield sock.send_msg(b'JOB_REPLY:' + serialize(job_reply))
+
+        count = yield _send_stored_results(
+            self._result_store(compute.dest_path), sock, send_reply, compute,
+            compute.scheduler_ip_addr, self.io_pool, jobs=jobs, resend_rate=self.resend_rate,
+            coro=coro)
+        raise StopIteration(count)
+
+    def _load_computation(self, compute_id, auth):
+        """Internal use only.
+
+        Returns computation that is not running anymore (but has
+        results to be sent) or None. The computation is loaded from its
+        pickle file, which is saved only when the computation is added,
+        and its counters from its state file (see '_save_compute_state').
+        """
+        compute = self.saved_computations.get(compute_id, None)
+        if compute is not None and compute.auth == auth:
+            return compute
+        pkl_path = os.path.join(self.dest_path_prefix, '%s_%s' % (compute_id, auth))
+        try:
+            fd = open(pkl_path, 'rb')
+            compute = pickle.load(fd)
+            fd.close()
+        except:
+            return None
+        try:
+            fd = open(pkl_path + '.state', 'rb')
+            state = unserialize(fd.read())
+            fd.close()
+        except:
+            pass
+        else:
+            for name, value in state.items():
+                setattr(compute, name, value)
+        self.saved_computations[compute_id] = compute
+        return compute
+
+    def _save_compute_state(self, compute):
+        """Internal use only.
+
+        Saves counters of computation that is not running anymore in
+        its state file, instead of pickling computation (with its code,
+        files etc.) again; if all its results are sent, its files are
+        removed. May be called in I/O threads.
+        """
+        pkl_path = os.path.join(self.dest_path_prefix, '%s_%s' % (compute.id, compute.auth))
+        # counters are read when saving, so that last save has
+        # current values even if saves finish out of order
+        self.state_lock.acquire()
+        try:
+            if compute.pending_results == 0:
+                for path in (pkl_path + '.state', pkl_path):
+                    if os.path.isfile(path):
+                        os.remove(path)
+            else:
+                state = {'pending_jobs': compute.pending_jobs,
+                         'pending_results': compute.pending_results,
+                         'zombie': compute.zombie, 'last_pulse': compute.last_pulse}
+                _write_file(pkl_path + '.state', serialize(state))
+        finally:
+            self.state_lock.release()
+
+    def _disk_usage(self):
+        """Internal use only.
+
+        Returns number of bytes used by files under
+        'dest_path_prefix'. Called in I/O threads.
+        """
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(self.dest_path_prefix):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except:
+                    pass
+        return size
+
+    def _evict_cached_files(self, size):
+        """Internal use only.
+
+        Removes cached files, least recently used first, until 'size'
+        more bytes can be used within 'disk_budget'. Returns False if
+        that is not possible even after removing all cached files.
+        """
+        while (self.disk_usage + size) > self.disk_budget and self.cached_files:
+            path, nbytes = self.cached_files.popitem(last=False)
+            logger.debug('Removing cached file "%s" (%s bytes)', path, nbytes)
             try:
-                fd = open(result_file, 'rb')
-                job_result = pickle.load(fd)
-                fd.close()
+                os.remove(path)
+                if os.path.splitext(path)[1] == '.py' and os.path.isfile(path + 'c'):
+                    os.remove(path + 'c')
             except:
-                logger.debug('Could not load "%s"', result_file)
-                # logger.debug(traceback.format_exc())
+                if os.path.isfile(path):
+                    logger.warning('Could not remove file "%s"', path)
+                    continue
+            self.disk_usage -= nbytes
+        return (self.disk_usage + size) <= self.disk_budget
+
+    def _discard_saved_results(self, coro=None):
+        """Internal use only.
+
+        If saved results of all computations (including those not
+        running anymore) use more than 'max_saved_results' bytes,
+        oldest results are discarded. Each discarded result is replaced
+        with reply with status 'Terminated' and exception saying why,
+        so client is notified of it when that reply is delivered.
+        """
+        # generator
+        computes = [compute for compute in self.computations.values()
+                    if compute.pending_results]
+        for path in glob.glob(os.path.join(self.dest_path_prefix, '*_*')):
+            # computations not running anymore are saved in files
+            # with name '<id>_<auth>'
+            compute_id, auth = os.path.basename(path).split('_', 1)
+            if not compute_id.isdigit() or not auth.isalnum() or \
+               int(compute_id) in self.computations:
                 continue
-            job_info = _DispyJobInfo(job_result, (compute.scheduler_ip_addr,
-                                                  compute.job_result_port), compute, [])
-            status = yield self._send_job_reply(job_info, resending=True)
-            if status:
-                break
+            compute = self._load_computation(int(compute_id), auth)
+            if compute is not None and compute.pending_results:
+                computes.append(compute)
+        # results being sent or saved are not discarded now
+        stores = [(compute, self._result_store(compute.dest_path)) for compute in computes
+                  if compute.dest_path not in self.resending and
+                  compute.dest_path not in self.saving_results]
+
+        def discard_results():
+            # called in I/O thread; returns number of results
+            # discarded of each computation
+            size = sum(store.nbytes() for compute, store in stores)
+            if size <= self.max_saved_results:
+                return {}
+            results = []
+            for compute, store in stores:
+                results.extend((saved, uid, compute, store)
+                               for saved, uid, nbytes in store.oldest())
+            results.sort(key=lambda result: result[0])
+            discarded = {}
+            for saved, uid, compute, store in results:
+                if size <= self.max_saved_results:
+                    break
+                entry = store.get(uid)
+                if entry is None:
+                    continue
+                job_reply = entry[0]
+                job_reply.result = job_reply.stdout = job_reply.stderr = None
+                job_reply.status = DispyJob.Terminated
+                job_reply.exception = ('Result discarded by node %s as saved results exceed '
+                                       '%s bytes' % (self.ext_ip_addr, self.max_saved_results))
+                size -= store.discard(uid, job_reply)
+                discarded[compute] = discarded.get(compute, 0) + 1
+            return discarded
+
+        if stores:
+            discarded = yield self.io_pool.async_task(discard_results)
+            for compute, count in discarded.items():
+                logger.warning('Discarded %s oldest saved results of computation "%s" as saved '
+                               'results exceed %s bytes', count, compute.name,
+                               self.max_saved_results)
+
+    def check_disk_task(self, coro=None):
+        """Internal use only.
+
+        Updates 'disk_usage' (reported to client with pulse messages)
+        and keeps saved results and files within their limits.
+        """
+        # generator
+        if self.disk_check is not None:
+            self.disk_check = True
+            raise StopIteration
+        self.disk_check = False
+        try:
+            while True:
+                if self.max_saved_results:
+                    yield self._discard_saved_results(coro=coro)
+                self.disk_usage = yield self.io_pool.async_task(self._disk_usage)
+                if self.disk_budget and not self._evict_cached_files(0):
+                    logger.warning('Disk usage (%s bytes) exceeds budget (%s bytes)',
+                                   self.disk_usage, self.disk_budget)
+                if not self.disk_check:
+                    break
+                self.disk_check = False
+        finally:
+            self.disk_check = None
+
+    def _save_pending_state(self, compute, coro=None):
+        """Internal use only.
+
+        Called after saved results of computation are sent: state file
+        of computation that is not running anymore is updated (files of
+        computation are removed if all results are sent) and zombie
+        computation is cleaned up.
+        """
+        # generator
+        if self.computations.get(compute.id, None) is not compute:
+            # computation was loaded from its pickle file
+            if compute.pending_results == 0 and \
+               self.saved_computations.get(compute.id, None) is compute:
+                del self.saved_computations[compute.id]
+            try:
+                yield self.io_pool.async_task(self._save_compute_state, compute)
+            except:
+                logger.warning('Could not update state of computation "%s"', compute.name)
+        elif compute.pending_jobs == 0 and compute.zombie:
+            self.cleanup_computation(compute)
+
+    def resend_job_results(self, compute, coro=None):
+        """Internal use only.
+
+        Sends saved results of computation over one connection.
+        """
+        # generator
+        if compute.dest_path in self.resending or not os.path.isdir(compute.dest_path):
+            raise StopIteration(0)
+        self.resending.add(compute.dest_path)
+        # results being saved are already counted in 'pending_results'
+        while self.saving_results.get(compute.dest_path, 0):
+            yield coro.sleep(0.1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.keyfile, certfile=self.certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            yield sock.connect((compute.scheduler_ip_addr, compute.job_result_port))
+            yield sock.send_msg(b'JOB_REPLIES:' + serialize({'count': compute.pending_results}))
+            count = yield self._send_saved_results(compute, sock, coro=coro)
+        except:
+            logger.debug('Could not resend results of "%s" to %s: %s', compute.name,
+                         compute.scheduler_ip_addr, traceback.format_exc())
+            status = -1
+        else:
+            logger.debug('Resent %s results of "%s" to %s', count, compute.name,
+                         compute.scheduler_ip_addr)
+            status = 0
+            compute.last_pulse = time.time()
+        finally:
+            sock.close()
+            self.resending.discard(compute.dest_path)
+        yield self._save_pending_state(compute, coro=coro)
+        raise StopIteration(status)
 
     def timer_task(self, coro=None):
         coro.set_daemon()
@@ -1085,7 +2511,10 @@ class _DispyNode(object):
                     sock.settimeout(MsgTimeout)
                     info = {'ip_addr': self.ext_ip_addr, 'port': self.port,
                             'cpus': self.num_cpus - self.avail_cpus,
-                            'scheduler_ip_addr': self.scheduler['ip_addr']}
+                            'scheduler_ip_addr': self.scheduler['ip_addr'],
+                            'disk_usage': self.disk_usage,
+                            'code_cache_hits': self.code_cache_hits,
+                            'code_cache_misses': self.code_cache_misses}
                     yield sock.sendto(b'PULSE:' + serialize(info),
                                       (self.scheduler['ip_addr'], self.scheduler['port']))
                     sock.close()
@@ -1094,6 +2523,7 @@ class _DispyNode(object):
                           if compute.pending_results and not compute.zombie]
                 for compute in resend:
                     Coro(self.resend_job_results, compute)
+                Coro(self.check_disk_task)
 
             if self.zombie_interval and (now - last_zombie_time) >= self.zombie_interval:
                 last_zombie_time = now
@@ -1158,17 +2588,52 @@ class _DispyNode(object):
             program = [compute.name]
         args = unserialize(_job.args)
         program.extend(args)
+        if getattr(_job, 'after_args', None):
+            program.extend(unserialize(_job.after_args))
+        if job_info.cpu_slot is not None:
+            # pin program (before it starts threads etc.)
+            preexec_fn = functools.partial(os.sched_setaffinity, 0,
+                                           self.cpu_slots.cpus(job_info.cpu_slot))
+        else:
+            preexec_fn = None
         reply = job_info.job_reply
         try:
             os.chdir(compute.dest_path)
             env = {}
             env.update(os.environ)
             env['PATH'] = compute.dest_path + os.pathsep + env['PATH']
-            job_info.proc = subprocess.Popen(program, stdout=subprocess.PIPE,
-                                             stderr=subprocess.PIPE, env=env)
-
-            assert isinstance(job_info.proc, subprocess.Popen)
-            reply.stdout, reply.stderr = job_info.proc.communicate()
+            if job_info.capture_output == 'memory':
+                job_info.proc = subprocess.Popen(program, stdout=subprocess.PIPE,
+                                                 stderr=subprocess.PIPE, env=env,
+                                                 preexec_fn=preexec_fn)
+                assert isinstance(job_info.proc, subprocess.Popen)
+                reply.stdout, reply.stderr = job_info.proc.communicate()
+            elif job_info.capture_output == 'discard':
+                job_info.proc = subprocess.Popen(program, stdout=subprocess.DEVNULL,
+                                                 stderr=subprocess.DEVNULL, env=env,
+                                                 preexec_fn=preexec_fn)
+                assert isinstance(job_info.proc, subprocess.Popen)
+                job_info.proc.wait()
+            else:
+                job_info.proc = subprocess.Popen(program, stdout=subprocess.PIPE,
+                                                 stderr=subprocess.PIPE, env=env,
+                                                 preexec_fn=preexec_fn)
+                assert isinstance(job_info.proc, subprocess.Popen)
+                # pipes are read as output is produced, instead of
+                # collecting all of it with 'communicate'
+                outputs = [_DispyOutput(name, job_info, self.keyfile, self.certfile, empty=b'')
+                           for name in ('stdout', 'stderr')]
+                readers = [threading.Thread(target=self.__program_output, args=(pipe, output))
+                           for pipe, output in zip((job_info.proc.stdout, job_info.proc.stderr),
+                                                   outputs)]
+                for reader in readers:
+                    reader.start()
+                job_info.proc.wait()
+                for reader in readers:
+                    reader.join()
+                reply.stdout, reply.stderr = [output.getvalue() for output in outputs]
+                for output in outputs:
+                    output.close()
             reply.result = job_info.proc.returncode
             reply.status = DispyJob.Finished
         except:
@@ -1178,33 +2643,60 @@ class _DispyNode(object):
         job_info.proc = None
         self.reply_Q.put(reply)
 
+    def __program_output(self, pipe, output):
+        try:
+            while True:
+                data = os.read(pipe.fileno(), 65536)
+                if not data:
+                    break
+                output.write(data)
+        except:
+            logger.debug('Reading output of program failed: %s', traceback.format_exc())
+        pipe.close()
+
     def __reply_Q(self):
         while True:
             job_reply = self.reply_Q.get()
             if job_reply is None:
                 break
-            self.thread_lock.acquire()
-            job_info = self.job_infos.get(job_reply.uid, None)
-            if job_info is not None:
-                job_info.job_reply = job_reply
-            self.thread_lock.release()
-            if job_info is not None:
-                if job_info.proc is not None:
-                    if isinstance(job_info.proc, multiprocessing.Process):
-                        job_info.proc.join(2)
-                    else:
-                        job_info.proc.wait()
-                for xf in job_info.xfer_files:
-                    tgt = os.path.join(self.computations[xf.compute_id].dest_path,
-                                       os.path.basename(xf.name))
-                    self.file_uses[tgt] -= 1
-                    if self.file_uses[tgt] == 0:
-                        self.file_uses.pop(tgt)
-                        try:
-                            os.remove(tgt)
-                        except:
-                            logger.warning('Failed to remove "%s"' % tgt)
-                Coro(self._send_job_reply, job_info, resending=False)
+            if isinstance(job_reply, tuple):
+                # reply with result in file
+                self.__job_reply(*job_reply)
+            else:
+                self.__job_reply(job_reply)
+
+    def __job_reply(self, job_reply, reply_file=None):
+        self.thread_lock.acquire()
+        job_info = self.job_infos.get(job_reply.uid, None)
+        if job_info is not None:
+            job_info.job_reply = job_reply
+            job_info.reply_file = reply_file
+            if job_info.capture_output == 'discard':
+                job_reply.stdout = job_reply.stderr = None
+        self.thread_lock.release()
+        if job_info is not None:
+            # worker processes are reused for other jobs
+            if job_info.proc is not None and job_info.worker is None:
+                if isinstance(job_info.proc, multiprocessing.process.BaseProcess):
+                    job_info.proc.join(2)
+                else:
+                    job_info.proc.wait()
+            for xf in job_info.xfer_files:
+                tgt = os.path.join(self.computations[xf.compute_id].dest_path,
+                                   os.path.basename(xf.name))
+                self.file_uses[tgt] -= 1
+                if self.file_uses[tgt] == 0:
+                    self.file_uses.pop(tgt)
+                    try:
+                        os.remove(tgt)
+                    except:
+                        logger.warning('Failed to remove "%s"' % tgt)
+            Coro(self._send_job_reply, job_info, resending=False)
+        elif reply_file:
+            try:
+                os.remove(reply_file)
+            except:
+                logger.warning('Could not remove "%s"', reply_file)
 
     def _send_job_reply(self, job_info, resending=False, coro=None):
         """Internal use only.
@@ -1217,17 +2709,48 @@ class _DispyNode(object):
             self.thread_lock.acquire()
             assert self.job_infos.pop(job_reply.uid, None) is not None
             self.thread_lock.release()
-            self.avail_cpus += 1
+            if job_info.worker:
+                self._release_worker(job_info.worker)
+                job_info.worker = job_info.proc = None
+            if job_info.cpu_slot is not None:
+                self.cpu_slots.release(job_info.cpu_slot)
+                job_info.cpu_slot = None
+            thread_worker = self.thread_workers.get(job_info.compute_id, None)
+            if job_info.queued:
+                # terminated before it was started
+                pass
+            elif thread_worker:
+                thread_worker.job_infos.discard(job_info)
+                thread_worker.jobs -= 1
+                if (thread_worker.jobs % compute.jobs_per_cpu) == 0:
+                    self.avail_cpus += 1
+            else:
+                self.avail_cpus += 1
             assert self.avail_cpus <= self.num_cpus
             if compute:
                 compute.pending_jobs -= 1
+            if self.queued_jobs:
+                self._start_queued_jobs()
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock = AsyncSocket(sock, keyfile=self.keyfile, certfile=self.certfile)
         sock.settimeout(MsgTimeout)
         try:
             yield sock.connect(job_info.reply_addr)
-            yield sock.send_msg(b'JOB_REPLY:' + serialize(job_reply))
+            # large replies are sent in parts (with framing of
+            # 'send_msg') to avoid copying them
+            if job_info.reply_file:
+                yield self._send_reply_file(sock, job_info.reply_file, b'JOB_REPLY:', coro=coro)
+            else:
+                msg = serialize(job_reply)
+                if len(msg) < LargeResultSize:
+                    yield sock.send_msg(b'JOB_REPLY:' + msg)
+                else:
+                    yield sock.sendall(struct.pack('>L', len(b'JOB_REPLY:') + len(msg)) +
+                                       b'JOB_REPLY:')
+                    for i in range(0, len(msg), 1024000):
+                        yield sock.sendall(msg[i:i + 1024000])
+                msg = None
             ack = yield sock.recv_msg()
             assert ack == b'ACK'
         except:
@@ -1235,20 +2758,51 @@ class _DispyNode(object):
             if not resending:
                 # store job result so it can be sent when client is
                 # reachable or recovered by user
-                f = os.path.join(job_info.compute_dest_path, '_dispy_job_reply_%s' % job_reply.uid)
+                store = self._result_store(job_info.compute_dest_path)
                 logger.error('Could not send reply for job %s to %s; saving it in "%s"',
-                             job_reply.uid, str(job_info.reply_addr), f)
+                             job_reply.uid, str(job_info.reply_addr), store.path)
+
+                def save_reply():
+                    # called in I/O thread
+                    if job_info.reply_file:
+                        # rename so file is not removed with computation
+                        f = os.path.join(job_info.compute_dest_path,
+                                         '_dispy_job_reply_%s' % job_reply.uid)
+                        os.rename(job_info.reply_file, f)
+                        job_info.reply_file = None
+                    else:
+                        f = None
+                    store.put(job_reply.uid, job_reply, f)
+
+                # result is counted before it is saved so computation
+                # is not cleaned up meanwhile
+                if compute is not None:
+                    compute.pending_results += 1
+                dest_path = job_info.compute_dest_path
+                self.saving_results[dest_path] = self.saving_results.get(dest_path, 0) + 1
                 try:
-                    fd = open(f, 'wb')
-                    pickle.dump(job_reply, fd)
-                    fd.close()
+                    yield self.io_pool.async_task(save_reply)
                 except:
                     logger.debug('Could not save reply for job %s', job_reply.uid)
-                else:
                     if compute is not None:
-                        compute.pending_results += 1
+                        compute.pending_results -= 1
+                self.saving_results[dest_path] -= 1
+                if self.saving_results[dest_path] == 0:
+                    del self.saving_results[dest_path]
+                if self.max_saved_results:
+                    Coro(self.check_disk_task)
         else:
             status = 0
+            if resending:
+                # file with reply, if any, is removed with it
+                yield self.io_pool.async_task(
+                    self._result_store(job_info.compute_dest_path).remove, job_reply.uid)
+            elif job_info.reply_file:
+                try:
+                    os.remove(job_info.reply_file)
+                except:
+                    logger.warning('Could not remove "%s"', job_info.reply_file)
+            job_info.reply_file = None
 
             if compute:
                 compute.last_pulse = time.time()
@@ -1258,21 +2812,11 @@ class _DispyNode(object):
                     Coro(self.resend_job_results, compute)
 
             if resending:
-                f = os.path.join(job_info.compute_dest_path,
-                                 '_dispy_job_reply_%s' % job_reply.uid)
-                if os.path.isfile(f):
-                    try:
-                        os.remove(f)
-                    except:
-                        logger.warning('Could not remove "%s"' % f)
                 if compute is None:
-                    fd = open(os.path.join(self.dest_path_prefix,
-                                           '%s_%s' % (job_info.compute_id, job_info.compute_auth)),
-                              'rb')
-                    compute = pickle.load(fd)
-                    fd.close()
+                    compute = self._load_computation(job_info.compute_id, job_info.compute_auth)
                     if compute:
                         compute.pending_results -= 1
+                        yield self._save_pending_state(compute, coro=coro)
 
         finally:
             sock.close()
@@ -1281,6 +2825,283 @@ class _DispyNode(object):
             self.cleanup_computation(compute)
         raise StopIteration(status)
 
+    def _cpu_available(self, compute):
+        """Internal use only.
+
+        Returns True if a job of given computation can be started now.
+        """
+        if self.avail_cpus > 0:
+            return True
+        if compute.exec_mode == 'thread' and compute.id in self.thread_workers:
+            # jobs_per_cpu jobs share a cpu
+            return (self.thread_workers[compute.id].jobs % compute.jobs_per_cpu) != 0
+        return False
+
+    def _queue_job(self, compute, item):
+        """Internal use only.
+
+        Adds job (item is tuple of job, job info and its code) to run
+        queue of computation, to be started when a cpu is available.
+        """
+        item[1].queued = True
+        item[1].job_reply.status = DispyJob.Created
+        if compute.id not in self.run_queue:
+            self.run_queue[compute.id] = collections.deque()
+            self.run_pass[compute.id] = self.run_vtime
+        self.run_queue[compute.id].append(item)
+        self.queued_jobs += 1
+        logger.debug('Job %s of "%s" is queued (%s queued)',
+                     item[0].uid, compute.name, self.queued_jobs)
+
+    def _start_queued_jobs(self):
+        """Internal use only.
+
+        Starts jobs in run queues while cpus are available. Next job is
+        taken from computation with smallest pass, so jobs of
+        computations are started in proportion to their weights.
+        """
+        while self.queued_jobs:
+            computes = [self.computations[cid] for cid in self.run_queue
+                        if self._cpu_available(self.computations[cid])]
+            if not computes:
+                break
+            compute = min(computes, key=lambda compute: (self.run_pass[compute.id], compute.id))
+            self.run_vtime = self.run_pass[compute.id]
+            self.run_pass[compute.id] += 1.0 / compute.weight
+            run_queue = self.run_queue[compute.id]
+            _job, job_info, code_hash, job_code, code_error = run_queue.popleft()
+            if not run_queue:
+                del self.run_queue[compute.id]
+                del self.run_pass[compute.id]
+            self.queued_jobs -= 1
+            job_info.queued = False
+            self._start_job(compute, _job, job_info, code_hash, job_code, code_error)
+
+    def _start_job(self, compute, _job, job_info, code_hash=None, job_code=None, code_error=None):
+        """Internal use only.
+
+        Takes a cpu for job and starts it (in worker process, thread or
+        as program).
+        """
+        job_info.job_reply.status = DispyJob.Running
+        job_info.job_reply.start_time = time.time()
+        if compute.exec_mode == 'thread':
+            thread_worker = self.thread_workers.get(compute.id, None)
+            if thread_worker is None:
+                thread_worker = _DispyThreadWorker(compute.id)
+                self.thread_workers[compute.id] = thread_worker
+            if (thread_worker.jobs % compute.jobs_per_cpu) == 0:
+                self.avail_cpus -= 1
+            thread_worker.jobs += 1
+        else:
+            self.avail_cpus -= 1
+        if code_error:
+            job_info.job_reply.status = DispyJob.Terminated
+            job_info.job_reply.exception = code_error
+            job_info.job_reply.end_time = time.time()
+            self.reply_Q.put(job_info.job_reply)
+            return
+        if compute.exec_mode == 'thread':
+            try:
+                if thread_worker.worker is None or not thread_worker.worker.proc.is_alive():
+                    if thread_worker.worker:
+                        self._stop_worker(thread_worker.worker)
+                    thread_worker.worker = self._start_worker(compute, _dispy_thread_worker_func)
+                    thread_worker.crashed = False
+                thread_worker.job_infos.add(job_info)
+                # job code is sent with each job (it is loaded only once
+                # by worker, unless loading it fails)
+                thread_worker.worker.conn.send((job_info, _job.args, _job.kwargs,
+                                                getattr(_job, 'after_args', None),
+                                                job_code, code_hash))
+            except:
+                job_info.job_reply.status = DispyJob.Terminated
+                job_info.job_reply.exception = traceback.format_exc()
+                job_info.job_reply.end_time = time.time()
+                self.reply_Q.put(job_info.job_reply)
+            return
+        if compute.type == _Compute.prog_type and not getattr(compute, 'program_worker', False):
+            self._pin_job(job_info)
+            prog_thread = threading.Thread(target=self.__job_program, args=(_job, job_info))
+            prog_thread.start()
+            return
+        try:
+            worker = self._get_worker(compute)
+            job_info.worker = worker
+            job_info.proc = worker.proc
+            worker.job_info = job_info
+            self._pin_job(job_info, worker)
+            if compute.type == _Compute.prog_type:
+                worker.conn.send((job_info, _job.args, None,
+                                  getattr(_job, 'after_args', None), None))
+            else:
+                # send job code only if worker doesn't have it already
+                if code_hash and code_hash == worker.code_hash:
+                    job_code = None
+                else:
+                    worker.code_hash = code_hash
+                worker.conn.send((job_info, _job.args, _job.kwargs,
+                                  getattr(_job, 'after_args', None), job_code))
+        except:
+            job_info.job_reply.status = DispyJob.Terminated
+            job_info.job_reply.exception = traceback.format_exc()
+            job_info.job_reply.end_time = time.time()
+            job_info.proc = None
+            self.reply_Q.put(job_info.job_reply)
+
+    def _get_worker(self, compute):
+        """Internal use only.
+
+        Returns an idle worker process for given computation, starting
+        one if necessary.
+        """
+        workers = self.workers.setdefault(compute.id, [])
+        idle_workers = [worker for worker in workers
+                        if worker.job_info is None and worker.proc.is_alive()]
+        if self.cpu_slots:
+            # prefer worker whose cpus are free, so its memory stays local
+            for worker in idle_workers:
+                if worker.cpu_slot in self.cpu_slots.free:
+                    return worker
+        if idle_workers:
+            return idle_workers[0]
+        for worker in [worker for worker in workers
+                       if worker.job_info is None and not worker.proc.is_alive()]:
+            self._stop_worker(worker)
+
+        if compute.type == _Compute.prog_type:
+            worker = self._start_worker(compute, _dispy_program_worker_func)
+        else:
+            worker = self._start_worker(compute, _dispy_worker_func)
+        workers.append(worker)
+        return worker
+
+    def _start_worker(self, compute, target):
+        """Internal use only.
+
+        Starts worker process for given computation with function
+        'target' (one of '_dispy_*_worker_func').
+        """
+        reader, writer = self.mp_context.Pipe(False)
+        if target == _dispy_program_worker_func:
+            args = (compute.name, self.certfile, self.keyfile, compute.dest_path, reader,
+                    self.reply_Q)
+        else:
+            args = (compute.name, compute.code, compute.globals,
+                    getattr(compute, 'worker_setup', None),
+                    getattr(compute, 'worker_cleanup', None),
+                    self.certfile, self.keyfile, compute.dest_path, reader, self.reply_Q)
+        proc = self.mp_context.Process(target=target, args=args)
+        proc.start()
+        reader.close()
+        logger.debug('Started worker %s for "%s"', proc.pid, compute.name)
+        return _DispyWorker(compute.id, proc, writer)
+
+    def _pin_job(self, job_info, worker=None):
+        """Internal use only.
+
+        Assigns cpu slot to job and pins worker process executing it
+        (if any) to cpus of that slot.
+        """
+        if not self.cpu_slots:
+            return
+        job_info.cpu_slot = self.cpu_slots.allocate(prefer=worker.cpu_slot if worker else None)
+        if worker and job_info.cpu_slot is not None and worker.cpu_slot != job_info.cpu_slot:
+            _dispy_set_affinity(worker.proc.pid, self.cpu_slots.cpus(job_info.cpu_slot))
+            worker.cpu_slot = job_info.cpu_slot
+
+    def _release_worker(self, worker):
+        """Internal use only.
+        """
+        worker.job_info = None
+        worker.jobs += 1
+        compute = self.computations.get(worker.compute_id, None)
+        if compute is None or not worker.proc.is_alive() or \
+           not getattr(compute, 'reuse_workers', False) or \
+           (self.max_worker_jobs and worker.jobs >= self.max_worker_jobs):
+            self._stop_worker(worker)
+
+    def _stop_worker(self, worker, terminate=False):
+        """Internal use only.
+        """
+        workers = self.workers.get(worker.compute_id, None)
+        if workers is not None and worker in workers:
+            workers.remove(worker)
+            if not workers:
+                del self.workers[worker.compute_id]
+        if worker.proc.is_alive():
+            if terminate:
+                worker.proc.terminate()
+            else:
+                try:
+                    worker.conn.send(None)
+                except:
+                    worker.proc.terminate()
+        try:
+            worker.conn.close()
+        except:
+            pass
+
+    def worker_monitor_task(self, coro=None):
+        # worker processes that die while executing jobs (e.g., due to
+        # crash in extension module) don't send replies; terminate
+        # those jobs
+        coro.set_daemon()
+        while True:
+            yield coro.sleep(2)
+            for workers in list(self.workers.values()):
+                for worker in workers:
+                    job_info = worker.job_info
+                    if job_info is None or worker.proc.is_alive():
+                        continue
+                    if not worker.crashed:
+                        # give reply sent just before exit a chance
+                        worker.crashed = True
+                        continue
+                    self.thread_lock.acquire()
+                    if self.job_infos.get(job_info.job_reply.uid, None) == job_info and \
+                       job_info.job_reply.status == DispyJob.Running:
+                        job_reply = job_info.job_reply
+                        job_reply.status = DispyJob.Terminated
+                        job_reply.exception = 'Worker process %s for job %s died ' \
+                                              '(exit code %s)' % (worker.proc.pid, job_reply.uid,
+                                                                  worker.proc.exitcode)
+                        job_reply.end_time = time.time()
+                        job_info.proc = None
+                    else:
+                        job_reply = None
+                    self.thread_lock.release()
+                    if job_reply:
+                        logger.warning(job_reply.exception)
+                        self.reply_Q.put(job_reply)
+            for thread_worker in list(self.thread_workers.values()):
+                worker = thread_worker.worker
+                if worker is None or not thread_worker.job_infos or worker.proc.is_alive():
+                    continue
+                if not thread_worker.crashed:
+                    thread_worker.crashed = True
+                    continue
+                # all jobs running in worker are terminated; another
+                # worker is started for next job
+                thread_worker.worker = None
+                self._stop_worker(worker)
+                self.thread_lock.acquire()
+                job_replies = []
+                for job_info in thread_worker.job_infos:
+                    if self.job_infos.get(job_info.job_reply.uid, None) == job_info and \
+                       job_info.job_reply.status == DispyJob.Running:
+                        job_reply = job_info.job_reply
+                        job_reply.status = DispyJob.Terminated
+                        job_reply.exception = 'Worker process %s for job %s died ' \
+                                              '(exit code %s)' % (worker.proc.pid, job_reply.uid,
+                                                                  worker.proc.exitcode)
+                        job_reply.end_time = time.time()
+                        job_replies.append(job_reply)
+                self.thread_lock.release()
+                for job_reply in job_replies:
+                    logger.warning(job_reply.exception)
+                    self.reply_Q.put(job_reply)
+
     def cleanup_computation(self, compute):
         if not compute.zombie or compute.pending_jobs > 0:
             return
@@ -1291,17 +3112,26 @@ class _DispyNode(object):
         if self.computations.pop(compute.id, None) is None:
             logger.warning('Invalid computation "%s" to cleanup ignored' % compute.id)
             return
-
-        pkl_path = os.path.join(self.dest_path_prefix, '%s_%s' % (compute.id, compute.auth))
-        if compute.pending_results == 0:
-            try:
-                os.remove(pkl_path)
-            except:
-                logger.warning('Could not remove "%s"' % pkl_path)
-        else:
-            fd = open(pkl_path, 'wb')
-            pickle.dump(compute, fd)
-            fd.close()
+        for worker in list(self.workers.get(compute.id, [])):
+            self._stop_worker(worker)
+        for bc in self.broadcasts.pop(compute.id, {}).values():
+            bc.close()
+        compute.broadcasts = {}
+        thread_worker = self.thread_workers.pop(compute.id, None)
+        if thread_worker and thread_worker.worker:
+            # worker calls 'worker_cleanup' after its jobs are done
+            self._stop_worker(thread_worker.worker)
+            thread_worker.worker = None
+
+        store = self.result_stores.pop(compute.dest_path, None)
+        if store is not None:
+            store.close()
+        # computation itself was saved when it was added; only its
+        # counters are saved now (or its files removed)
+        try:
+            self._save_compute_state(compute)
+        except:
+            logger.warning('Could not update state of computation "%s"' % compute.name)
         try:
             self.scheduler['auth'].remove(compute.auth)
         except ValueError:
@@ -1320,6 +3150,16 @@ class _DispyNode(object):
             Coro(self.broadcast_ping_msg)
 
         if compute.cleanup is False:
+            # files are kept so they can be reused until they are
+            # removed to keep disk usage within 'disk_budget'
+            for xf in compute.xfer_files:
+                tgt = os.path.join(compute.dest_path, os.path.basename(xf.name))
+                if tgt not in self.file_uses:
+                    continue
+                self.file_uses[tgt] -= 1
+                if self.file_uses[tgt] == 0:
+                    self.file_uses.pop(tgt)
+                    self.cached_files[tgt] = xf.stat_buf.st_size
             compute.globals = {}
             return
         os.chdir(self.dest_path_prefix)
@@ -1327,10 +3167,10 @@ class _DispyNode(object):
             try:
                 localvars = {'_dispy_cleanup_args': compute.cleanup.args,
                              '_dispy_cleanup_kwargs': compute.cleanup.kwargs}
-                if os.name == 'nt':
-                    globalvars = globals()
-                else:
+                if self.fork_workers:
                     globalvars = compute.globals
+                else:
+                    globalvars = globals()
                 exec(marshal.loads(compute.code), globalvars, localvars)
                 exec('%s(*_dispy_cleanup_args, **_dispy_cleanup_kwargs)' %
                      compute.cleanup.name, globalvars, localvars)
@@ -1338,7 +3178,7 @@ class _DispyNode(object):
                 logger.debug('Cleanup "%s" failed' % compute.cleanup.name)
                 logger.debug(traceback.format_exc())
 
-        if os.name == 'nt':
+        if not self.fork_workers:
             for var in list(globals().keys()):
                 if var not in self.__init_globals:
                     logger.warning('Variable "%s" left behind by "%s" at %s is being removed' %
@@ -1354,6 +3194,15 @@ class _DispyNode(object):
                     globals()[var] = value
         compute.globals = {}
 
+        for f in glob.glob(os.path.join(compute.dest_path, '_dispy_job_result_*')) + \
+                glob.glob(os.path.join(compute.dest_path, '_dispy_job_std*_*')):
+            # result of job that was terminated while being saved and
+            # output of jobs with capture_output='file'
+            try:
+                os.remove(f)
+            except:
+                logger.warning('Could not remove "%s"', f)
+
         for xf in compute.xfer_files:
             tgt = os.path.join(compute.dest_path, os.path.basename(xf.name))
             if tgt not in self.file_uses:
@@ -1386,17 +3235,39 @@ class _DispyNode(object):
                 self.reply_Q.put(None)
             self.scheduler['ip_addr'] = None
             self.scheduler['auth'] = []
-            self.avail_cpus += len(job_infos)
+            self.avail_cpus += len([job_info for job_info in job_infos.values()
+                                    if not job_info.queued])
+            self.run_queue = {}
+            self.run_pass = {}
+            self.queued_jobs = 0
             if self.avail_cpus != self.num_cpus:
                 logger.warning('invalid cpus: %s / %s' % (self.avail_cpus, self.num_cpus))
+            if self.cpu_slots:
+                for job_info in job_infos.values():
+                    if job_info.cpu_slot is not None:
+                        self.cpu_slots.release(job_info.cpu_slot)
+                        job_info.cpu_slot = None
             self.thread_lock.release()
             for uid, job_info in job_infos.items():
+                if job_info.proc is None:
+                    continue
                 job_info.proc.terminate()
                 logger.debug('process for %s is killed', uid)
-                if isinstance(job_info.proc, multiprocessing.Process):
+                if isinstance(job_info.proc, multiprocessing.process.BaseProcess):
                     job_info.proc.join(2)
                 else:
                     job_info.proc.wait()
+            for workers in list(self.workers.values()):
+                for worker in list(workers):
+                    self._stop_worker(worker, terminate=True)
+            for thread_worker in list(self.thread_workers.values()):
+                if thread_worker.worker:
+                    self._stop_worker(thread_worker.worker, terminate=True)
+                    thread_worker.worker = None
+            for bcs in list(self.broadcasts.values()):
+                for bc in bcs.values():
+                    bc.close()
+            self.broadcasts = {}
             for cid, compute in computations:
                 sock = AsyncSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
                                    keyfile=self.keyfile, certfile=self.certfile)
@@ -1414,6 +3285,10 @@ class _DispyNode(object):
                 self.cleanup_computation(compute)
 
         if hasattr(self, 'job_infos'):
+            logger.debug('Event loop latency: %s', self.loop_latency)
+            logger.debug('Code cache: %s hits, %s misses',
+                         self.code_cache_hits, self.code_cache_misses)
+            logger.debug('Disk usage: %s bytes', self.disk_usage)
             # self.asyncoro.join()
             if quit:
                 Coro(_shutdown, self, quit).value()
@@ -1471,6 +3346,35 @@ if __name__ == '__main__':
                         help='file containing SSL key')
     parser.add_argument('--clean', action='store_true', dest='clean', default=False,
                         help='if given, files copied from or generated by clients will be removed')
+    parser.add_argument('--max_worker_jobs', dest='max_worker_jobs', type=int, default=0,
+                        help='number of jobs a worker process executes before it is replaced '
+                        '(0 for no limit), for computations that reuse workers')
+    parser.add_argument('--preload', dest='preload', default='',
+                        help='comma separated list of modules to load before starting worker '
+                        'processes, so they are shared by all workers')
+    parser.add_argument('--forkserver', action='store_true', dest='forkserver', default=False,
+                        help='if given, worker processes are started from a server process '
+                        '(with modules in --preload loaded) instead of dispynode')
+    parser.add_argument('--affinity', dest='affinity', default=None, choices=['spread', 'pack'],
+                        help='pin each job (and worker process) to its own cpus, spread across '
+                        'NUMA nodes or packed into as few NUMA nodes as possible (Linux only)')
+    parser.add_argument('--cores_per_job', dest='cores_per_job', type=int, default=1,
+                        help='number of cpus reserved for each job (e.g., for multithreaded '
+                        'jobs); node serves cpus / cores_per_job jobs at a time')
+    parser.add_argument('--overcommit', dest='overcommit', type=int, default=0,
+                        help='number of jobs (in addition to cpus) accepted and queued on node, '
+                        'so they start as soon as a cpu is available')
+    parser.add_argument('--resend_rate', dest='resend_rate', type=int, default=0,
+                        help='maximum number of saved results resent per second when client '
+                        'is reachable again (0 for no limit)')
+    parser.add_argument('--disk_budget', dest='disk_budget', default='0', type=str,
+                        help='disk space files under dest_path_prefix may use; if exceeded, '
+                        'files kept for reuse (of computations with cleanup=False) are removed, '
+                        'least recently used first (0 for no limit)')
+    parser.add_argument('--max_saved_results', dest='max_saved_results', default='0', type=str,
+                        help='disk space results that could not be sent to clients may use; '
+                        'if exceeded, oldest results are discarded and clients get '
+                        'Terminated status for those jobs (0 for no limit)')
     _dispy_config = vars(parser.parse_args(sys.argv[1:]))
     del parser
 
@@ -1526,25 +3430,26 @@ if __name__ == '__main__':
     MsgTimeout = _dispy_config['msg_timeout']
     del _dispy_config['msg_timeout']
 
-    m = re.match(r'(\d+)([kKmMgGtT]?)', _dispy_config['max_file_size'])
-    if m:
-        MaxFileSize = int(m.group(1))
-        if m.group(2):
-            m = m.group(2).lower()
-            if m == 'k':
-                MaxFileSize *= 1024
-            elif m == 'm':
-                MaxFileSize *= 1024**2
-            elif m == 'g':
-                MaxFileSize *= 1024**3
-            elif m == 't':
-                MaxFileSize *= 1024**4
-            else:
-                raise Exception('invalid max_file_size option')
-    else:
-        raise Exception('max_file_size must be >= 0')
-    del m
+    def _dispy_size(name):
+        # sizes may be given with suffix k, m, g or t
+        m = re.match(r'(\d+)([kKmMgGtT]?)', str(_dispy_config[name]))
+        if not m:
+            raise Exception('%s must be >= 0' % name)
+        return int(m.group(1)) * 1024**(' kmgt'.index(m.group(2).lower() or ' '))
+
+    MaxFileSize = _dispy_size('max_file_size')
     del _dispy_config['max_file_size']
+    _dispy_config['disk_budget'] = _dispy_size('disk_budget')
+    _dispy_config['max_saved_results'] = _dispy_size('max_saved_results')
+
+    if _dispy_config['max_worker_jobs'] < 0:
+        raise Exception('max_worker_jobs must be >= 0')
+    if _dispy_config['overcommit'] < 0:
+        raise Exception('overcommit must be >= 0')
+    if _dispy_config['resend_rate'] < 0:
+        raise Exception('resend_rate must be >= 0')
+    _dispy_config['preload'] = [module.strip() for module in _dispy_config['preload'].split(',')
+                                if module.strip()]
 
     if _dispy_config['service_start']:
         _dispy_config['service_start'] = time.strptime(_dispy_config['service_start'], '%H:%M')
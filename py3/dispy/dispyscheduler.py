@@ -28,7 +28,6 @@ import atexit
 import traceback
 import tempfile
 import shutil
-import glob
 import pickle
 
 # 'httpd' module may not be available at sys.path[0] as 'dispy.py' is
@@ -42,7 +41,8 @@ del path
 
 from dispy import _Compute, DispyJob, _DispyJob_, _Function, _Node, DispyNode, NodeAllocate, \
     _JobReply, auth_code, num_min, _parse_node_allocs, _node_ipaddr, _XferFile, _dispy_version, \
-    _same_file
+    _same_file, _Broadcast, _ResultStore, _write_file, _LoopLatency, IOThreads, \
+    _send_stored_results, _recv_result_ack
 import dispy.httpd
 
 import asyncoro
@@ -75,7 +75,10 @@ class _Cluster(object):
         self.pending_jobs = 0
         self.pending_results = 0
         self._jobs = []
+        # jobs waiting for their parent jobs ('dispy_after') to finish
+        self._blocked_jobs = {}
         self._dispy_nodes = {}
+        self._broadcasts = {}
         self.cpu_time = 0
         self.start_time = time.time()
         self.end_time = None
@@ -87,10 +90,12 @@ class _Cluster(object):
         self.client_auth = None
         self.ip_addr = None
         self.dest_path = None
+        self.max_pending = 0
 
     def __getstate__(self):
         state = dict(self.__dict__)
-        for var in ('_node_allocs', 'scheduler', 'status_callback', '_jobs', '_dispy_nodes'):
+        for var in ('_node_allocs', 'scheduler', 'status_callback', '_jobs', '_blocked_jobs',
+                    '_dispy_nodes', '_broadcasts'):
             state.pop(var, None)
         return state
 
@@ -122,7 +127,8 @@ class _Scheduler(object, metaclass=MetaSingleton):
                  pulse_interval=None, ping_interval=None,
                  node_secret='', node_keyfile=None, node_certfile=None,
                  cluster_secret='', cluster_keyfile=None, cluster_certfile=None,
-                 dest_path_prefix=None, clean=False, zombie_interval=60, http_server=False):
+                 dest_path_prefix=None, clean=False, zombie_interval=60, http_server=False,
+                 max_pending=0, resend_rate=0):
         if not hasattr(self, 'ip_addr'):
             self.ip_addrs = set()
             if ip_addr:
@@ -175,6 +181,8 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 os.makedirs(self.dest_path_prefix)
                 os.chmod(self.dest_path_prefix, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
+            self.max_pending = max_pending
+            self.resend_rate = resend_rate
             if pulse_interval:
                 try:
                     self.pulse_interval = float(pulse_interval)
@@ -203,9 +211,20 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 self.zombie_interval = None
 
             self.asyncoro = AsynCoro()
+            # disk I/O (transferred files, saved results etc.) is done
+            # in these threads so coroutines are not blocked
+            self.io_pool = asyncoro.AsyncThreadPool(IOThreads)
+            self.loop_latency = _LoopLatency(threshold=1.0, log=logger)
             atexit.register(self.shutdown)
 
             self._clusters = {}
+            # results that could not be sent to clients, indexed by
+            # cluster's dest_path
+            self.result_stores = {}
+            # dest_path of clusters whose results are being resent
+            self.resending = set()
+            # number of results being saved (in I/O threads), indexed by dest_path
+            self.saving_results = {}
             self.unsched_jobs = 0
             self._sched_jobs = {}
             self._sched_event = asyncoro.Event()
@@ -215,6 +234,9 @@ class _Scheduler(object, metaclass=MetaSingleton):
             # submitted) until the result is sent back to client
             # (otherwise, 'id' may be duplicate)
             self.done_jobs = {}
+            # jobs that are not yet done (so jobs submitted later can
+            # depend on them), indexed by uid
+            self._live_jobs = {}
             self.terminate = False
             self.sign = ''.join(hex(x)[2:] for x in os.urandom(10))
             self.auth = auth_code(self.cluster_secret, self.sign)
@@ -278,6 +300,16 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     if node is not None:
                         # assert 0 <= info['cpus'] <= node.cpus
                         node.last_pulse = time.time()
+                        for cid in node.clusters:
+                            cluster = self._clusters.get(cid, None)
+                            if cluster is None:
+                                continue
+                            dispy_node = cluster._dispy_nodes.get(node.ip_addr, None)
+                            if dispy_node is not None:
+                                dispy_node.disk_usage = info.get('disk_usage', None)
+                                dispy_node.code_cache_hits = info.get('code_cache_hits', None)
+                                dispy_node.code_cache_misses = info.get('code_cache_misses',
+                                                                        None)
                         pulse_msg = {'ip_addr': info['scheduler_ip_addr'], 'port': self.port}
 
                         def _send_pulse(self, pulse_msg, addr, coro=None):
@@ -369,6 +401,23 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 logger.warning('invalid job reply from %s:%s ignored' % (addr[0], addr[1]))
             else:
                 yield self.job_reply_process(info, conn, addr)
+        elif msg.startswith(b'JOB_REPLIES:'):
+            # saved results resent in bulk; each reply is acknowledged
+            # as it is processed, until 'END'
+            while True:
+                try:
+                    msg = yield conn.recv_msg()
+                except:
+                    break
+                if not msg.startswith(b'JOB_REPLY:'):
+                    break
+                try:
+                    info = unserialize(msg[len(b'JOB_REPLY:'):])
+                except:
+                    logger.warning('invalid job reply from %s:%s ignored' % (addr[0], addr[1]))
+                    yield conn.send_msg(b'NAK')
+                else:
+                    yield self.job_reply_process(info, conn, addr)
         elif msg.startswith(b'PONG:'):
             try:
                 info = unserialize(msg[len(b'PONG:'):])
@@ -418,6 +467,23 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 yield self.xfer_to_client(reply, xf, conn, addr)
             except:
                 logger.debug(traceback.format_exc())
+        elif msg.startswith(b'JOB_OUTPUT:'):
+            try:
+                info = unserialize(msg[len(b'JOB_OUTPUT:'):])
+                _job = self._sched_jobs[info['uid']]
+                assert _job.hash == info['hash']
+                cluster = self._clusters[_job.compute_id]
+            except:
+                logger.debug('Ignoring output of job from %s', addr[0])
+                resp = -1
+            else:
+                # output is acknowledged after client gets it, so it is
+                # not sent after job's result
+                resp = yield self.send_job_output(cluster, msg, coro=coro)
+            try:
+                yield conn.send_msg(b'ACK' if resp == 0 else b'NAK')
+            except:
+                pass
         elif msg.startswith(b'TERMINATED:'):
             try:
                 info = unserialize(msg[len(b'TERMINATED:'):])
@@ -475,10 +541,22 @@ class _Scheduler(object, metaclass=MetaSingleton):
 
     def scheduler_task(self, conn, addr, coro=None):
         # generator
-        def _job_request_task(self, cluster, _job):
+        def _job_request_task(self, cluster, _job, after, after_results):
             # function
+            if cluster.max_pending and \
+               (len(cluster._jobs) + len(cluster._blocked_jobs)) >= cluster.max_pending:
+                return b'NAK (max_pending)'
+            if after:
+                # parents that are done here but not (yet) at client
+                # can't be resolved; client waits for them and retries
+                missing = [i for i, parent in enumerate(after) if parent and
+                           getattr(self._live_jobs.get(parent[0], None), 'hash', None) != parent[1]]
+                if missing:
+                    return serialize(missing)
             _job.uid = id(_job)
             setattr(_job, 'node', None)
+            setattr(_job, 'children', None)
+            setattr(_job, 'after', None)
             dest_path = os.path.join(self.dest_path_prefix, str(_job.compute_id))
             for xf in _job.xfer_files:
                 xf.name = os.path.join(dest_path, os.path.basename(xf.name))
@@ -486,29 +564,45 @@ class _Scheduler(object, metaclass=MetaSingleton):
             job.id = _job.uid
             delattr(job, 'finish')
             setattr(_job, 'job', job)
-            cluster._jobs.append(_job)
-            self.unsched_jobs += 1
+            self._live_jobs[_job.uid] = _job
             cluster.pending_jobs += 1
             cluster.last_pulse = time.time()
-            self._sched_event.set()
+            if after:
+                _job.after = [parent[0] if parent else None for parent in after]
+                _job.after_args = after_results
+                for parent in after:
+                    if parent:
+                        parent = self._live_jobs[parent[0]]
+                        if parent.children is None:
+                            parent.children = [_job]
+                        else:
+                            parent.children.append(_job)
+                cluster._blocked_jobs[_job.uid] = _job
+            else:
+                _job.after_args = None
+                cluster._jobs.append(_job)
+                self.unsched_jobs += 1
+                self._sched_event.set()
             if cluster.status_callback:
                 cluster.status_callback(DispyJob.Created, None, job)
+            if _job.after:
+                self.release_job(cluster, _job)
             return serialize(_job.uid)
 
         def _compute_task(self, msg):
-            # function
+            # generator
             try:
                 req = unserialize(msg)
                 compute = req['compute']
                 node_allocs = req['node_allocs']
             except:
                 logger.debug('Ignoring compute request from %s', addr[0])
-                return b'NAK'
+                raise StopIteration(b'NAK')
             for xf in compute.xfer_files:
                 if MaxFileSize and xf.stat_buf.st_size > MaxFileSize:
                     logger.warning('transfer file "%s" is too big (%s)',
                                    xf.name, xf.stat_buf.st_size)
-                    return b'NAK'
+                    raise StopIteration(b'NAK')
             setattr(compute, 'nodes', {})
             cluster = _Cluster(compute, node_allocs, self)
             cluster.ip_addr = conn.getsockname()[0]
@@ -517,7 +611,7 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 try:
                     os.mkdir(dest)
                 except:
-                    return 'NAK'
+                    raise StopIteration(b'NAK')
             if compute.dest_path and isinstance(compute.dest_path, str):
                 # TODO: get os.sep from client and convert (in case of mixed environments)?
                 if compute.dest_path.startswith(os.sep):
@@ -528,10 +622,16 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     try:
                         os.makedirs(cluster.dest_path)
                     except:
-                        return 'NAK'
+                        raise StopIteration(b'NAK')
             else:
                 cluster.dest_path = tempfile.mkdtemp(prefix=compute.name + '_', dir=dest)
 
+            # limit on number of queued jobs of this client
+            cluster.max_pending = getattr(compute, 'max_pending', 0)
+            if self.max_pending and \
+               (not cluster.max_pending or cluster.max_pending > self.max_pending):
+                cluster.max_pending = self.max_pending
+
             compute.id = self.compute_id
             self.compute_id += 1
             self._clusters[compute.id] = cluster
@@ -547,14 +647,14 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 xf.compute_id = compute.id
                 xf.name = os.path.join(cluster.dest_path, os.path.basename(xf.name))
 
-            fd = open(os.path.join(self.dest_path_prefix,
-                                   '%s_%s' % (compute.id, cluster.client_auth)), 'wb')
-            pickle.dump(cluster, fd)
-            fd.close()
+            yield self.io_pool.async_task(
+                _write_file, os.path.join(self.dest_path_prefix,
+                                          '%s_%s' % (compute.id, cluster.client_auth)),
+                pickle.dumps(cluster))
             logger.debug('New computation %s: %s, %s', compute.id, compute.name, cluster.dest_path)
             resp = {'compute_id': compute.id, 'pulse_interval': self.pulse_interval,
                     'job_result_port': compute.job_result_port}
-            return serialize(resp)
+            raise StopIteration(serialize(resp))
 
         def xfer_from_client(self, msg):
             # generator
@@ -578,18 +678,20 @@ class _Scheduler(object, metaclass=MetaSingleton):
             logger.debug('Copying file %s to %s (%s)', xf.name, tgt, xf.stat_buf.st_size)
             try:
                 yield conn.send_msg(b'NAK')
-                fd = open(tgt, 'wb')
+                fd = yield self.io_pool.async_task(open, tgt, 'wb')
                 n = 0
-                while n < xf.stat_buf.st_size:
-                    data = yield conn.recvall(min(xf.stat_buf.st_size-n, 1024000))
-                    if not data:
-                        break
-                    fd.write(data)
-                    n += len(data)
-                    if MaxFileSize and n > MaxFileSize:
-                        logger.warning('File "%s" is too big (%s); it is truncated', tgt, n)
-                        break
-                fd.close()
+                try:
+                    while n < xf.stat_buf.st_size:
+                        data = yield conn.recvall(min(xf.stat_buf.st_size-n, 1024000))
+                        if not data:
+                            break
+                        yield self.io_pool.async_task(fd.write, data)
+                        n += len(data)
+                        if MaxFileSize and n > MaxFileSize:
+                            logger.warning('File "%s" is too big (%s); it is truncated', tgt, n)
+                            break
+                finally:
+                    yield self.io_pool.async_task(fd.close)
                 if n < xf.stat_buf.st_size:
                     resp = bytes('NAK (read only %s bytes)' % n, 'ascii')
                 else:
@@ -655,10 +757,11 @@ class _Scheduler(object, metaclass=MetaSingleton):
             except:
                 resp = None
             else:
-                resp = _job_request_task(self, cluster, _job)
+                resp = _job_request_task(self, cluster, _job, req.get('after', None),
+                                         req.get('after_results', None))
         elif msg.startswith(b'COMPUTE:'):
             msg = msg[len(b'COMPUTE:'):]
-            resp = _compute_task(self, msg)
+            resp = yield _compute_task(self, msg)
         elif msg.startswith(b'ADD_CLUSTER:'):
             msg = msg[len(b'ADD_CLUSTER:'):]
             try:
@@ -724,7 +827,7 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 compute_id = info['compute_id']
                 auth = info['auth']
             except:
-                resp = serialize(0)
+                resp = 0
             else:
                 cluster = self._clusters.get(compute_id, None)
                 if cluster is None:
@@ -733,10 +836,10 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     cluster = pickle.load(fd)
                     fd.close()
                 if cluster is None or cluster.client_auth != auth:
-                    resp = serialize(0)
+                    resp = 0
                 else:
-                    resp = serialize(cluster.pending_results + cluster.pending_jobs)
-            yield conn.send_msg(resp)
+                    resp = cluster.pending_results + cluster.pending_jobs
+            yield conn.send_msg(serialize(resp))
             conn.close()
             if resp > 0:
                 yield self.resend_job_results(cluster, coro=coro)
@@ -760,24 +863,17 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 if cluster is not None and cluster.client_auth == auth:
                     done = []
                     if cluster.pending_results:
-                        for result_file in glob.glob(os.path.join(cluster.dest_path,
-                                                                  '_dispy_job_reply_*')):
-                            result_file = os.path.basename(result_file)
-                            try:
-                                uid = int(result_file[len('_dispy_job_reply_'):])
-                            except:
-                                pass
-                            else:
-                                done.append(uid)
-                                # limit so as not to take up too much time
-                                if len(done) > 50:
-                                    break
+                        # limit so as not to take up too much time
+                        done = self._result_store(cluster.dest_path).uids(limit=1024)
                     reply['done'] = done
                     reply['pending'] = cluster.pending_jobs
             resp = serialize(reply)
         elif msg.startswith(b'RETRIEVE_JOB:'):
             msg = msg[len(b'RETRIEVE_JOB:'):]
             yield self.retrieve_job_task(conn, msg)
+        elif msg.startswith(b'RETRIEVE_JOBS:'):
+            msg = msg[len(b'RETRIEVE_JOBS:'):]
+            yield self.retrieve_jobs_task(conn, msg, coro=coro)
         elif msg.startswith(b'ALLOCATE_NODE:'):
             req = msg[len(b'ALLOCATE_NODE:'):]
             try:
@@ -788,6 +884,33 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 resp = serialize(resp)
             except:
                 resp = serialize(-1)
+        elif msg.startswith(b'BROADCAST:'):
+            req = msg[len(b'BROADCAST:'):]
+            try:
+                req = unserialize(req)
+                cluster = self._clusters[req['compute_id']]
+                assert cluster.client_auth == req['auth']
+                data = yield conn.recvall(req['size'])
+                assert len(data) == req['size']
+                bc = _Broadcast(req['name'], data)
+                bc.kind = req['kind']
+                bc.meta = req['meta']
+                resp = yield self.broadcast(cluster, bc, coro=coro)
+                resp = serialize(resp)
+            except:
+                logger.warning('Invalid broadcast request from %s', addr[0])
+                resp = serialize(-1)
+        elif msg.startswith(b'RETRIEVE_OUTPUT:'):
+            req = msg[len(b'RETRIEVE_OUTPUT:'):]
+            try:
+                req = unserialize(req)
+                cluster = self._clusters[req['compute_id']]
+                assert cluster.client_auth == req['auth']
+                node = self._nodes[req['node']]
+            except:
+                resp = serialize(None)
+            else:
+                yield self.retrieve_output(cluster, node, req['uid'], conn, coro=coro)
         elif msg.startswith(b'SET_NODE_CPUS:'):
             req = msg[len(b'SET_NODE_CPUS:'):]
             try:
@@ -810,24 +933,69 @@ class _Scheduler(object, metaclass=MetaSingleton):
         conn.close()
         # end of scheduler_task
 
+    def _result_store(self, dest_path):
+        """Internal use only.
+
+        Returns store of pending results of cluster with given
+        'dest_path'.
+        """
+        store = self.result_stores.get(dest_path, None)
+        if store is None:
+            store = _ResultStore(os.path.join(dest_path, '_dispy_results.db'))
+            self.result_stores[dest_path] = store
+        return store
+
+    def _send_saved_results(self, cluster, sock, jobs=None, coro=None):
+        """Internal use only.
+
+        Sends saved results of cluster over 'sock' (see
+        '_send_stored_results'). Returns number of results sent.
+        """
+        # generator
+        def send_reply(result, path):
+            # generator
+            yield sock.send_msg(b'JOB_REPLY:' + serialize(result))
+
+        count = yield _send_stored_results(
+            self._result_store(cluster.dest_path), sock, send_reply, cluster,
+            cluster.client_ip_addr, self.io_pool, jobs=jobs, resend_rate=self.resend_rate,
+            coro=coro)
+        raise StopIteration(count)
+
     def resend_job_results(self, cluster, coro=None):
-        # TODO: limit number queued so as not to take up too much space/time
-        result_files = [f for f in os.listdir(cluster.dest_path)
-                        if f.startswith('_dispy_job_reply_')]
-        result_files = result_files[:min(len(result_files), 64)]
-        for result_file in result_files:
-            result_file = os.path.join(cluster.dest_path, result_file)
-            try:
-                fd = open(result_file, 'rb')
-                result = pickle.load(fd)
-                fd.close()
-            except:
-                logger.debug('Could not load "%s"', result_file)
-            else:
-                status = yield self.send_job_result(
-                    result.uid, cluster, result, resending=True, coro=coro)
-                if status:
-                    break
+        """Internal use only.
+
+        Sends saved results of cluster over one connection.
+        """
+        # generator
+        if cluster.dest_path in self.resending or not os.path.isdir(cluster.dest_path):
+            raise StopIteration(0)
+        self.resending.add(cluster.dest_path)
+        # results being saved are already counted in 'pending_results'
+        while self.saving_results.get(cluster.dest_path, 0):
+            yield coro.sleep(0.1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.cluster_keyfile, certfile=self.cluster_certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            yield sock.connect((cluster.client_ip_addr, cluster.client_job_result_port))
+            yield sock.send_msg(b'JOB_REPLIES:' + serialize({'count': cluster.pending_results}))
+            count = yield self._send_saved_results(cluster, sock, coro=coro)
+        except:
+            logger.debug('Could not resend results of "%s" to %s: %s', cluster.name,
+                         cluster.client_ip_addr, traceback.format_exc())
+            status = -1
+        else:
+            logger.debug('Resent %s results of "%s" to %s', count, cluster.name,
+                         cluster.client_ip_addr)
+            status = 0
+            cluster.last_pulse = time.time()
+        finally:
+            sock.close()
+            self.resending.discard(cluster.dest_path)
+        if cluster.pending_jobs == 0 and cluster.pending_results == 0 and cluster.zombie:
+            Coro(self.cleanup_computation, cluster)
+        raise StopIteration(status)
 
     def timer_task(self, coro=None):
         coro.set_daemon()
@@ -1023,6 +1191,9 @@ class _Scheduler(object, metaclass=MetaSingleton):
             logger.warning('Invalid computation "%s" to cleanup ignored' % compute.id)
             raise StopIteration
 
+        store = self.result_stores.pop(cluster.dest_path, None)
+        if store is not None:
+            store.close()
         pkl_path = os.path.join(self.dest_path_prefix,
                                 '%s_%s' % (compute.id, cluster.client_auth))
         if cluster.pending_results == 0:
@@ -1031,9 +1202,7 @@ class _Scheduler(object, metaclass=MetaSingleton):
             except:
                 logger.warning('Could not remove "%s"' % pkl_path)
         else:
-            fd = open(pkl_path, 'wb')
-            pickle.dump(compute, fd)
-            fd.close()
+            yield self.io_pool.async_task(_write_file, pkl_path, pickle.dumps(compute))
         for xf in compute.xfer_files:
             try:
                 os.remove(xf.name)
@@ -1080,8 +1249,11 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 continue
             dispy_node = DispyNode(node.ip_addr, node.name, node.cpus)
             dispy_node.avail_cpus = node.avail_cpus
+            dispy_node.topology = node.topology
             cluster._dispy_nodes[node.ip_addr] = dispy_node
             r = yield node.setup(compute, coro=coro)
+            if not r:
+                r = yield self.send_broadcasts(cluster, node, coro=coro)
             if r:
                 cluster._dispy_nodes.pop(node.ip_addr, None)
                 logger.warning('Failed to setup %s for computation "%s"',
@@ -1144,6 +1316,8 @@ class _Scheduler(object, metaclass=MetaSingleton):
         node_computations = []
         node.name = info['name']
         node.scheduler_ip_addr = info['scheduler_ip_addr']
+        node.topology = info.get('topology', None)
+        node.overcommit = info.get('overcommit', 0)
         for cid, cluster in self._clusters.items():
             if cid in node.clusters:
                 continue
@@ -1173,29 +1347,31 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 # store job result even if computation has not enabled
                 # fault recovery; user may be able to access node and
                 # retrieve result manually
-                f = os.path.join(cluster.dest_path, '_dispy_job_reply_%s' % uid)
+                store = self._result_store(cluster.dest_path)
                 logger.error('Could not send reply for job %s to %s:%s; saving it in "%s"',
-                             uid, cluster.client_ip_addr, cluster.client_job_result_port, f)
+                             uid, cluster.client_ip_addr, cluster.client_job_result_port,
+                             store.path)
+                # result is counted before it is saved so cluster is
+                # not cleaned up meanwhile
+                cluster.pending_results += 1
+                dest_path = cluster.dest_path
+                self.saving_results[dest_path] = self.saving_results.get(dest_path, 0) + 1
                 try:
-                    fd = open(f, 'wb')
-                    pickle.dump(result, fd)
-                    fd.close()
+                    yield self.io_pool.async_task(store.put, uid, result)
                 except:
                     logger.debug('Could not save reply for job %s', uid)
-                else:
-                    cluster.pending_results += 1
+                    cluster.pending_results -= 1
+                self.saving_results[dest_path] -= 1
+                if self.saving_results[dest_path] == 0:
+                    del self.saving_results[dest_path]
         else:
             status = 0
             cluster.last_pulse = time.time()
             if result.status != DispyJob.ProvisionalResult:
                 if resending:
                     cluster.pending_results -= 1
-                    f = os.path.join(cluster.dest_path, '_dispy_job_reply_%s' % uid)
-                    if os.path.isfile(f):
-                        try:
-                            os.remove(f)
-                        except:
-                            logger.warning('Could not remove "%s"' % f)
+                    yield self.io_pool.async_task(
+                        self._result_store(cluster.dest_path).remove, uid)
                 else:
                     self.done_jobs.pop(uid, None)
                     if cluster.pending_results:
@@ -1207,6 +1383,24 @@ class _Scheduler(object, metaclass=MetaSingleton):
 
         raise StopIteration(status)
 
+    def send_job_output(self, cluster, msg, coro=None):
+        # generator
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.cluster_keyfile, certfile=self.cluster_certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            yield sock.connect((cluster.client_ip_addr, cluster.client_job_result_port))
+            yield sock.send_msg(msg)
+            ack = yield sock.recv_msg()
+            assert ack == b'ACK'
+        except:
+            status = -1
+        else:
+            status = 0
+        finally:
+            sock.close()
+        raise StopIteration(status)
+
     def send_job_status(self, cluster, _job, coro=None):
         if cluster.status_callback:
             dispy_node = cluster._dispy_nodes.get(_job.node.ip_addr, None)
@@ -1309,8 +1503,57 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     os.remove(xf.name)
                 except:
                     logger.warning('Could not remove "%s"' % xf.name)
+            self.finish_job(_job, reply.status, reply.result)
         Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
 
+    def finish_job(self, _job, status, result):
+        # non-generator
+        # called when _job is done; jobs waiting for it are released
+        # (or cancelled if _job didn't finish successfully)
+        self._live_jobs.pop(_job.uid, None)
+        children, _job.children = _job.children, None
+        if not children:
+            return
+        for child in children:
+            if child.after is None:
+                continue
+            for i, uid in enumerate(child.after):
+                if uid == _job.uid:
+                    child.after[i] = None
+                    if child.after_args is not None:
+                        child.after_args[i] = result
+            cluster = self._clusters.get(child.compute_id, None)
+            if cluster is None:
+                continue
+            if status == DispyJob.Finished:
+                self.release_job(cluster, child)
+            elif cluster._blocked_jobs.pop(child.uid, None) is not None:
+                logger.debug('Cancelling job %s as its parent %s failed', child.uid, _job.uid)
+                child.after = None
+                cluster.pending_jobs -= 1
+                if cluster.pending_jobs == 0:
+                    cluster.end_time = time.time()
+                self.done_jobs[child.uid] = child
+                reply = _JobReply(child, cluster.ip_addr, status=DispyJob.Cancelled)
+                Coro(self.send_job_result, child.uid, cluster, reply, resending=False)
+                self.finish_job(child, DispyJob.Cancelled, None)
+
+    def release_job(self, cluster, _job):
+        # non-generator
+        # queue blocked _job for scheduling if all its parents are done
+        if any(uid is not None for uid in _job.after):
+            return
+        if cluster._blocked_jobs.pop(_job.uid, None) is None:
+            return
+        _job.after = None
+        if _job.after_args is not None:
+            if cluster._compute.type == _Compute.prog_type:
+                _job.after_args = [str(result) for result in _job.after_args]
+            _job.after_args = serialize(_job.after_args)
+        cluster._jobs.append(_job)
+        self.unsched_jobs += 1
+        self._sched_event.set()
+
     def reschedule_jobs(self, dead_jobs):
         # non-generator
         for _job in dead_jobs:
@@ -1331,20 +1574,27 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     cluster.end_time = time.time()
                 self.done_jobs[_job.uid] = _job
                 Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
+                self.finish_job(_job, DispyJob.Abandoned, None)
 
     def load_balance_schedule(self):
         # TODO: maintain "available" sequence of nodes for better performance
         host = None
-        load = 1.0
+        load = None
         for node in self._nodes.values():
-            if node.busy >= node.cpus:
-                continue
             if all((not self._clusters[cid]._jobs) for cid in node.clusters):
                 continue
+            # nodes used only by clusters that execute jobs in threads
+            # may run more jobs than cpus
+            cpus = node.cpus * min(self._clusters[cid]._compute.jobs_per_cpu
+                                   for cid in node.clusters)
+            # nodes with 'overcommit' queue that many jobs more, to start
+            # them as soon as cpus are available
+            if not cpus or node.busy >= (cpus + node.overcommit):
+                continue
             # logger.debug('load: %s, %s, %s' % (node.ip_addr, node.busy, node.cpus))
-            if (float(node.busy) / node.cpus) < load:
+            if load is None or (float(node.busy) / cpus) < load:
                 host = node
-                load = float(node.busy) / node.cpus
+                load = float(node.busy) / cpus
         return host
 
     def run_job(self, _job, cluster, coro=None):
@@ -1384,6 +1634,10 @@ class _Scheduler(object, metaclass=MetaSingleton):
             _job.job.status = DispyJob.Running
             _job.job.start_time = time.time()
             cluster = self._clusters[_job.compute_id]
+            if not cluster._compute.reentrant:
+                # job is not sent again, so its serialized data is not needed
+                _job.args = _job.kwargs = _job.after_args = None
+                _job.code = ''
             # TODO/Note: It is likely that this job status may arrive at
             # the client before the job is done and the node's status
             # arrives. Either use queing for messages (ideally with
@@ -1416,7 +1670,7 @@ class _Scheduler(object, metaclass=MetaSingleton):
                 continue
             cluster = self._clusters[_job.compute_id]
             _job.node = node
-            assert node.busy < node.cpus
+            # assert node.busy < node.cpus
             self._sched_jobs[_job.uid] = _job
             self.unsched_jobs -= 1
             node.busy += 1
@@ -1429,14 +1683,16 @@ class _Scheduler(object, metaclass=MetaSingleton):
             compute = cluster._compute
             Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
         for cid, cluster in self._clusters.items():
-            for _job in cluster._jobs:
+            for _job in cluster._jobs + list(cluster._blocked_jobs.values()):
                 reply = _JobReply(_job, cluster.ip_addr, status=DispyJob.Terminated)
                 Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
             cluster._jobs = []
+            cluster._blocked_jobs = {}
         clusters = list(self._clusters.values())
         self._clusters = {}
         self._sched_jobs = {}
         self.done_jobs = {}
+        self._live_jobs = {}
         for cluster in clusters:
             compute = cluster._compute
             if compute is None:
@@ -1476,15 +1732,9 @@ class _Scheduler(object, metaclass=MetaSingleton):
             yield send_reply(None)
             raise StopIteration
 
-        info_file = os.path.join(cluster.dest_path, '_dispy_job_reply_%s' % uid)
-        if not os.path.isfile(info_file):
-            yield send_reply(None)
-            raise StopIteration
-
+        store = self._result_store(cluster.dest_path)
         try:
-            fd = open(info_file, 'rb')
-            job_reply = pickle.load(fd)
-            fd.close()
+            job_reply, _ = yield self.io_pool.async_task(store.get, uid)
             assert job_reply.hash == job_hash
         except:
             yield send_reply(None)
@@ -1492,19 +1742,53 @@ class _Scheduler(object, metaclass=MetaSingleton):
 
         try:
             yield conn.send_msg(serialize(job_reply))
-            ack = yield conn.recv_msg()
-            assert ack == b'ACK'
-            cluster.pending_results -= 1
-            fd = open(pkl_path, 'wb')
-            pickle.dump(cluster, fd)
-            fd.close()
+            acked = yield _recv_result_ack(store, uid, conn, cluster, cluster.client_ip_addr,
+                                           self.io_pool)
         except:
             pass
         else:
+            if acked and compute_id not in self._clusters:
+                yield self.io_pool.async_task(_write_file, pkl_path, pickle.dumps(cluster))
+
+    def retrieve_jobs_task(self, conn, msg, coro=None):
+        # generator
+        # results of many jobs are sent in one stream, as with
+        # resend_job_results
+        try:
+            req = unserialize(msg)
+            compute_id = req['compute_id']
+            auth = req['auth']
+            jobs = req['jobs']
+        except:
+            yield conn.send_msg(b'NAK')
+            raise StopIteration
+
+        pkl_path = os.path.join(self.dest_path_prefix, '%s_%s' % (compute_id, auth))
+        cluster = self._clusters.get(compute_id, None)
+        if cluster is None:
             try:
-                os.remove(info_file)
+                fd = open(pkl_path, 'rb')
+                cluster = pickle.load(fd)
+                fd.close()
             except:
                 pass
+        if cluster is None or cluster.client_auth != auth:
+            yield conn.send_msg(b'NAK')
+            raise StopIteration
+
+        try:
+            count = yield self._send_saved_results(cluster, conn, jobs=jobs, coro=coro)
+        except:
+            logger.debug('Could not send results of "%s": %s', cluster.name,
+                         traceback.format_exc())
+        else:
+            logger.debug('Sent %s results of "%s"', count, cluster.name)
+        # cluster is saved once for all results sent
+        if compute_id not in self._clusters:
+            try:
+                yield self.io_pool.async_task(_write_file, pkl_path, pickle.dumps(cluster))
+            except:
+                logger.warning('Could not update "%s"', pkl_path)
 
     def cancel_job(self, cluster, uid):
         # function
@@ -1519,10 +1803,26 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     cluster.pending_jobs -= 1
                     reply = _JobReply(_job, cluster.ip_addr, status=DispyJob.Cancelled)
                     Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
+                    self.finish_job(_job, DispyJob.Cancelled, None)
                     break
             else:
-                logger.debug('Invalid job %s!', uid)
-                return -1
+                _job = cluster._blocked_jobs.pop(uid, None)
+                if _job is None:
+                    logger.debug('Invalid job %s!', uid)
+                    return -1
+                for parent_uid in _job.after:
+                    parent = self._live_jobs.get(parent_uid, None)
+                    if parent is not None and parent.children:
+                        try:
+                            parent.children.remove(_job)
+                        except ValueError:
+                            pass
+                _job.after = None
+                self.done_jobs[_job.uid] = _job
+                cluster.pending_jobs -= 1
+                reply = _JobReply(_job, cluster.ip_addr, status=DispyJob.Cancelled)
+                Coro(self.send_job_result, _job.uid, cluster, reply, resending=False)
+                self.finish_job(_job, DispyJob.Cancelled, None)
         else:
             _job.job.status = DispyJob.Cancelled
             Coro(_job.node.send, b'TERMINATE_JOB:' + serialize(_job), reply=False)
@@ -1574,6 +1874,60 @@ class _Scheduler(object, metaclass=MetaSingleton):
                     ]
         raise StopIteration(jobs)
 
+    def send_broadcasts(self, cluster, node, coro=None):
+        # generator
+        # data may be broadcast while sending earlier data
+        sent = set()
+        while True:
+            bcs = [bc for bc in cluster._broadcasts.values() if bc not in sent]
+            if not bcs:
+                break
+            for bc in bcs:
+                r = yield node.broadcast(cluster._compute, bc, coro=coro)
+                if r:
+                    raise StopIteration(r)
+                sent.add(bc)
+        raise StopIteration(0)
+
+    def broadcast(self, cluster, bc, coro=None):
+        # generator
+        cluster._broadcasts[bc.name] = bc
+        # nodes being setup get data in 'send_broadcasts'
+        coros = [Coro(node.broadcast, cluster._compute, bc) for node in self._nodes.values()
+                 if cluster._compute.id in node.clusters]
+        n = 0
+        for coro_ in coros:
+            r = yield coro_.finish()
+            if r == 0:
+                n += 1
+        raise StopIteration(n)
+
+    def retrieve_output(self, cluster, node, uid, conn, coro=None):
+        # generator
+        # output saved by node is relayed to client in chunks
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = AsyncSocket(sock, keyfile=self.node_keyfile, certfile=self.node_certfile)
+        sock.settimeout(MsgTimeout)
+        try:
+            yield sock.connect((node.ip_addr, node.port))
+            yield sock.sendall(node.auth)
+            req = {'compute_id': cluster._compute.id, 'auth': cluster._compute.auth, 'uid': uid}
+            yield sock.send_msg(b'RETRIEVE_OUTPUT:' + serialize(req))
+            msg = yield sock.recv_msg()
+            yield conn.send_msg(msg)
+            sizes = unserialize(msg)
+            n = sum(sizes) if sizes else 0
+            while n > 0:
+                data = yield sock.recvall(min(n, 1024000))
+                if not data:
+                    break
+                yield conn.sendall(data)
+                n -= len(data)
+        except:
+            logger.warning('Could not retrieve output of job %s from %s', uid, node.ip_addr)
+        finally:
+            sock.close()
+
     def set_node_cpus(self, node, cpus, coro=None):
         # generator
 
@@ -1621,6 +1975,7 @@ class _Scheduler(object, metaclass=MetaSingleton):
             print(' %-30.30s | %5s | %13.3f' % (name, node.cpus, node.cpu_time))
         print()
         print('Total job time: %.3f sec' % (tot_cpu_time))
+        print('Event loop latency: %s' % self.loop_latency)
         print()
 
 if __name__ == '__main__':
@@ -1670,6 +2025,12 @@ if __name__ == '__main__':
                         help='path prefix where files sent by dispy are stored')
     parser.add_argument('--max_file_size', dest='max_file_size', default=str(MaxFileSize), type=str,
                         help='maximum file size of any file transferred')
+    parser.add_argument('--max_pending', dest='max_pending', type=int, default=0,
+                        help='maximum number of jobs of a client that are queued; '
+                        'clients can not submit more jobs until queued jobs are scheduled')
+    parser.add_argument('--resend_rate', dest='resend_rate', type=int, default=0,
+                        help='maximum number of saved results resent per second when client '
+                        'is reachable again (0 for no limit)')
     parser.add_argument('--clean', action='store_true', dest='clean', default=False,
                         help='if given, files copied from or generated by clients '
                         'will be removed')
@@ -1712,6 +2073,9 @@ if __name__ == '__main__':
         raise Exception('max_file_size must be >= 0')
     del config['max_file_size']
 
+    if config['resend_rate'] < 0:
+        raise Exception('resend_rate must be >= 0')
+
     scheduler = _Scheduler(**config)
     while True:
         try:
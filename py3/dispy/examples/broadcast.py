@@ -0,0 +1,39 @@
+# Example program that sends data to nodes once with 'broadcast'
+# instead of loading it in 'setup' (see node_setup.py). Nodes keep
+# the data in shared memory and jobs get it with 'dispy_broadcast'
+# without copying it, whether worker processes are forked or not.
+import sys
+
+def compute(n):
+    import hashlib
+    # 'data' is read-only memoryview of data sent with 'broadcast'
+    data = dispy_broadcast('data')
+    algorithms = dispy_broadcast('algorithms')
+    alg = algorithms[n % len(algorithms)]
+    csum = getattr(hashlib, alg)()
+    csum.update(data)
+    return (alg, csum.hexdigest())
+
+if __name__ == '__main__':
+    import dispy, hashlib
+    cluster = dispy.JobCluster(compute)
+    data = open(sys.argv[0], 'rb').read()
+    cluster.broadcast('data', data)
+    if sys.version_info.major > 2:
+        cluster.broadcast('algorithms', sorted(hashlib.algorithms_guaranteed))
+    else:
+        cluster.broadcast('algorithms', sorted(hashlib.algorithms))
+    jobs = []
+    for n in range(10):
+        job = cluster.submit(n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: %s : %s' % (job.id, job.result[0], job.result[1]))
+        else:
+            print(job.exception)
+    cluster.print_status()
+    cluster.close()
@@ -0,0 +1,28 @@
+# Example program where jobs return large results. With
+# 'mmap_result_size', results (bytes or numpy arrays) at least that
+# big are saved in files in client's current directory as they are
+# received, instead of being kept in memory; job's result is then
+# read-only memoryview (or numpy.memmap for arrays) of the file, so
+# data is read from disk only when used.
+
+def compute(n):
+    import os
+    return os.urandom(1024**2) * n
+
+if __name__ == '__main__':
+    import dispy
+    cluster = dispy.JobCluster(compute, mmap_result_size=1024**2)
+    jobs = []
+    for n in range(1, 11):
+        job = cluster.submit(n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: %s bytes in %s' % (job.id, len(job.result), type(job.result).__name__))
+        else:
+            print(job.exception)
+    cluster.print_status()
+    cluster.close()
@@ -0,0 +1,33 @@
+# Example program where computation is a Python program (this file
+# itself). With 'program_worker=True', nodes execute the program in
+# worker processes that are reused for jobs (with 'runpy'), instead of
+# starting new Python interpreter for each job, so short jobs finish
+# much faster. Job's arguments are in 'sys.argv' and exit status of
+# the program is job's result.
+import sys
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'job':
+    # executed on node as job
+    n = int(sys.argv[2])
+    print('%s squared is %s' % (n, n * n))
+    sys.exit(n % 3)
+
+elif __name__ == '__main__':
+    import dispy, time
+    cluster = dispy.JobCluster(sys.argv[0], program_worker=True)
+    start = time.time()
+    jobs = []
+    for n in range(20):
+        job = cluster.submit('job', n)
+        job.id = n
+        jobs.append(job)
+
+    for job in jobs:
+        job()
+        if job.status == dispy.DispyJob.Finished:
+            print('%s: exit status %s, output: %s' % (job.id, job.result, job.stdout.strip()))
+        else:
+            print(job.exception)
+    print('elapsed: %.2f sec' % (time.time() - start))
+    cluster.print_status()
+    cluster.close()